@@ -329,12 +329,7 @@ def get_bird_sessions(bird):
     <tbody>
     </table>
     """
-    try:
-        g.c.execute("SELECT state,COUNT(1) AS count FROM state_vw WHERE "
-                    + "bird=%s GROUP BY 1 ORDER BY 2 DESC", bname)
-        rows = g.c.fetchall()
-    except Exception as err:
-        raise InvalidUsage(sql_error(err), 500) from err
+    rows = get_state_counts(bname)
     sessions += "<table id='state' class='state'><thead><tr>"
     for row in rows:
         sessions += f"<th>{row['state']}</th>"
@@ -3697,7 +3692,8 @@ def get_marker(marker=""):
 def get_allelic_state(bird=""):
     '''
     Get allelic state information for a bird
-    Return information on a bird's allelic state.
+    Return information on a bird's allelic state. Packed genotypes are read
+    as a single row; otherwise states come from one row per marker.
     ---
     tags:
       - Allelic state
@@ -3710,6 +3706,10 @@ def get_allelic_state(bird=""):
         description: bird name
     '''
     result = initialize_result()
+    packed = get_packed_genotype(bird)
+    if packed is not None:
+        result["data"] = {marker: packed[marker] for marker in sorted(packed)}
+        return generate_response(result)
     execute_sql(result, f"SELECT marker,state FROM state_vw WHERE bird='{bird}' ORDER BY marker",
                 app.config["DEBUG"], "temp")
     result["data"] = {}
@@ -3719,6 +3719,137 @@ def get_allelic_state(bird=""):
     return generate_response(result)
 
 
+@app.route('/neighbors/<string:bird>', methods=['GET'])
+@app.route('/neighbors/<string:bird>/<string:comparison>', methods=['GET'])
+def get_neighbors(bird="", comparison="allele_match_all"):
+    '''
+    Get a bird's nearest genetic neighbors
+    Return the birds with the highest allele match to a bird. Only stored
+    comparisons are ranked, so runs of compute_similarity.py with --topk k
+    support counts up to k.
+    ---
+    tags:
+      - Allelic state
+    parameters:
+      - in: path
+        name: bird
+        schema:
+          type: string
+        required: true
+        description: bird name
+      - in: path
+        name: comparison
+        schema:
+          type: string
+        required: false
+        description: comparison (allele_match_all or allele_match_seq)
+      - in: query
+        name: count
+        schema:
+          type: integer
+        required: false
+        description: number of neighbors to return (default 10)
+    '''
+    result = initialize_result()
+    if comparison not in ("allele_match_all", "allele_match_seq"):
+        raise InvalidUsage(f"Unknown comparison {comparison}")
+    count = request.args.get("count", 10, type=int)
+    try:
+        g.c.execute(READ['NEIGHBORS'], (bird, bird, comparison, count))
+        rows = g.c.fetchall()
+    except Exception as err:
+        raise InvalidUsage(sql_error(err), 500) from err
+    result["data"] = []
+    for row in rows:
+        result["data"].append({"bird": row["bird1"] if row["bird2"] == bird else row["bird2"],
+                               "relationship": row["relationship"],
+                               "comparison": row["comparison"],
+                               "value": float(row["value"])})
+    result["rest"]["row_count"] = len(result["data"])
+    return generate_response(result)
+
+
+@app.route('/similarity/<string:comparison>/<string:bird>', methods=['GET'])
+def get_similarity_row(comparison="", bird=""):
+    '''
+    Get a bird's similarity to all other birds
+    Return comparison values for a bird from the similarity matrix store.
+    ---
+    tags:
+      - Allelic state
+    parameters:
+      - in: path
+        name: comparison
+        schema:
+          type: string
+        required: true
+        description: comparison (allele_match_all or allele_match_seq)
+      - in: path
+        name: bird
+        schema:
+          type: string
+        required: true
+        description: bird name
+    '''
+    result = initialize_result()
+    store = get_similarity_store(app.config.get("SIMILARITY_MATRIX"))
+    if comparison not in store["metrics"]:
+        raise InvalidUsage(f"Comparison {comparison} is not in the similarity matrix store", 404)
+    if bird not in store["index"]:
+        raise InvalidUsage(f"Bird {bird} is not in the similarity matrix store", 404)
+    row = store["index"][bird]
+    others = np.arange(len(store["birds"]))
+    others = others[others != row]
+    values = store["metrics"][comparison][similarity_index(store, row, others)]
+    result["data"] = {store["birds"][other]: (None if np.isnan(value) else float(value))
+                      for other, value in zip(others.tolist(), values)}
+    result["rest"]["row_count"] = len(result["data"])
+    return generate_response(result)
+
+
+@app.route('/similarity/<string:comparison>/<string:bird1>/<string:bird2>', methods=['GET'])
+def get_similarity_pair(comparison="", bird1="", bird2=""):
+    '''
+    Get the similarity of two birds
+    Return a comparison value for a pair of birds from the similarity matrix store.
+    ---
+    tags:
+      - Allelic state
+    parameters:
+      - in: path
+        name: comparison
+        schema:
+          type: string
+        required: true
+        description: comparison (allele_match_all or allele_match_seq)
+      - in: path
+        name: bird1
+        schema:
+          type: string
+        required: true
+        description: bird1 name
+      - in: path
+        name: bird2
+        schema:
+          type: string
+        required: true
+        description: bird2 name
+    '''
+    result = initialize_result()
+    store = get_similarity_store(app.config.get("SIMILARITY_MATRIX"))
+    if comparison not in store["metrics"]:
+        raise InvalidUsage(f"Comparison {comparison} is not in the similarity matrix store", 404)
+    for bird in (bird1, bird2):
+        if bird not in store["index"]:
+            raise InvalidUsage(f"Bird {bird} is not in the similarity matrix store", 404)
+    if bird1 == bird2:
+        raise InvalidUsage("Birds must be different")
+    value = store["metrics"][comparison][similarity_index(store, store["index"][bird1],
+                                                          store["index"][bird2])]
+    result["data"] = None if np.isnan(value) else float(value)
+    return generate_response(result)
+
+
 @app.route('/colortest', methods=['GET'])
 def get_cc():
     '''
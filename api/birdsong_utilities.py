@@ -2,13 +2,17 @@
     Birdsong manager utilities
 '''
 
+from collections import Counter
 from datetime import datetime
 import inspect
+import json
+import os
 import random
 import re
 import string
 from urllib.parse import parse_qs
 from flask import g, request
+import numpy as np
 import requests
 
 # pylint: disable=C0302, W0703
@@ -16,6 +20,8 @@ import requests
 CONFIG = {'config': {"url": "http://config.int.janelia.org/"}}
 BEARER = ""
 KEY_TYPE_IDS = {}
+SIMILARITY = {} # Memory-mapped similarity matrix store
+MARKER_SET = {} # Packed genotype marker set ID: list of markers
 
 # SQL statements
 READ = {
@@ -23,6 +29,8 @@ READ = {
     'CSUMMARY': "SELECT * FROM clutch_vw ORDER BY name DESC",
     'COMPARISON': "SELECT bird1,bird2,relationship,comparison,value FROM bird_comparison_vw "
                   + "WHERE bird1=%s OR bird2=%s ORDER BY 1,2",
+    'NEIGHBORS': "SELECT bird1,bird2,relationship,comparison,value FROM bird_comparison_vw "
+                 + "WHERE (bird1=%s OR bird2=%s) AND comparison=%s ORDER BY value+0 DESC LIMIT %s",
     'INUSE': "SELECT c.name,display_name,COUNT(b.id) AS cnt FROM cv_term c "
              + "LEFT OUTER JOIN bird b ON (b.location_id=c.id) "
              + "WHERE cv_id=getCvId('location','') GROUP BY 1,2 HAVING cnt>0",
@@ -35,6 +43,17 @@ READ = {
                 + "(b.location_id=c.id) LEFT OUTER JOIN nest n ON (n.location_id=c.id) "
                 + "WHERE cv_id=getCvId('location','') GROUP BY 1,2,3,4",
     'NSUMMARY': "SELECT * FROM nest_vw ORDER BY name DESC",
+    'MARKERS': "SELECT marker FROM genotype_marker WHERE marker_set_id=%s ORDER BY position",
+    'PACKED': "SELECT gb.marker_set_id,gb.vocab,gb.calls FROM genotype_blob gb "
+              + "JOIN session ss ON (ss.id=gb.session_id) JOIN bird b ON (b.id=ss.bird_id) "
+              + "WHERE b.name=%s ORDER BY ss.create_date DESC LIMIT 1",
+    'PACKEDALL': "SELECT gb.vocab,gb.calls FROM genotype_blob gb "
+                 + "JOIN session ss ON (ss.id=gb.session_id) JOIN bird b ON (b.id=ss.bird_id) "
+                 + "WHERE b.name=%s",
+    'STATECOUNT': "SELECT state,COUNT(1) AS count FROM state s "
+                  + "JOIN session ss ON (ss.id=s.session_id) JOIN bird b ON (b.id=ss.bird_id) "
+                  + "WHERE b.name=%s AND NOT EXISTS (SELECT 1 FROM genotype_blob gb "
+                  + "WHERE gb.session_id=s.session_id) GROUP BY 1",
 }
 WRITE = {
     'INSERT_BIRD': "INSERT INTO bird (species_id,name,band,nest_id,birth_nest_id,clutch_id,"
@@ -1353,6 +1372,105 @@ def get_record(id_or_name, what="clutch"):
     return result
 
 
+def get_packed_genotype(bird):
+    ''' Get a bird's latest packed genotype (one genotype_blob row)
+        Keyword arguments:
+          bird: bird name
+        Returns:
+          Dictionary of marker: state (None if the bird has no packed genotype)
+    '''
+    try:
+        g.c.execute(READ['PACKED'], (bird,))
+        row = g.c.fetchone()
+        if not row:
+            return None
+        if row['marker_set_id'] not in MARKER_SET:
+            g.c.execute(READ['MARKERS'], (row['marker_set_id'],))
+            MARKER_SET[row['marker_set_id']] = [mrow['marker'] for mrow in g.c.fetchall()]
+    except Exception as err:
+        raise InvalidUsage(sql_error(err), 500) from err
+    vocab = row['vocab'].split(",")
+    return {marker: vocab[code - 1]
+            for marker, code in zip(MARKER_SET[row['marker_set_id']], row['calls'])}
+
+
+def get_state_counts(bird):
+    ''' Count a bird's allelic states over all of its genotyping sessions.
+        Packed sessions are counted from their blobs without decoding markers.
+        Keyword arguments:
+          bird: bird name
+        Returns:
+          List of {state, count} dictionaries, most common first
+    '''
+    counts = Counter()
+    try:
+        g.c.execute(READ['PACKEDALL'], (bird,))
+        for row in g.c.fetchall():
+            vocab = row['vocab'].split(",")
+            for code, count in Counter(row['calls']).items():
+                counts[vocab[code - 1]] += count
+        g.c.execute(READ['STATECOUNT'], (bird,))
+        for row in g.c.fetchall():
+            counts[row['state']] += row['count']
+    except Exception as err:
+        raise InvalidUsage(sql_error(err), 500) from err
+    return [{"state": state, "count": count} for state, count in counts.most_common()]
+
+
+def get_similarity_store(path):
+    ''' Open (or reuse) a similarity matrix store written by compute_similarity.py.
+        The store is reopened if its bird list has changed.
+        Keyword arguments:
+          path: store directory (None or empty if no store is configured)
+        Returns:
+          store dictionary (birds, index, metrics)
+    '''
+    if not path:
+        raise InvalidUsage("No similarity matrix store is configured", 503)
+    sidecar = os.path.join(path, "birds.json")
+    # A rebuild removes the old matrix files right after swapping the sidecar,
+    # so if they vanish between reading the sidecar and opening them, try again
+    for attempt in range(2):
+        try:
+            mtime = os.path.getmtime(sidecar)
+        except OSError as err:
+            raise InvalidUsage(f"Similarity matrix store {path} is not available", 404) from err
+        if SIMILARITY.get("mtime") == mtime:
+            break
+        with open(sidecar, encoding="ascii") as infile:
+            data = json.load(infile)
+        files = data.get("files", {cvt: f"{cvt}.npy" for cvt in data["metrics"]})
+        try:
+            metrics = {cvt: np.load(os.path.join(path, fname), mmap_mode="r")
+                       for cvt, fname in files.items()}
+        except FileNotFoundError as err:
+            if attempt:
+                raise InvalidUsage(f"Similarity matrix store {path} is being rebuilt",
+                                   503) from err
+            continue
+        SIMILARITY["birds"] = data["birds"]
+        SIMILARITY["index"] = {bird: row for row, bird in enumerate(data["birds"])}
+        SIMILARITY["metrics"] = metrics
+        SIMILARITY["mtime"] = mtime
+        break
+    return SIMILARITY
+
+
+def similarity_index(store, row1, row2):
+    ''' Return positions in a condensed similarity matrix
+        Keyword arguments:
+          store: store dictionary
+          row1: bird1 row (or array of rows)
+          row2: bird2 row (or array of rows)
+        Returns:
+          condensed index (or array of them)
+    '''
+    count = len(store["birds"])
+    low = np.minimum(row1, row2)
+    high = np.maximum(row1, row2)
+    return low * (2 * count - low - 1) // 2 + (high - low - 1)
+
+
 def get_user_by_name(uname):
     ''' Given a user name, return the user record
         Keyword arguments:
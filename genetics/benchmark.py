@@ -0,0 +1,509 @@
+''' benchmark.py
+    Benchmark the genetics pipeline on synthetic data. Genotype and phenotype
+    files are generated in the layouts read by process_file.py, and an
+    analyzed dataframe and a similarity matrix store are generated in the
+    layouts read by compute_similarity.py and relatedness_plots.py. Each stage
+    is run in its own process, and its wall time, RSS growth (peak RSS above
+    the process's RSS when the stage starts), and throughput are reported:
+      ingest: load the genotype and phenotype files (process_file.py)
+      similarity: compare every pair of birds (compute_similarity.py)
+      plots: bin phenotype comparisons against the matrix store and plot the
+             heatmaps (relatedness_plots.py --aggregate --matrix)
+    The stages run each program's own entry points against a stand-in
+    database that discards writes, so only the programs' own work is measured.
+    Results can be saved as JSON and compared to a previous run.
+'''
+
+import argparse
+from argparse import Namespace
+from contextlib import redirect_stdout
+from itertools import islice
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+from time import time
+import colorlog
+import numpy as np
+import pandas as pd
+from similarity_store import create_store
+
+# pylint: disable=C0415, W0703
+
+BASES = ["A", "C", "G", "T"]
+COLORS = ["bk", "bu", "gr", "or", "pk", "pu", "rd", "wh", "ye"]
+STAGES = ["ingest", "similarity", "plots"]
+
+
+def terminate_program(msg=None):
+    """ Log an optional error to output and exit
+        Keyword arguments:
+          err: error message
+        Returns:
+           None
+    """
+    if msg:
+        LOGGER.critical(msg)
+    sys.exit(-1 if msg else 0)
+
+
+class NullDatabase:
+    """ Stand-in for a database connection and its cursor. Writes are
+        discarded (sessions are kept so that their IDs can be read back), and
+        the lookups made while loading are answered.
+    """
+    def __init__(self, terms=None):
+        self.terms = terms or []
+        self.sessions = []
+        self.lastrowid = 0
+        self.rows = []
+
+    def commit(self):
+        """ Nothing to commit """
+
+    def rollback(self):
+        """ Nothing to roll back """
+
+    def execute(self, sql, args=None):
+        """ Run one statement """
+        self.rows = []
+        if sql.startswith("INSERT INTO session"):
+            self.lastrowid += 1
+            self.sessions.append({"id": self.lastrowid, "type_id": args[1],
+                                  "bird_id": args[2]})
+        elif sql.startswith(("INSERT", "REPLACE")):
+            self.lastrowid += 1
+        elif "cv_term_vw" in sql:
+            self.rows = self.terms
+        elif "MAX(id)" in sql:
+            self.rows = [{"id": self.lastrowid}]
+        elif sql.startswith("SELECT id,bird_id,type_id FROM session"):
+            self.rows = [row for row in self.sessions if row["id"] > args[0]]
+        elif "getCvTermId" in sql:
+            self.rows = [{"id": 1}]
+        elif "session_vw" in sql:
+            self.lastrowid += 1
+            self.rows = [{"id": self.lastrowid}]
+
+    def executemany(self, sql, rows):
+        """ Run a statement for each row """
+        if sql.startswith("INSERT INTO session"):
+            for row in rows:
+                self.execute(sql, row)
+        else:
+            self.lastrowid += len(rows)
+
+    def fetchone(self):
+        """ Return the first row of the last result """
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        """ Return the last result """
+        return self.rows
+
+
+class ComparisonDatabase(NullDatabase):
+    """ Stand-in for a database of phenotype comparisons between every pair
+        of birds. Pairs are generated as they're fetched, a row of birds at a
+        time, and every twentieth pair is related.
+    """
+    def __init__(self, names, values):
+        super().__init__()
+        self.names = names
+        self.values = values
+        self.pairs = iter(())
+
+    def cursor(self, cursorclass=None):
+        """ Comparisons are streamed from this connection """
+        return self
+
+    def close(self):
+        """ Nothing to close """
+
+    def execute(self, sql, args=None):
+        """ Run one statement """
+        if "MIN(ABS(p.value))" in sql:
+            size = len(self.names)
+            ordered = np.sort(self.values)
+            self.rows = [{"cnt": size * (size - 1) // 2, "xmin": float(np.diff(ordered).min()),
+                          "xmax": float(ordered[-1] - ordered[0])}]
+        elif sql.startswith("SELECT b1.name"):
+            self.pairs = self.generate_pairs()
+        else:
+            super().execute(sql, args)
+
+    def generate_pairs(self):
+        """ Generate phenotype comparison rows
+            Keyword arguments:
+              None
+            Returns:
+              Iterator of rows
+        """
+        size = len(self.names)
+        for idx1 in range(size - 1):
+            diff = np.abs(self.values[idx1] - self.values[idx1 + 1:]).tolist()
+            related = ((idx1 + np.arange(idx1 + 1, size)) % 20 == 0).tolist()
+            for name, value, rel in zip(self.names[idx1 + 1:], diff, related):
+                yield {"bird1": self.names[idx1], "bird2": name, "value": value,
+                       "related": rel}
+
+    def fetchmany(self, size):
+        """ Return the next rows of a streamed result """
+        return list(islice(self.pairs, size))
+
+
+def generate_calls(rng, birds, markers, missing):
+    """ Generate biallelic calls
+        Keyword arguments:
+          rng: random number generator
+          birds: number of birds
+          markers: number of markers
+          missing: fraction of missing calls
+        Returns:
+          birds x markers array of calls
+    """
+    alleles = np.array([rng.choice(BASES, 2, replace=False) for _ in range(markers)])
+    freq = rng.uniform(0.05, 0.95, markers)
+    dosage = rng.binomial(2, freq, (birds, markers))
+    first = np.where(dosage == 2, alleles[:, 1], alleles[:, 0])
+    second = np.where(dosage >= 1, alleles[:, 1], alleles[:, 0])
+    calls = np.char.add(np.char.add(first, "/"), second).astype(object)
+    calls[rng.random((birds, markers)) < missing] = "./."
+    return calls
+
+
+def generate_files(directory):
+    """ Generate a genotype file, a phenotype file, an analyzed dataframe,
+        and a similarity matrix store
+        Keyword arguments:
+          directory: output directory
+        Returns:
+          Dictionary of file names
+    """
+    rng = np.random.default_rng(ARG.SEED)
+    calls = generate_calls(rng, ARG.BIRDS, ARG.MARKERS, ARG.MISSING)
+    markers = [str(num) for num in range(2, ARG.MARKERS + 2)]
+    bands = []
+    while len(bands) < ARG.BIRDS:
+        band = f"{rng.choice(COLORS)}{rng.integers(1, 100)}{rng.choice(COLORS)}" \
+               + f"{rng.integers(1, 100)}"
+        if band not in bands:
+            bands.append(band)
+    days = rng.integers(0, 3650, ARG.BIRDS)
+    birthdays = pd.to_datetime("2012-01-01") + pd.to_timedelta(days, unit="D")
+    sex = rng.choice(["M", "F"], ARG.BIRDS)
+    tempo = np.round(rng.normal(10.0, 1.5, ARG.BIRDS), 6)
+    # Eight columns before SEX (process_file.py inserts IND_NAME and the
+    # phenotype after the eighth column)
+    lead = pd.DataFrame({"FAM_ID": rng.integers(1, max(ARG.BIRDS // 4, 2), ARG.BIRDS),
+                         "IND_ID": bands,
+                         "FATHER_ID": 0, "MOTHER_ID": 0,
+                         "IND_BD": birthdays.strftime("%m/%d/%Y"),
+                         "BATCH": 1, "PLATE": 1, "WELL": "A1",
+                         "SEX": sex})
+    files = {"genotype": os.path.join(directory, "genotype.tsv"),
+             "phenotype": os.path.join(directory, "phenotype.tsv"),
+             "analyzed": os.path.join(directory, "analyzed.pkl"),
+             "matrix": os.path.join(directory, "matrix"),
+             "scores": os.path.join(directory, "scores.pkl")}
+    marker_frame = pd.DataFrame(calls, columns=markers)
+    pd.concat([lead, marker_frame], axis=1).to_csv(files["genotype"], sep="\t", index=False)
+    # Phenotyped birds are a subset, identified by row number
+    phenotyped = np.sort(rng.choice(ARG.BIRDS, max(1, int(ARG.BIRDS * ARG.PHENOTYPED)),
+                                    replace=False))
+    phen = pd.DataFrame({"IND_ID": np.arange(len(phenotyped)), "SEX": sex[phenotyped],
+                         ARG.PHENOTYPE.upper(): tempo[phenotyped]})
+    pd.concat([phen, marker_frame.iloc[phenotyped].reset_index(drop=True)],
+              axis=1).to_csv(files["phenotype"], sep="\t", index=False)
+    analyzed = lead.copy()
+    analyzed["IND_ID"] = np.arange(1, ARG.BIRDS + 1)
+    analyzed.insert(8, "IND_NAME", [f"{day.strftime('%Y%m%d')}_{band}"
+                                    for day, band in zip(birthdays, bands)])
+    analyzed[ARG.PHENOTYPE.upper()] = tempo
+    pd.concat([analyzed, marker_frame], axis=1).to_pickle(files["analyzed"])
+    # Similarities are random, so the store can be built without comparing birds
+    store = create_store(files["matrix"], analyzed["IND_NAME"].tolist(), ["allele_match_seq"])
+    metric = store["metrics"]["allele_match_seq"]
+    for start in range(0, len(metric), 1000000):
+        stop = min(start + 1000000, len(metric))
+        metric[start:stop] = np.clip(rng.normal(50, 5, stop - start), 0, 100)
+    metric.flush()
+    # Phenotype scores for the plots stage's stand-in comparisons
+    pd.DataFrame({"IND_NAME": analyzed["IND_NAME"], ARG.PHENOTYPE.upper(): tempo}) \
+      .to_pickle(files["scores"])
+    return files
+
+
+def stage_ingest(files):
+    """ Load the genotype and phenotype files with process_file.py
+        Keyword arguments:
+          files: dictionary of file names
+        Returns:
+          Rows (allelic states) processed
+    """
+    import process_file
+    process_file.ARG = Namespace(FILE=[files["genotype"]], PHENFILE=files["phenotype"],
+                                 PHENOTYPE=[ARG.PHENOTYPE], CHUNK=0, WORKERS=1, CACHE=None,
+                                 SKIP=False, WRITE=True, BATCH=ARG.BATCH, PACKED=ARG.PACKED,
+                                 INFILE=False, DEFER=False)
+    process_file.LOGGER = LOGGER
+    terms = [{"id": pos, "cv": "genotype", "cv_term": cvt}
+             for pos, cvt in enumerate(("allelic_state",) + process_file.BIRD_QC, start=1)]
+    terms.append({"id": len(terms) + 1, "cv": "phenotype", "cv_term": ARG.PHENOTYPE.lower()})
+    process_file.CONN['bird'] = process_file.CURSOR['bird'] = NullDatabase(terms)
+    # Every generated bird is in the database
+    process_file.COLOR.update({color: color for color in COLORS})
+    dfr = pd.read_csv(files["genotype"], delimiter="\t", usecols=["IND_ID", "IND_BD", "SEX"])
+    for bid, (band, birthday, sex) in enumerate(dfr.itertuples(index=False), start=1):
+        month, day, year = birthday.split("/")
+        process_file.BAND[band] = True
+        process_file.BIRD[f"{year}{month}{day}_{band}"] = bid
+        process_file.BIRDID[bid] = {"name": f"{year}{month}{day}_{band}", "sex": sex,
+                                    "band": band}
+    os.chdir(os.path.dirname(files["genotype"]))
+    process_file.process_data_frame()
+    return process_file.COUNT["state"]
+
+
+def stage_similarity(files):
+    """ Compare every pair of birds with compute_similarity.py
+        Keyword arguments:
+          files: dictionary of file names
+        Returns:
+          Rows (bird pairs) compared
+    """
+    import similarity_engine
+    import compute_similarity
+    if not ARG.PACK:
+        similarity_engine.pack_genotypes = lambda geno: None
+    directory = os.path.dirname(files["analyzed"])
+    compute_similarity.ARG = Namespace(FILE=files["analyzed"], CACHE=None, MARKERS=None,
+                                       PHENOTYPE=ARG.PHENOTYPE, PHENOTYPES=None, SINGLE=None,
+                                       START=None, FULL=False, INCREMENTAL=False,
+                                       CHECKPOINT=None, TOPK=None, BLOCK=ARG.BLOCK,
+                                       TILE=ARG.TILE, WORKERS=1, BATCH=5000,
+                                       OUTPUT=os.path.join(directory, "analysis_results.tsv"),
+                                       MATRIX=None, PRECISION="float32", SHARD=None,
+                                       WRITE=True)
+    compute_similarity.LOGGER = LOGGER
+    compute_similarity.CONN['bird'] = compute_similarity.CURSOR['bird'] = NullDatabase()
+    compute_similarity.WILL_LOAD.extend(ARG.METRICS + [ARG.PHENOTYPE])
+    compute_similarity.COUNT[ARG.PHENOTYPE] = 0
+    compute_similarity.process_data_frame()
+    return compute_similarity.COUNT["comparisons"]
+
+
+def stage_plots(files):
+    """ Bin the phenotype comparisons for every pair of birds against the
+        similarity matrix store and plot them (relatedness_plots.py
+        --aggregate --matrix)
+        Keyword arguments:
+          files: dictionary of file names
+        Returns:
+          Rows (phenotype comparisons) binned
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import relatedness_plots
+    relatedness_plots.ARG = Namespace(PHENOTYPE=ARG.PHENOTYPE, GENOTYPE="allele_match_seq",
+                                      MATRIX=files["matrix"], AGGREGATE=True, BINS=100,
+                                      SAMPLE=10000)
+    relatedness_plots.LOGGER = LOGGER
+    scores = pd.read_pickle(files["scores"])
+    relatedness_plots.CONN['bird'] = relatedness_plots.CURSOR['bird'] \
+        = ComparisonDatabase(scores["IND_NAME"].tolist(),
+                             scores[ARG.PHENOTYPE.upper()].to_numpy())
+    os.chdir(os.path.dirname(files["analyzed"]))
+    agg = relatedness_plots.aggregate_matrix(relatedness_plots.open_matrix())
+    relatedness_plots.plot_aggregate(agg, {"related": ARG.BIRDS // 20,
+                                           "unrelated": ARG.BIRDS - ARG.BIRDS // 20})
+    return ARG.BIRDS * (ARG.BIRDS - 1) // 2
+
+
+def process_memory(field):
+    """ Return a memory statistic for this process (Linux only)
+        Keyword arguments:
+          field: /proc/self/status field (VmRSS or VmHWM)
+        Returns:
+          MB (or None if unavailable)
+    """
+    try:
+        with open("/proc/self/status", encoding="ascii") as infile:
+            for line in infile:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_memory():
+    """ Reset this process's peak RSS to its current RSS (Linux only)
+        Keyword arguments:
+          None
+        Returns:
+          True if the peak was reset
+    """
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="ascii") as outfile:
+            outfile.write("5")
+    except OSError:
+        return False
+    return process_memory("VmHWM") is not None
+
+
+def run_stage(stage, files, queue):
+    """ Run one stage and report its statistics (called in a child process).
+        A forked child starts out holding its parent's pages, so memory is
+        reported as the growth of the peak RSS over the RSS at startup.
+        Keyword arguments:
+          stage: stage name
+          files: dictionary of file names
+          queue: queue for statistics
+        Returns:
+          None
+    """
+    try:
+        if reset_peak_memory():
+            base = process_memory("VmRSS")
+        else:
+            base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        start = time()
+        # The programs' own summaries would interleave with the report
+        with open(os.devnull, "w", encoding="ascii") as devnull, redirect_stdout(devnull):
+            rows = globals()[f"stage_{stage}"](files)
+        elapsed = time() - start
+        peak = process_memory("VmHWM") or \
+               resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        queue.put({"stage": stage, "seconds": elapsed, "rows": rows,
+                   "rows_per_sec": rows / elapsed if elapsed else 0.0,
+                   "rss_growth_mb": peak - base})
+    except (Exception, SystemExit) as err:
+        queue.put({"stage": stage, "error": repr(err)})
+
+
+def compare_results(results):
+    """ Compare results to a baseline file
+        Keyword arguments:
+          results: list of stage results
+        Returns:
+          List of stages that regressed
+    """
+    with open(ARG.BASELINE, encoding="ascii") as infile:
+        baseline = {row["stage"]: row for row in json.load(infile)["stages"]}
+    regressed = []
+    for row in results:
+        old = baseline.get(row["stage"])
+        if not old or "error" in row or "error" in old or not old["rows_per_sec"]:
+            continue
+        ratio = row["rows_per_sec"] / old["rows_per_sec"]
+        flag = ""
+        if ratio < 1.0 - ARG.TOLERANCE:
+            flag = " REGRESSION"
+            regressed.append(row["stage"])
+        # Baselines saved before RSS growth was measured have no comparable value
+        memory = f"{row['rss_growth_mb'] - old['rss_growth_mb']:+.1f} MB RSS growth" \
+                 if "rss_growth_mb" in old else "no RSS baseline"
+        print(f"{row['stage']:<11} {ratio:6.2f}x throughput, {memory}{flag}")
+    return regressed
+
+
+def run_benchmarks():
+    """ Generate data, run each stage, and report the results
+        Keyword arguments:
+          None
+        Returns:
+          None
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        directory = ARG.DIRECTORY or tmpdir
+        os.makedirs(directory, exist_ok=True)
+        LOGGER.info("Generating %d birds x %d markers in %s", ARG.BIRDS, ARG.MARKERS, directory)
+        files = generate_files(directory)
+        ctx = multiprocessing.get_context("fork")
+        results = []
+        for stage in ARG.STAGES:
+            LOGGER.info("Running %s", stage)
+            queue = ctx.Queue()
+            proc = ctx.Process(target=run_stage, args=(stage, files, queue))
+            proc.start()
+            results.append(queue.get())
+            proc.join()
+    print(f"{'Stage':<11} {'Seconds':>9} {'Rows':>12} {'Rows/sec':>12} {'RSS growth (MB)':>16}")
+    for row in results:
+        if "error" in row:
+            print(f"{row['stage']:<11} failed: {row['error']}")
+            continue
+        print(f"{row['stage']:<11} {row['seconds']:9.2f} {row['rows']:12d} " \
+              + f"{row['rows_per_sec']:12.0f} {row['rss_growth_mb']:16.1f}")
+    if ARG.OUTPUT:
+        with open(ARG.OUTPUT, "w", encoding="ascii") as outfile:
+            json.dump({"parameters": {"birds": ARG.BIRDS, "markers": ARG.MARKERS,
+                                      "missing": ARG.MISSING, "seed": ARG.SEED},
+                       "stages": results}, outfile, indent=2)
+    if ARG.BASELINE:
+        regressed = compare_results(results)
+        if regressed:
+            terminate_program(f"Throughput regressed for {', '.join(regressed)}")
+
+
+# *****************************************************************************
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description="Benchmark the genetics pipeline")
+    PARSER.add_argument('--birds', dest='BIRDS', action='store', type=int,
+                        default=500, help='Number of birds [500]')
+    PARSER.add_argument('--markers', dest='MARKERS', action='store', type=int,
+                        default=2000, help='Number of markers [2000]')
+    PARSER.add_argument('--missing', dest='MISSING', action='store', type=float,
+                        default=0.05, help='Fraction of missing calls [0.05]')
+    PARSER.add_argument('--phenotyped', dest='PHENOTYPED', action='store', type=float,
+                        default=0.2, help='Fraction of birds in the phenotype file [0.2]')
+    PARSER.add_argument('--phenotype', dest='PHENOTYPE', action='store',
+                        default="median_tempo", help='Phenotype [median_tempo]')
+    PARSER.add_argument('--seed', dest='SEED', action='store', type=int,
+                        default=1, help='Random seed [1]')
+    PARSER.add_argument('--stages', dest='STAGES', action='store', nargs='+',
+                        default=STAGES, choices=STAGES, help='Stages to run [all]')
+    PARSER.add_argument('--metrics', dest='METRICS', action='store', nargs='+',
+                        default=["allele_match_all", "allele_match_seq"],
+                        help='Similarity metrics [allele_match_all allele_match_seq]')
+    PARSER.add_argument('--block', dest='BLOCK', action='store', type=int,
+                        default=64, help='Primary birds to compare per block [64]')
+    PARSER.add_argument('--tile', dest='TILE', action='store', type=int,
+                        default=1024, help='Secondary birds to compare per tile [1024]')
+    PARSER.add_argument('--nopack', dest='PACK', action='store_false',
+                        default=True, help='Compare without bit-packing')
+    PARSER.add_argument('--batch', dest='BATCH', action='store', type=int,
+                        default=50000, help='Allelic states per ingest batch [50000]')
+    PARSER.add_argument('--packed', dest='PACKED', action='store_true',
+                        default=False, help='Ingest genotypes as packed genotype_blob rows')
+    PARSER.add_argument('--directory', dest='DIRECTORY', action='store',
+                        help='Keep generated files in this directory')
+    PARSER.add_argument('--output', dest='OUTPUT', action='store',
+                        help='Save results to a JSON file')
+    PARSER.add_argument('--baseline', dest='BASELINE', action='store',
+                        help='Compare results to a JSON file from a previous run')
+    PARSER.add_argument('--tolerance', dest='TOLERANCE', action='store', type=float,
+                        default=0.1, help='Allowed throughput drop vs. the baseline [0.1]')
+    PARSER.add_argument('--verbose', dest='VERBOSE', action='store_true',
+                        default=False, help='Flag, Chatty')
+    PARSER.add_argument('--debug', dest='DEBUG', action='store_true',
+                        default=False, help='Flag, Very chatty')
+    ARG = PARSER.parse_args()
+    LOGGER = colorlog.getLogger()
+    ATTR = colorlog.colorlog.logging if "colorlog" in dir(colorlog) else colorlog
+    if ARG.DEBUG:
+        LOGGER.setLevel(ATTR.DEBUG)
+    elif ARG.VERBOSE:
+        LOGGER.setLevel(ATTR.INFO)
+    else:
+        LOGGER.setLevel(ATTR.WARNING)
+    HANDLER = colorlog.StreamHandler()
+    HANDLER.setFormatter(colorlog.ColoredFormatter())
+    LOGGER.addHandler(HANDLER)
+
+    run_benchmarks()
+    sys.exit(0)
@@ -3,14 +3,26 @@
 '''
 
 import argparse
+from collections import deque
+import gzip
+import heapq
+import io
+from itertools import repeat
 import json
+import multiprocessing
+import os
 import signal
 import sys
 import colorlog
 import inquirer
 import MySQLdb
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
+from frame_cache import frame_columns, read_frame
+from similarity_engine import METRICS, attach_genotypes, encode_genotypes, score_tile, \
+                              share_genotypes
+from similarity_store import SIDECAR, create_store, metric_dtype, open_store, put_block
 
 # pylint: disable=W0703, W0613
 
@@ -18,22 +30,40 @@ from tqdm import tqdm
 BIRD_COL = "IND_ID" # Column name for bird
 SEX_COL = "SEX" # Column name for bird sex
 FRAME = {}
-PROCESSED = {}
+PROCESSED = {"keys": np.empty(0, dtype=np.int64)} # Sorted keys of compared session pairs
 RELATIONSHIP = {}
 SESSION = {}
+TERM = {} # bird_comparison CV term IDs
 WILL_LOAD = []
+BATCH = [] # Buffered bird_comparison rows
+CHECKPOINT = {"completed": -1} # Progress as of the last commit
+NEIGHBOR = {} # Bounded heaps of (value, bird2 row, comparison) keyed by CV term and bird row
+OUTPUT = {"rows": [], "mark": 0, "count": 0, "file": None, "writer": None} # Analysis results
+RESULT_COLUMNS = ["Bird1", "Bird2", "Phenotype1", "Phenotype2", "All markers",
+                  "Sequenced markers", "Relationship"]
 COUNT = {"skipped": 0, "potential": 0,"comparisons": 0, "removed": 0, "present": 0,
-         "allele_match_all": 0, "allele_match_seq": 0}
+         "merged": 0}
+COUNT.update({cvt: 0 for cvt in METRICS})
 # Database
 CONN = {}
 CURSOR = {}
 READ = {"SESSION": "SELECT id FROM session_vw WHERE cv='Genotype' AND "
-                   + "type='Allelic state' AND bird=%s ORDER BY create_date DESC LIMIT 1"
+                   + "type='Allelic state' AND bird=%s ORDER BY create_date DESC LIMIT 1",
+        "TERM": "SELECT getCvTermId('bird_comparison',%s,'') AS id",
+        "PROCESSED": "SELECT bird1_session_id,bird2_session_id FROM bird_comparison",
+        "SESSIONS": "SELECT bird,id FROM session_vw WHERE cv='Genotype' AND "
+                    + "type='Allelic state' ORDER BY create_date,id",
+        "SCORES": "SELECT ss.bird_id,b.name AS bird,cvt.name AS term,s.value FROM score s "
+                  + "JOIN session ss ON (s.session_id=ss.id) JOIN bird b ON (ss.bird_id=b.id) "
+                  + "JOIN cv_term cvt ON (s.type_id=cvt.id) JOIN cv ON (cvt.cv_id=cv.id) "
+                  + "WHERE cv.name='phenotype' ORDER BY ss.create_date,s.id"
        }
 WRITE = {"COMPARE": "INSERT IGNORE INTO bird_comparison (bird1_id,bird1_session_id,"
                     + "comparison_id,bird2_id,bird2_session_id,value) "
-                    + "VALUES (%s,%s,getCvTermId('bird_comparison','%s',''),"
-                    + "%s,%s,%s)"
+                    + "VALUES (%s,%s,%s,%s,%s,%s)",
+         "REFRESH": "INSERT INTO bird_comparison (bird1_id,bird1_session_id,"
+                    + "comparison_id,bird2_id,bird2_session_id,value) "
+                    + "VALUES (%s,%s,%s,%s,%s,%s) ON DUPLICATE KEY UPDATE value=VALUES(value)"
         }
 
 
@@ -84,14 +114,103 @@ def db_connect(dbd):
     return conn, cursor
 
 
-def make_comparison_key(arr):
-    """ Join elements in a list to create a key.
+def make_comparison_key(session1, session2):
+    """ Pack a pair of session IDs into an int64 key. A session belongs to
+        a single bird, so the bird IDs aren't needed.
+        Keyword arguments:
+          session1: session ID for bird1 (scalar or array)
+          session2: session ID for bird2 (scalar or array)
+        Returns:
+          Key (scalar or array)
+    """
+    return (np.int64(session1) << 32) | np.int64(session2)
+
+
+def is_processed(session1, session2):
+    """ Determine which comparisons are already in the database
+        Keyword arguments:
+          session1: array of session IDs for bird1
+          session2: array of session IDs for bird2
+        Returns:
+          boolean array
+    """
+    keys = PROCESSED["keys"]
+    if not keys.size:
+        return np.zeros(len(session1), dtype=bool)
+    key = make_comparison_key(session1, session2)
+    pos = np.minimum(np.searchsorted(keys, key), keys.size - 1)
+    return keys[pos] == key
+
+
+def load_processed():
+    """ Load previously processed comparisons. The session ID pairs are
+        streamed into a sorted key array. For incremental runs, SESSION is
+        also prefetched so that old sessions can be identified.
         Keyword arguments:
-          arr: list of birn names
+          None
         Returns:
           None
     """
-    return "_".join([str(elem) for elem in arr])
+    if ARG.INCREMENTAL:
+        try:
+            CURSOR['bird'].execute(READ["SESSIONS"])
+            rows = CURSOR['bird'].fetchall()
+        except Exception as err:
+            sql_error(err)
+        for row in rows:
+            SESSION[row["bird"]] = row["id"]
+    chunks = []
+    try:
+        cursor = CONN['bird'].cursor(MySQLdb.cursors.SSCursor)
+        cursor.execute(READ["PROCESSED"])
+        while True:
+            rows = cursor.fetchmany(100000)
+            if not rows:
+                break
+            pairs = np.array(rows, dtype=np.int64)
+            chunks.append(make_comparison_key(pairs[:, 0], pairs[:, 1]))
+        cursor.close()
+    except Exception as err:
+        sql_error(err)
+    if chunks:
+        PROCESSED["keys"] = np.unique(np.concatenate(chunks))
+    LOGGER.info("Prior comparisons found: %d", PROCESSED["keys"].size)
+
+
+def compared_birds():
+    """ Find the birds (for --incremental) whose sessions have all been compared
+        to each other. A session with some prior comparisons isn't enough: a
+        run that stopped partway leaves new sessions compared to only some
+        birds. Starting from every session in the key array, the sessions with
+        the fewest comparisons to the other candidates are dropped until the
+        rest are all compared to each other. Pairs outside this set are
+        checked against the key array.
+        Keyword arguments:
+          None
+        Returns:
+          boolean array (indexed by bird row)
+    """
+    sessions = np.array([SESSION.get(full, 0) if full else 0 for full in FRAME['FULL']],
+                        dtype=np.int64)
+    first = PROCESSED["keys"] >> 32
+    second = PROCESSED["keys"] & 0xFFFFFFFF
+    candidates = np.unique(sessions[(sessions > 0)
+                                    & (np.isin(sessions, first) | np.isin(sessions, second))])
+    # Each pair counts once, in whichever order it was stored
+    inside = np.isin(first, candidates) & np.isin(second, candidates)
+    pairs = np.unique(make_comparison_key(np.minimum(first[inside], second[inside]),
+                                          np.maximum(first[inside], second[inside])))
+    pos1 = np.searchsorted(candidates, pairs >> 32)
+    pos2 = np.searchsorted(candidates, pairs & 0xFFFFFFFF)
+    alive = np.ones(candidates.size, dtype=bool)
+    while alive.any():
+        live = alive[pos1] & alive[pos2]
+        degree = np.bincount(pos1[live], minlength=candidates.size) \
+                 + np.bincount(pos2[live], minlength=candidates.size)
+        if (degree[alive] == np.count_nonzero(alive) - 1).all():
+            break
+        alive &= degree != degree[alive].min()
+    return np.isin(sessions, candidates[alive]) & (sessions > 0)
 
 
 def initialize_program():
@@ -104,6 +223,16 @@ def initialize_program():
     with open("../birdsong_config.json", encoding="ascii") as jfile_obj:
         data = json.load(jfile_obj)
     (CONN['bird'], CURSOR['bird']) = db_connect(data['database']['birdsong'][ARG.MANIFOLD])
+    if ARG.MERGE or ARG.PHENOTYPES:
+        return
+    if ARG.SHARD:
+        try:
+            index, count = [int(num) for num in ARG.SHARD.split("/")]
+        except ValueError:
+            terminate_program(f"Invalid shard {ARG.SHARD} (should be i/N)")
+        if not 0 <= index < count:
+            terminate_program(f"Invalid shard {ARG.SHARD} (i must be 0 to N-1)")
+        FRAME['SHARD'] = (index, count)
     # Get relationships
     try:
         CURSOR['bird'].execute("SELECT subject,type,object FROM bird_relationship_vw")
@@ -115,53 +244,32 @@ def initialize_program():
             RELATIONSHIP[row["subject"]] = {}
         RELATIONSHIP[row["subject"]][row["object"]] = row["type"]
     # Get previously processed comparisons
-    try:
-        CURSOR['bird'].execute("SELECT * FROM bird_comparison")
-        rows = CURSOR['bird'].fetchall()
-    except Exception as err:
-        sql_error(err)
-    for row in rows:
-        key = make_comparison_key([row["bird1_id"], row["bird1_session_id"],
-                                   row["bird2_id"], row["bird2_session_id"]])
-        PROCESSED[key] = True
-    LOGGER.info("Prior comparisons found: %d", len(PROCESSED))
-    choices = ["allele_match_all", "allele_match_seq", ARG.PHENOTYPE]
-    quest = [inquirer.Checkbox('checklist',
-                               message='Select comparisons to upload',
-                               choices=choices, default=choices)]
-    for cvt in inquirer.prompt(quest)['checklist']:
-        WILL_LOAD.append(cvt)
+    load_processed()
+    if ARG.TOPK and PROCESSED["keys"].size:
+        # Neighbors would only be chosen from the pairs compared in this run
+        terminate_program(f"--topk can't be used with comparisons already loaded "
+                          + f"({PROCESSED['keys'].size} found)")
+    choices = METRICS + [ARG.PHENOTYPE]
+    if ARG.COMPARISONS:
+        for cvt in ARG.COMPARISONS:
+            if cvt not in choices:
+                terminate_program(f"Unknown comparison {cvt} (choose from {', '.join(choices)})")
+        WILL_LOAD.extend(cvt for cvt in choices if cvt in ARG.COMPARISONS)
+    else:
+        quest = [inquirer.Checkbox('checklist',
+                                   message='Select comparisons to upload',
+                                   choices=choices,
+                                   default=["allele_match_all", "allele_match_seq",
+                                            ARG.PHENOTYPE])]
+        for cvt in inquirer.prompt(quest)['checklist']:
+            WILL_LOAD.append(cvt)
     COUNT[ARG.PHENOTYPE] = 0
-
-
-def compute_percent_match(row1, row2):
-    """ Compute match percentages for all and sequenced alleles.
-        Keyword arguments:
-          row1: bird1 row
-          row2: bird2 row
-        Returns:
-           % match for all alleles, % match for sequenced alleles
-    """
-    score = seqscore = 0.0
-    seqcount = 0
-    name = FRAME['NAME']
-    first_marker = FRAME['FIRST_MARKER']
-    markers = range(first_marker, row1.shape[1])
-    for col in markers:
-        val1 = row1[name[col]].iloc[0]
-        val2 = row2[name[col]].iloc[0]
-        if (val1 == val2) and (val1 != "./."):
-            score += 1
-        else:
-            v1l = val1.split("/")
-            v2l = val2.split("/")
-            if (v1l[0] != "." and v1l[0] in v2l) or (v1l[1] != "." and v1l[1] in v2l):
-                score += 0.5
-        if val1 != "./." and val2 != "./.":
-            seqcount += 1
-            if val1 == val2:
-                seqscore += 1
-    return score / len(markers) * 100.0, seqscore / seqcount * 100.0
+    if ARG.TOPK:
+        for cvt in WILL_LOAD:
+            if cvt.startswith("allele"):
+                NEIGHBOR[cvt] = {}
+        if not NEIGHBOR:
+            terminate_program("--topk requires allele_match_all or allele_match_seq")
 
 
 def get_session_id(bird):
@@ -184,65 +292,655 @@ def get_session_id(bird):
     return SESSION[bird]
 
 
-def compare_birds(row1, row2, id1, session1, full1, phen1, results):
-    """ Compare two birds
+def get_session_ids(rows):
+    """ Return session IDs for bird rows, looking up any that aren't known yet
         Keyword arguments:
-          row1: bird1 row
-          row2: bird2 row
-          id1: bird1 ID
-          session1: session ID for bird1
-          full1:
-          phen1: phenotype measurenent for bird1
-          results: results list
+          rows: array of bird row indices
         Returns:
-           None
+          int64 array of session IDs
     """
-    full2 = row2["IND_NAME"].iloc[0]
-    id2 = row2[BIRD_COL].iloc[0]
-    session2 = get_session_id(full2)
-    phen2 = row2[ARG.PHENOTYPE.upper()].iloc[0] or "-"
-    if full2 < full1:
-        id1, id2 = id2, id1
-        session1, session2 = session2, session1
-        full1, full2 = full2, full1
-        phen1, phen2 = phen2, phen1
-    COUNT["potential"] += 1
-    if make_comparison_key([id1, session1, id2, session2]) in PROCESSED:
-        COUNT["present"] += 1
+    sessions = FRAME['SESSION']
+    for row in np.unique(rows[sessions[rows] == 0]).tolist():
+        sessions[row] = get_session_id(FRAME['FULL'][row])
+    return sessions[rows]
+
+
+def skip_primary(full1):
+    """ Determine if a bird should be skipped as a primary (bird1) bird
+        Keyword arguments:
+          full1: bird name
+        Returns:
+          True or False
+    """
+    return bool((ARG.SINGLE and (ARG.SINGLE != full1)) or (ARG.START and (ARG.START > full1)))
+
+
+def plan_blocks():
+    """ Split the primary birds into blocks, and the birds they will be compared
+        to into tiles. This mirrors the order used by process_data_frame.
+        Keyword arguments:
+          None
+        Returns:
+          List of (bird1 row indices, list of tiles)
+    """
+    primary = np.array([idx for idx, full in enumerate(FRAME['FULL'])
+                        if not skip_primary(full)], dtype=int)
+    # Birds completed by a previous run (see load_checkpoint), assigned to
+    # other shards, or without a name (which the main loop removes) aren't planned
+    todo = [idx for idx in primary.tolist()
+            if idx > CHECKPOINT["completed"] and FRAME['MINE'][idx] and FRAME['FULL'][idx]]
+    pending = np.ones(len(FRAME['FULL']), dtype=bool)
+    size = 1 if ARG.SINGLE else ARG.BLOCK
+    plan = []
+    for pos in range(0, len(todo), size):
+        rows1 = tuple(todo[pos:pos+size])
+        pending[primary[primary <= rows1[0]]] = False
+        cols = np.flatnonzero(pending)
+        if ARG.INCREMENTAL and FRAME['OLD'][list(rows1)].all():
+            cols = cols[~FRAME['OLD'][cols]]
+        # Split secondary birds into runs of contiguous rows, then into tiles
+        runs = np.split(cols, np.flatnonzero(np.diff(cols) != 1) + 1) if len(cols) else []
+        tiles = []
+        for run in runs:
+            for start in range(run[0], run[-1] + 1, ARG.TILE):
+                tiles.append((rows1, int(start), int(min(start + ARG.TILE, run[-1] + 1))))
+        plan.append((rows1, tiles))
+    return plan
+
+
+def tile_results(tiles):
+    """ Score tiles in order, either in this process or in a pool of workers
+        attached to a shared-memory copy of the call matrix.
+        Keyword arguments:
+          tiles: iterator of tiles
+        Returns:
+          Iterator of metric dictionaries
+    """
+    if ARG.WORKERS <= 1:
+        for tile in tiles:
+            yield score_tile(tile, FRAME['GENOTYPE'])
         return
-    COUNT["comparisons"] += 1
-    comp = {}
-    if "allele_match_all" in WILL_LOAD or "allele_match_seq" in WILL_LOAD:
-        comp["allele_match_all"], comp["allele_match_seq"] = compute_percent_match(row1, row2)
-        relate = ""
-        if full1 in RELATIONSHIP and full2 in RELATIONSHIP[full1]:
-            relate = f"\t{RELATIONSHIP[full1][full2]}"
-        results.append(f"{full1}\t{full2}\t{phen1}\t{phen2}\t{comp['allele_match_all']:.2f}%\t" \
-                       + f"{comp['allele_match_seq']:.2f}%{relate}")
-        # Save genotypes
-        for cvt in (WILL_LOAD):
-            if not cvt.startswith("allele"):
-                continue
-            try:
-                CURSOR['bird'].execute(WRITE["COMPARE"] % (id1,session1,cvt,
-                                                           id2,session2,comp[cvt]))
-            except Exception as err:
-                LOGGER.error("Could not insert %s for %s<->%s", cvt, id1, id2)
-                sql_error(err)
-            COUNT[cvt] += 1
-    if ARG.PHENOTYPE in WILL_LOAD:
-        # Save phenotype
-        if phen1 and phen2 and phen1 not in (".", "-") and phen2 not in (".", "-"):
+    shm, shared = share_genotypes(FRAME['GENOTYPE'])
+    pool = multiprocessing.Pool(ARG.WORKERS, initializer=attach_genotypes, initargs=(shared,))
+    try:
+        window = deque()
+        for tile in tiles:
+            window.append(pool.apply_async(score_tile, (tile,)))
+            if len(window) >= 2 * ARG.WORKERS:
+                yield window.popleft().get()
+        while window:
+            yield window.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        shm.close()
+        shm.unlink()
+
+
+def block_matches(plan):
+    """ Compute comparison metrics for each planned block
+        Keyword arguments:
+          plan: block plan from plan_blocks
+        Returns:
+          Iterator of (bird1 row indices, bird2 row indices, metric dictionary)
+    """
+    results = tile_results(tile for _, tiles in plan for tile in tiles)
+    for rows1, tiles in plan:
+        cols = [np.arange(start, stop) for _, start, stop in tiles]
+        parts = [next(results) for _ in tiles]
+        if not parts:
+            yield rows1, np.empty(0, dtype=int), \
+                  {cvt: np.empty((len(rows1), 0)) for cvt in FRAME['GENOTYPE']['metrics']}
+            continue
+        yield rows1, np.concatenate(cols), \
+              {cvt: np.hstack([part[cvt] for part in parts])
+               for cvt in FRAME['GENOTYPE']['metrics']}
+
+
+def get_block_match(idx1, cols):
+    """ Return comparison metrics for one bird against a set of pending birds.
+        Metrics are computed for a block of primary birds at a time.
+        Keyword arguments:
+          idx1: bird1 row index
+          cols: array of bird2 row indices
+        Returns:
+          Dictionary (keyed by metric) of arrays aligned with cols
+    """
+    block = FRAME['BLOCK']
+    if idx1 not in block.get('rows', {}):
+        rows1, block['cols'], block['metrics'] = next(FRAME['MATCHES'])
+        block['rows'] = {row: pos for pos, row in enumerate(rows1)}
+        if 'STORE' in FRAME:
+            # A reused store may hold metrics that this run doesn't compute
+            metrics = [cvt for cvt in FRAME['STORE']['metrics'] if cvt in block['metrics']]
+            for row, pos in block['rows'].items():
+                for cvt in metrics:
+                    put_block(FRAME['STORE'], cvt, row, block['cols'], block['metrics'][cvt][pos])
+    pos = block['rows'][idx1]
+    # Block columns are in row order
+    where = np.searchsorted(block['cols'], cols)
+    return {cvt: values[pos][where] for cvt, values in block['metrics'].items()}
+
+
+def open_matrix_store():
+    """ Open the similarity matrix store, creating it if it doesn't exist or
+        was built for a different set of birds
+        Keyword arguments:
+          None
+        Returns:
+          None
+    """
+    metrics = [cvt for cvt in WILL_LOAD if cvt in METRICS]
+    if os.path.exists(os.path.join(ARG.MATRIX, SIDECAR)):
+        store = open_store(ARG.MATRIX, "r+")
+        if store["birds"] == FRAME['FULL'] and set(metrics) <= set(store["metrics"]) \
+           and all(mat.dtype == metric_dtype(cvt, ARG.PRECISION)
+                   for cvt, mat in store["metrics"].items()):
+            LOGGER.info("Updating similarity matrix store %s", ARG.MATRIX)
+            FRAME['STORE'] = store
+            return
+        LOGGER.warning("Similarity matrix store %s doesn't match %s, so it will be rebuilt",
+                       ARG.MATRIX, ARG.FILE)
+        del store
+    LOGGER.info("Creating similarity matrix store %s", ARG.MATRIX)
+    FRAME['STORE'] = create_store(ARG.MATRIX, FRAME['FULL'], metrics, ARG.PRECISION)
+
+
+def get_term_id(cvt):
+    """ Return the CV term ID for a bird_comparison term
+        Keyword arguments:
+          cvt: CV term
+        Returns:
+           CV term ID
+    """
+    if cvt in TERM:
+        return TERM[cvt]
+    try:
+        CURSOR['bird'].execute(READ["TERM"], [cvt])
+        row = CURSOR['bird'].fetchone()
+    except Exception as err:
+        sql_error(err)
+    if not row or row["id"] is None:
+        terminate_program(f"Unknown bird_comparison term {cvt}")
+    TERM[cvt] = row["id"]
+    return TERM[cvt]
+
+
+def load_checkpoint(birdcount):
+    """ Load a checkpoint file left by an earlier run with the same input and
+        options. Counts and session IDs are restored, and primary birds up to
+        the completed one will be skipped.
+        Keyword arguments:
+          birdcount: number of birds in the input file
+        Returns:
+          None
+    """
+    CHECKPOINT.update({"file": os.path.abspath(ARG.FILE), "birds": birdcount,
+                       "args": {"single": ARG.SINGLE, "full": ARG.FULL, "start": ARG.START,
+                                "incremental": ARG.INCREMENTAL, "phenotype": ARG.PHENOTYPE,
+                                "shard": ARG.SHARD},
+                       "load": WILL_LOAD})
+    if not (ARG.WRITE or ARG.SHARD):
+        LOGGER.warning("Checkpoints are only written with --write or --shard")
+    if not os.path.exists(ARG.CHECKPOINT):
+        return
+    with open(ARG.CHECKPOINT, encoding="ascii") as jfile_obj:
+        data = json.load(jfile_obj)
+    for key in ("file", "birds", "args", "load"):
+        if data.get(key) != CHECKPOINT[key]:
+            terminate_program(f"Checkpoint {ARG.CHECKPOINT} does not match this run ({key})")
+    CHECKPOINT.update(data)
+    FRAME['RESUMED'] = True
+    COUNT.update(data["count"])
+    SESSION.update(data["session"])
+    print(f"Resuming after {FRAME['FULL'][CHECKPOINT['completed']]}")
+
+
+def save_checkpoint():
+    """ Atomically write the checkpoint file
+        Keyword arguments:
+          None
+        Returns:
+          None
+    """
+    if not ARG.CHECKPOINT or "count" not in CHECKPOINT:
+        return
+    CHECKPOINT["session"] = SESSION
+    tmpname = ARG.CHECKPOINT + ".tmp"
+    with open(tmpname, "w", encoding="ascii") as jfile_obj:
+        json.dump(CHECKPOINT, jfile_obj)
+    os.replace(tmpname, ARG.CHECKPOINT)
+
+
+def open_results():
+    """ Open the analysis results file. The format is chosen by the file
+        extension: .parquet (typed columns), .tsv.gz (gzip), .tsv.zst (zstd),
+        or plain TSV. Resumed runs append to text files; Parquet files can't
+        be appended to, so a resumed run writes a separate part file.
+        Keyword arguments:
+          None
+        Returns:
+          None
+    """
+    outname = ARG.OUTPUT
+    if not outname:
+        outname = "analysis_results.tsv"
+        if 'SHARD' in FRAME:
+            outname = f"analysis_results_{FRAME['SHARD'][0]}_of_{FRAME['SHARD'][1]}.tsv"
+    resumed = FRAME.get('RESUMED', False)
+    if outname.endswith(".parquet"):
+        try:
+            import pyarrow as pa # pylint: disable=C0415
+            import pyarrow.parquet as pq # pylint: disable=C0415
+        except ImportError:
+            terminate_program("pyarrow is required for Parquet output")
+        if resumed:
+            outname = outname.replace(".parquet", f".part{CHECKPOINT['completed'] + 1}.parquet")
+        schema = pa.schema([(col, pa.string() if col in ("Bird1", "Bird2", "Relationship")
+                             else pa.float64()) for col in RESULT_COLUMNS])
+        OUTPUT["writer"] = pq.ParquetWriter(outname, schema)
+        OUTPUT["arrow"] = pa
+        OUTPUT["schema"] = schema
+    else:
+        mode = "at" if resumed and os.path.exists(outname) else "wt"
+        if outname.endswith(".gz"):
+            OUTPUT["file"] = gzip.open(outname, mode, encoding="ascii")
+        elif outname.endswith(".zst"):
             try:
-                CURSOR['bird'].execute(WRITE["COMPARE"] % (id1,session1,ARG.PHENOTYPE,
-                                                           id2,session2,
-                                                           float(phen1) - float(phen2)))
-            except Exception as err:
-                LOGGER.error("Could not insert %s for %s<->%s", ARG.PHENOTYPE, id1, id2)
-                sql_error(err)
-            COUNT[ARG.PHENOTYPE] += 1
+                import zstandard # pylint: disable=C0415
+            except ImportError:
+                terminate_program("zstandard is required for .zst output")
+            raw = open(outname, mode.replace("t", "b")) # pylint: disable=R1732
+            OUTPUT["file"] = io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(raw),
+                                              encoding="ascii")
+        else:
+            OUTPUT["file"] = open(outname, mode, encoding="ascii") # pylint: disable=R1732
+        if mode == "wt":
+            OUTPUT["file"].write("\t".join(RESULT_COLUMNS) + "\n")
+    LOGGER.info("Writing results to %s", outname)
+
+
+def as_float(val):
+    """ Convert a phenotype value to a float for typed output
+        Keyword arguments:
+          val: phenotype value
+        Returns:
+          float or None
+    """
+    try:
+        return float(val)
+    except (TypeError, ValueError):
+        return None
+
+
+def flush_results():
+    """ Write buffered analysis results
+        Keyword arguments:
+          None
+        Returns:
+          None
+    """
+    if not OUTPUT["rows"]:
+        return
+    if not (OUTPUT["file"] or OUTPUT["writer"]):
+        open_results()
+    if OUTPUT["writer"]:
+        columns = list(zip(*OUTPUT["rows"]))
+        data = {}
+        for pos, col in enumerate(RESULT_COLUMNS):
+            if col in ("Bird1", "Bird2", "Relationship"):
+                data[col] = list(columns[pos])
+            elif col.startswith("Phenotype"):
+                data[col] = [as_float(val) for val in columns[pos]]
+            else:
+                data[col] = [None if val != val else val for val in columns[pos]]
+        OUTPUT["writer"].write_table(OUTPUT["arrow"].Table.from_pydict(data,
+                                                                         schema=OUTPUT["schema"]))
+    else:
+        # Pairs with no sequenced markers in common have an empty sequenced match
+        OUTPUT["file"].write("".join(f"{row[0]}\t{row[1]}\t{row[2]}\t{row[3]}\t{row[4]:.2f}%\t"
+                                     + (f"{row[5]:.2f}%" if row[5] == row[5] else "")
+                                     + (f"\t{row[6]}" if row[6] else "") + "\n"
+                                     for row in OUTPUT["rows"]))
+        OUTPUT["file"].flush()
+    OUTPUT["count"] += len(OUTPUT["rows"])
+    OUTPUT["rows"].clear()
+    OUTPUT["mark"] = 0
+
+
+def close_results():
+    """ Flush and close the analysis results file
+        Keyword arguments:
+          None
+        Returns:
+          None
+    """
+    flush_results()
+    if OUTPUT["writer"]:
+        OUTPUT["writer"].close()
+    elif OUTPUT["file"]:
+        OUTPUT["file"].close()
+
+
+def flush_comparisons():
+    """ Insert buffered comparisons with a multi-row INSERT IGNORE, then commit
+        and checkpoint (if writing). Sharded runs append the comparisons to
+        the shard file instead. Buffered results are only written once their
+        comparisons are saved, so a resumed run doesn't write them twice.
+        Keyword arguments:
+          None
+        Returns:
+           None
+    """
+    if 'STORE' in FRAME:
+        for mat in FRAME['STORE']['metrics'].values():
+            mat.flush()
+    if 'SHARD_FILE' in FRAME:
+        FRAME['SHARD_FILE'].write("".join("\t".join(str(col) for col in row) + "\n"
+                                          for row in BATCH))
+        FRAME['SHARD_FILE'].flush()
+        os.fsync(FRAME['SHARD_FILE'].fileno())
+        BATCH.clear()
+        FRAME['MARK'] = 0
+        flush_results()
+        save_checkpoint()
+        return
+    if BATCH:
+        try:
+            CURSOR['bird'].executemany(WRITE["REFRESH" if ARG.PHENOTYPES else "COMPARE"],
+                                       BATCH)
+        except Exception as err:
+            LOGGER.error("Could not insert %d comparisons", len(BATCH))
+            sql_error(err)
+        BATCH.clear()
+    FRAME['MARK'] = 0
     if ARG.WRITE:
         CONN['bird'].commit()
+    flush_results()
+    if ARG.WRITE:
+        save_checkpoint()
+
+
+def merge_shards():
+    """ Bulk-load comparisons from shard files written by --shard runs
+        Keyword arguments:
+          None
+        Returns:
+           None
+    """
+    for shard in ARG.MERGE:
+        LOGGER.info("Loading %s", shard)
+        with open(shard, encoding="ascii") as shard_file:
+            for line in tqdm(shard_file, desc=shard):
+                BATCH.append(tuple(line.rstrip("\n").split("\t")))
+                COUNT["merged"] += 1
+                if len(BATCH) >= ARG.BATCH:
+                    flush_comparisons()
+        flush_comparisons()
+    print(f"Comparisons merged:          {COUNT['merged']}")
+
+
+def load_phenotypes():
+    """ Load phenotype scores into a bird x phenotype array. The latest score
+        for each bird and phenotype is used. Only birds with an allelic state
+        session are kept, since comparisons are keyed by genotype session.
+        Keyword arguments:
+          None
+        Returns:
+          List of phenotypes, list of (bird ID, session ID), array of values
+    """
+    try:
+        CURSOR['bird'].execute(READ["SCORES"])
+        rows = CURSOR['bird'].fetchall()
+        CURSOR['bird'].execute(READ["SESSIONS"])
+        sessions = CURSOR['bird'].fetchall()
+    except Exception as err:
+        sql_error(err)
+    for row in sessions:
+        SESSION[row["bird"]] = row["id"]
+    terms = sorted({row["term"] for row in rows})
+    if "all" not in ARG.PHENOTYPES:
+        for cvt in ARG.PHENOTYPES:
+            if cvt not in terms:
+                terminate_program(f"No scores for phenotype {cvt}")
+        terms = [cvt for cvt in terms if cvt in ARG.PHENOTYPES]
+    scores = {}
+    ungenotyped = set()
+    for row in rows:
+        if row["term"] not in terms:
+            continue
+        if row["bird"] not in SESSION:
+            ungenotyped.add(row["bird"])
+            continue
+        if row["bird"] not in scores:
+            scores[row["bird"]] = {"id": row["bird_id"]}
+        scores[row["bird"]][row["term"]] = row["value"]
+    COUNT["skipped"] = len(ungenotyped)
+    birds = sorted(scores)
+    values = np.full((len(birds), len(terms)), np.nan)
+    for pos, bird in enumerate(birds):
+        for col, cvt in enumerate(terms):
+            try:
+                values[pos, col] = float(scores[bird].get(cvt))
+            except (TypeError, ValueError):
+                pass
+    LOGGER.info("Birds: %d, phenotypes: %d", len(birds), len(terms))
+    return terms, [(scores[bird]["id"], SESSION[bird]) for bird in birds], values
+
+
+def compare_phenotypes():
+    """ Compare every pair of birds for each phenotype. Differences are
+        computed for a block of birds at a time by broadcasting, and
+        existing comparisons are refreshed.
+        Keyword arguments:
+          None
+        Returns:
+           None
+    """
+    terms, keys, values = load_phenotypes()
+    for cvt in terms:
+        get_term_id(cvt)
+        COUNT[cvt] = 0
+    birdcount = len(keys)
+    ids = np.array([key[0] for key in keys], dtype=np.int64)
+    sessions = np.array([key[1] for key in keys], dtype=np.int64)
+    for start in tqdm(range(0, birdcount, ARG.BLOCK), desc="Block"):
+        stop = min(start + ARG.BLOCK, birdcount)
+        # bird1 is always the bird that sorts first
+        upper = np.arange(birdcount)[None, :] > np.arange(start, stop)[:, None]
+        for col, cvt in enumerate(terms):
+            diff = values[start:stop, col, None] - values[None, :, col]
+            rows1, rows2 = np.nonzero(upper & ~np.isnan(diff))
+            COUNT["potential"] += int(np.count_nonzero(upper))
+            COUNT[cvt] += len(rows1)
+            BATCH.extend(zip(ids[start + rows1].tolist(), sessions[start + rows1].tolist(),
+                             [TERM[cvt]] * len(rows1), ids[rows2].tolist(),
+                             sessions[rows2].tolist(),
+                             map(str, diff[rows1, rows2].tolist())))
+            if len(BATCH) >= ARG.BATCH:
+                flush_comparisons()
+    flush_comparisons()
+    print(f"Birds without allelic state: {COUNT['skipped']}")
+    print(f"Potential comparisons:       {COUNT['potential']}")
+    for cvt in terms:
+        print(f"{cvt}:{' ' * (28 - len(cvt))}{COUNT[cvt]}")
+
+
+def complete_primary(idx1):
+    """ Record that all comparisons for a primary bird are buffered. Batches
+        are only flushed here, so that a checkpoint never splits a bird.
+        Keyword arguments:
+          idx1: bird1 row index
+        Returns:
+           None
+    """
+    CHECKPOINT["completed"] = idx1
+    CHECKPOINT["count"] = dict(COUNT)
+    FRAME['MARK'] = len(BATCH)
+    OUTPUT["mark"] = len(OUTPUT["rows"])
+    if len(BATCH) >= ARG.BATCH:
+        flush_comparisons()
+
+
+def save_comparisons(cvt, rows1, rows2, values):
+    """ Buffer comparisons of one kind for insertion. Undefined (NaN) values
+        aren't inserted.
+        Keyword arguments:
+          cvt: comparison CV term
+          rows1: array of bird1 row indices
+          rows2: array of bird2 row indices
+          values: array of comparison values
+        Returns:
+           None
+    """
+    defined = ~np.isnan(values)
+    if not defined.all():
+        rows1, rows2, values = rows1[defined], rows2[defined], values[defined]
+    BATCH.extend(zip(FRAME['IDS'][rows1].tolist(), FRAME['SESSION'][rows1].tolist(),
+                     repeat(get_term_id(cvt)), FRAME['IDS'][rows2].tolist(),
+                     FRAME['SESSION'][rows2].tolist(), map(str, values.tolist())))
+    COUNT[cvt] += len(rows1)
+
+
+def offer_neighbors(idx1, rows1, rows2, values):
+    """ Offer one primary bird's comparisons to the neighbor heaps of both
+        birds in each pair. Each heap keeps the ARG.TOPK best matches seen so
+        far, with the worst at the top. A heap is only touched for a value
+        above its floor (the worst value in a full heap), which is the test
+        that the heap itself would apply. Comparisons with no sequenced
+        markers in common aren't ranked.
+        Keyword arguments:
+          idx1: primary bird row index
+          rows1: array of bird1 row indices
+          rows2: array of bird2 row indices
+          values: dictionary of metric arrays aligned with the rows
+        Returns:
+           None
+    """
+    others = np.where(rows1 == idx1, rows2, rows1)
+    listed = {cvt: val.tolist() for cvt, val in values.items()}
+    for cvt, heaps in NEIGHBOR.items():
+        floor = FRAME['FLOOR'][cvt]
+        value = values[cvt]
+        offers = []
+        if not (ARG.SINGLE and FRAME['FULL'][idx1] != ARG.SINGLE):
+            offers.extend((idx1, pos) for pos in np.flatnonzero(value > floor[idx1]).tolist())
+        for pos in np.flatnonzero(value > floor[others]).tolist():
+            if not (ARG.SINGLE and FRAME['FULL'][others[pos]] != ARG.SINGLE):
+                offers.append((int(others[pos]), pos))
+        for row, pos in offers:
+            other = idx1 if row != idx1 else int(others[pos])
+            heap = heaps.setdefault(row, [])
+            item = (listed[cvt][pos], other, {key: val[pos] for key, val in listed.items()})
+            if len(heap) < ARG.TOPK:
+                heapq.heappush(heap, item)
+            elif item[0] > heap[0][0]:
+                heapq.heapreplace(heap, item)
+            if len(heap) >= ARG.TOPK:
+                floor[row] = heap[0][0]
+
+
+def save_neighbors():
+    """ Save comparisons for every pair of birds where one is among the
+        other's nearest neighbors
+        Keyword arguments:
+          None
+        Returns:
+           None
+    """
+    pairs = {}
+    for heaps in NEIGHBOR.values():
+        for row, heap in heaps.items():
+            for _, other, comp in heap:
+                pair = (row, other) if FRAME['FULL'][row] < FRAME['FULL'][other] else (other, row)
+                pairs[pair] = comp
+    LOGGER.info("Saving %d neighbor comparisons", len(pairs))
+    if pairs:
+        order = sorted(pairs)
+        rows1, rows2 = (np.array(rows, dtype=np.int64) for rows in zip(*order))
+        save_pairs(rows1, rows2, {cvt: np.array([pairs[pair][cvt] for pair in order])
+                                  for cvt in pairs[order[0]]})
+    NEIGHBOR.clear()
+
+
+def save_pairs(rows1, rows2, values):
+    """ Save the genotype comparisons and analysis results for pairs of birds
+        Keyword arguments:
+          rows1: array of bird1 row indices
+          rows2: array of bird2 row indices
+          values: dictionary of metric arrays aligned with the rows
+        Returns:
+           None
+    """
+    if not values:
+        return
+    names1 = FRAME['NAMES'][rows1].tolist()
+    names2 = FRAME['NAMES'][rows2].tolist()
+    relate = [None] * len(names1)
+    for pos in np.flatnonzero(FRAME['RELATED'][rows1]).tolist():
+        relate[pos] = RELATIONSHIP[names1[pos]].get(names2[pos])
+    OUTPUT["rows"].extend(zip(names1, names2, [FRAME['PHEN'][row] for row in rows1.tolist()],
+                              [FRAME['PHEN'][row] for row in rows2.tolist()],
+                              values['allele_match_all'].tolist(),
+                              values['allele_match_seq'].tolist(), relate))
+    # Save genotypes
+    for cvt in WILL_LOAD:
+        if cvt in values:
+            save_comparisons(cvt, rows1, rows2, values[cvt])
+
+
+def save_phenotypes(rows1, rows2):
+    """ Save the phenotype comparisons for pairs of birds. Pairs where either
+        bird has no phenotype are skipped.
+        Keyword arguments:
+          rows1: array of bird1 row indices
+          rows2: array of bird2 row indices
+        Returns:
+           None
+    """
+    if ARG.PHENOTYPE not in WILL_LOAD:
+        return
+    phen1 = FRAME['PVALUE'][rows1]
+    phen2 = FRAME['PVALUE'][rows2]
+    keep = ~(np.isnan(phen1) | np.isnan(phen2))
+    save_comparisons(ARG.PHENOTYPE, rows1[keep], rows2[keep], phen1[keep] - phen2[keep])
+
+
+def compare_primary(idx1, cols):
+    """ Compare a primary bird to a set of pending birds. Pairs are put in
+        name order, and pairs already in the database are dropped.
+        Keyword arguments:
+          idx1: bird1 row index
+          cols: array of bird2 row indices (in row order)
+        Returns:
+           None
+    """
+    full1 = FRAME['FULL'][idx1]
+    names = FRAME['NAMES'][cols]
+    named = names != ""
+    COUNT["removed"] += int(np.count_nonzero(~named))
+    cols, names = cols[named], names[named]
+    if ARG.SINGLE and not ARG.FULL:
+        early = names < full1
+        COUNT["skipped"] += int(np.count_nonzero(early))
+        cols, names = cols[~early], names[~early]
+    values = get_block_match(idx1, cols) if 'GENOTYPE' in FRAME else {}
+    swap = names < full1
+    rows1 = np.where(swap, cols, idx1)
+    rows2 = np.where(swap, idx1, cols)
+    COUNT["potential"] += len(cols)
+    present = is_processed(get_session_ids(rows1), get_session_ids(rows2))
+    COUNT["present"] += int(np.count_nonzero(present))
+    rows1, rows2 = rows1[~present], rows2[~present]
+    values = {cvt: val[~present] for cvt, val in values.items()}
+    COUNT["comparisons"] += len(rows1)
+    if NEIGHBOR:
+        offer_neighbors(idx1, rows1, rows2, values)
+    else:
+        save_pairs(rows1, rows2, values)
+    # --topk only limits genotype comparisons
+    save_phenotypes(rows1, rows2)
 
 
 def show_stats():
@@ -259,11 +957,15 @@ def show_stats():
     print(f"Comparisons made:            {COUNT['comparisons']}")
     print(f"allele_match_all:            {COUNT['allele_match_all']}")
     print(f"allele_match_seq:            {COUNT['allele_match_seq']}")
+    for cvt in METRICS[2:]:
+        if cvt in WILL_LOAD:
+            print(f"{cvt}:{' ' * (28 - len(cvt))}{COUNT[cvt]}")
     print(f"{ARG.PHENOTYPE}:                {COUNT[ARG.PHENOTYPE]}")
 
 
 def sigterm_handler(sig, frame):
-    """ Handle SIGTERM by displaying stats and exiting.
+    """ Handle SIGTERM by flushing buffered comparisons for completed primary
+        birds, displaying stats, and exiting.
         Keyword arguments:
           sig: signal
           frame: frame
@@ -271,12 +973,17 @@ def sigterm_handler(sig, frame):
           None
     """
     LOGGER.error("Caught SIGTERM")
+    del BATCH[FRAME.get('MARK', 0):]
+    del OUTPUT["rows"][OUTPUT["mark"]:]
+    flush_comparisons()
+    close_results()
     show_stats()
     sys.exit(0)
 
 
 def process_data_frame():
-    """ Read pickle file in to a dataframe, then process it.
+    """ Read the analyzed file in to a dataframe, then process it. Only the
+        bird, sex, phenotype, and marker columns are loaded.
         Keyword arguments:
           None
         Returns:
@@ -284,49 +991,113 @@ def process_data_frame():
     """
     print(f"Processing {ARG.FILE}")
     LOGGER.info("Reading %s", ARG.FILE)
-    dfr = pd.read_pickle(ARG.FILE)
+    name = frame_columns(ARG.FILE, ARG.CACHE)
+    markers = name[name.index(SEX_COL) + 2:]
+    if ARG.MARKERS:
+        missing = [marker for marker in ARG.MARKERS if marker not in markers]
+        if missing:
+            terminate_program(f"Marker {missing[0]} is not in {ARG.FILE}")
+        markers = ARG.MARKERS
+    # The sex and phenotype columns stay adjacent so that markers start at SEX_COL + 2
+    dfr = read_frame(ARG.FILE, [BIRD_COL, "IND_NAME", SEX_COL, ARG.PHENOTYPE.upper()] + markers,
+                     ARG.CACHE)
     dfr.sort_values(by="IND_NAME", inplace=True)
+    dfr.reset_index(drop=True, inplace=True)
     LOGGER.info("Dimensions: %dx%d", dfr.shape[0], dfr.shape[1])
     LOGGER.info("Birds: %d", len(dfr[BIRD_COL].unique()))
     FRAME['NAME'] = list(dfr.columns)
     FRAME['FIRST_MARKER'] = FRAME['NAME'].index(SEX_COL) + 2
-    birdlist = dfr[BIRD_COL].tolist()
-    birdlist2 = birdlist[:]
+    FRAME['ID'] = dfr[BIRD_COL].tolist()
+    # Blank cells in TSV input are read as NaN
+    FRAME['FULL'] = ["" if pd.isna(full) else full for full in dfr["IND_NAME"]]
+    FRAME['PHEN'] = ["-" if pd.isna(phen) or not phen else phen
+                     for phen in dfr[ARG.PHENOTYPE.upper()]]
+    # Per-bird arrays for comparing a primary bird to many birds at once
+    FRAME['NAMES'] = np.array(FRAME['FULL'], dtype=str)
+    FRAME['IDS'] = np.array(FRAME['ID'], dtype=object)
+    FRAME['SESSION'] = np.zeros(dfr.shape[0], dtype=np.int64)
+    FRAME['RELATED'] = np.array([full in RELATIONSHIP for full in FRAME['FULL']], dtype=bool)
+    FRAME['PVALUE'] = np.full(dfr.shape[0], np.nan)
+    if ARG.PHENOTYPE in WILL_LOAD:
+        for row, phen in enumerate(FRAME['PHEN']):
+            if not FRAME['FULL'][row] or phen in (".", "-"):
+                continue
+            try:
+                FRAME['PVALUE'][row] = float(phen)
+            except (TypeError, ValueError):
+                terminate_program(f"Invalid {ARG.PHENOTYPE} ({phen}) for {FRAME['FULL'][row]}")
+    FRAME['FLOOR'] = {cvt: np.full(dfr.shape[0], -np.inf) for cvt in NEIGHBOR}
+    FRAME['BLOCK'] = {}
+    if ARG.CHECKPOINT:
+        load_checkpoint(dfr.shape[0])
+    # Primary birds are dealt out to shards round-robin to balance the pair counts
+    FRAME['MINE'] = np.ones(dfr.shape[0], dtype=bool)
+    if 'SHARD' in FRAME:
+        primary = [idx for idx, full in enumerate(FRAME['FULL']) if not skip_primary(full)]
+        FRAME['MINE'][:] = False
+        FRAME['MINE'][primary[FRAME['SHARD'][0]::FRAME['SHARD'][1]]] = True
+        shard = f"comparisons_{FRAME['SHARD'][0]}_of_{FRAME['SHARD'][1]}.tsv"
+        LOGGER.info("Writing shard comparisons to %s", shard)
+        FRAME['SHARD_FILE'] = open(shard, "a" if CHECKPOINT["completed"] >= 0 else "w",
+                                   encoding="ascii")
+    if ARG.INCREMENTAL:
+        FRAME['OLD'] = compared_birds()
+        LOGGER.info("Birds with new sessions: %d", np.count_nonzero(~FRAME['OLD']))
+    if any(cvt in METRICS for cvt in WILL_LOAD):
+        LOGGER.info("Encoding genotypes")
+        FRAME['GENOTYPE'] = encode_genotypes(dfr, FRAME['FIRST_MARKER'])
+        # Allele matches are always computed for the results file
+        FRAME['GENOTYPE']['metrics'] = METRICS[:2] + [cvt for cvt in METRICS[2:]
+                                                      if cvt in WILL_LOAD]
+        if FRAME['GENOTYPE']['packed'] is not None:
+            LOGGER.info("Genotypes are bit-packed (%d bytes per bird)",
+                        FRAME['GENOTYPE']['packed'][:, 0].nbytes)
+        if ARG.MATRIX:
+            open_matrix_store()
+        FRAME['MATCHES'] = block_matches(plan_blocks())
+    birdcount = dfr.shape[0]
     if ARG.SINGLE:
-        max_results = len(birdlist) - 1
+        max_results = birdcount - 1
     else:
-        max_results = int((len(birdlist) - 1) * (len(birdlist)) / 2)
-        max_results -= len(PROCESSED)
+        max_results = int((birdcount - 1) * birdcount / 2)
+        if ARG.INCREMENTAL:
+            old = int(np.count_nonzero(FRAME['OLD']))
+            max_results -= int(old * (old - 1) / 2)
+        else:
+            max_results -= PROCESSED["keys"].size
+        if 'SHARD' in FRAME:
+            max_results = int(max_results / FRAME['SHARD'][1])
     LOGGER.info("Estimated comparisons: %d", max_results)
-    results = ["Bird1\tBird2\tPhenotype1\tPhenotype2\tAll markers\tSequenced markers\tRelationship"]
-    for bird1 in tqdm(birdlist, desc="Primary", position=0):
-        row1 = dfr.loc[dfr[BIRD_COL] == bird1]
-        full1 = row1["IND_NAME"].iloc[0]
-        if ARG.SINGLE and (ARG.SINGLE != full1):
+    pending = np.ones(birdcount, dtype=bool)
+    for idx1 in tqdm(range(birdcount), desc="Primary", position=0):
+        full1 = FRAME['FULL'][idx1]
+        if skip_primary(full1):
             continue
-        if ARG.START and (ARG.START > full1):
+        pending[idx1] = False
+        if idx1 <= CHECKPOINT["completed"] or not FRAME['MINE'][idx1]:
             continue
-        birdlist2.remove(bird1)
         if not full1:
             COUNT["removed"] += 1
+            complete_primary(idx1)
             continue
-        id1 = row1[BIRD_COL].iloc[0]
-        phen1 = row1[ARG.PHENOTYPE.upper()].iloc[0]
-        session1 = get_session_id(full1)
-        for bird2 in tqdm(birdlist2, desc=full1, position=1, leave=False):
-            row2 = dfr.loc[dfr[BIRD_COL] == bird2]
-            full2 = row2["IND_NAME"].iloc[0]
-            if not full2:
-                COUNT["removed"] += 1
-                continue
-            if ARG.SINGLE and (not ARG.FULL) and (full2 < full1):
-                COUNT["skipped"] += 1
-                continue
-            compare_birds(row1, row2, id1, session1, full1, phen1, results)
-    print(f"{len(results)-1}/{max_results} results")
-    if len(results) > 1:
-        with open("analysis_results.tsv", "w", encoding="ascii") as output:
-            output.write("\n".join(results) + "\n")
+        secondary = pending
+        if ARG.INCREMENTAL and FRAME['OLD'][idx1]:
+            # Pairs of previously compared sessions are already present
+            present = int(np.count_nonzero(pending & FRAME['OLD']))
+            COUNT["potential"] += present
+            COUNT["present"] += present
+            secondary = pending & ~FRAME['OLD']
+        compare_primary(idx1, np.flatnonzero(secondary))
+        complete_primary(idx1)
+    if 'MATCHES' in FRAME:
+        FRAME['MATCHES'].close()
+    if NEIGHBOR:
+        save_neighbors()
+    flush_comparisons()
+    if 'SHARD_FILE' in FRAME:
+        FRAME['SHARD_FILE'].close()
+    close_results()
+    print(f"{OUTPUT['count']}/{max_results} results")
     show_stats()
 
 
@@ -335,15 +1106,56 @@ def process_data_frame():
 if __name__ == '__main__':
     PARSER = argparse.ArgumentParser(description="Load allelic states")
     PARSER.add_argument('--file', dest='FILE', action='store',
-                        help='File', required=True)
+                        help='File (required unless using --merge or --phenotypes)')
+    PARSER.add_argument('--markers', dest='MARKERS', action='store', nargs='+',
+                        help='Marker columns to compare [all]')
+    PARSER.add_argument('--cache', dest='CACHE', action='store',
+                        help='Cache directory for TSV input [.frame_cache next to the file]')
     PARSER.add_argument('--phenotype', dest='PHENOTYPE', action='store',
                         default="median_tempo", help='Phenotype [median_tempo]')
+    PARSER.add_argument('--phenotypes', dest='PHENOTYPES', action='store', nargs='+',
+                        help='Refresh comparisons for these phenotypes (or "all") '
+                             + 'from their scores')
+    PARSER.add_argument('--comparisons', dest='COMPARISONS', action='store', nargs='+',
+                        help='Comparisons to upload (skips the prompt)')
     PARSER.add_argument('--single', dest='SINGLE', action='store',
                         help='Single bird to process')
     PARSER.add_argument('--full', dest='FULL', action='store_true',
                         default=False, help='Compare all birds is using --single')
+    PARSER.add_argument('--incremental', dest='INCREMENTAL', action='store_true',
+                        default=False, help='Only compare birds with new sessions')
     PARSER.add_argument('--start', dest='START', action='store',
                         help='Starting bird')
+    PARSER.add_argument('--topk', dest='TOPK', action='store', type=int,
+                        help='Only save genotype comparisons for the k closest birds to each '
+                             + 'bird (phenotype comparisons are saved for every pair). '
+                             + 'Neighbors are chosen from the pairs compared in this run, so '
+                             + 'bird_comparison must not already hold comparisons')
+    PARSER.add_argument('--block', dest='BLOCK', action='store', type=int,
+                        default=64, help='Primary birds to compare per block [64]')
+    PARSER.add_argument('--tile', dest='TILE', action='store', type=int,
+                        default=1024, help='Secondary birds to compare per tile [1024]')
+    PARSER.add_argument('--workers', dest='WORKERS', action='store', type=int,
+                        default=1, help='Worker processes for comparisons [1]')
+    PARSER.add_argument('--batch', dest='BATCH', action='store', type=int,
+                        default=5000, help='Comparisons to insert per batch [5000]')
+    PARSER.add_argument('--checkpoint', dest='CHECKPOINT', action='store',
+                        help='Checkpoint file for resuming an interrupted run')
+    PARSER.add_argument('--output', dest='OUTPUT', action='store',
+                        help='Results file (.tsv, .tsv.gz, .tsv.zst, or .parquet) '
+                             + '[analysis_results.tsv]')
+    PARSER.add_argument('--matrix', dest='MATRIX', action='store',
+                        help='Also write genotype comparisons to a condensed matrix store '
+                             + 'in this directory')
+    PARSER.add_argument('--precision', dest='PRECISION', action='store',
+                        default='float32', choices=['float32', 'float16'],
+                        help='Matrix store precision for similarities (marker counts '
+                             + 'are always float32) [float32]')
+    PARSER.add_argument('--shard', dest='SHARD', action='store',
+                        help='Compute one shard (i/N, 0 <= i < N) of the comparisons, '
+                             + 'writing them to a file instead of the database')
+    PARSER.add_argument('--merge', dest='MERGE', action='store', nargs='+',
+                        help='Shard files to load into the database')
     PARSER.add_argument('--manifold', dest='MANIFOLD', action='store',
                         default='dev', choices=["dev", "prod"],
                         help='Manifold')
@@ -354,6 +1166,12 @@ if __name__ == '__main__':
     PARSER.add_argument('--debug', dest='DEBUG', action='store_true',
                         default=False, help='Flag, Very chatty')
     ARG = PARSER.parse_args()
+    if not (ARG.FILE or ARG.MERGE or ARG.PHENOTYPES):
+        PARSER.error("one of --file, --merge, or --phenotypes is required")
+    if ARG.TOPK and (ARG.CHECKPOINT or ARG.SHARD or ARG.INCREMENTAL):
+        PARSER.error("--topk can't be used with --checkpoint, --shard, or --incremental")
+    if ARG.MATRIX and ARG.SHARD:
+        PARSER.error("--matrix can't be used with --shard")
     LOGGER = colorlog.getLogger()
     ATTR = colorlog.colorlog.logging if "colorlog" in dir(colorlog) else colorlog
     if ARG.DEBUG:
@@ -367,6 +1185,12 @@ if __name__ == '__main__':
     LOGGER.addHandler(HANDLER)
 
     initialize_program()
+    if ARG.MERGE:
+        merge_shards()
+        sys.exit(0)
+    if ARG.PHENOTYPES:
+        compare_phenotypes()
+        sys.exit(0)
     signal.signal(signal.SIGTERM, sigterm_handler)
     process_data_frame()
     sys.exit(0)
@@ -0,0 +1,181 @@
+''' frame_cache.py
+    Columnar cache for tab-delimited genotype and phenotype files. The first
+    read of a TSV saves it as an uncompressed Feather file named by a content
+    hash of the source; later reads memory-map the Feather file and load
+    only the requested columns. A cache is stale as soon as the source's
+    content changes. Size and modification time are checked first, and the
+    source is only rehashed when they differ. Pickle and Feather inputs are
+    read directly. Without pyarrow, TSVs are parsed every time.
+    Several processes can share a cache: the index is only updated while
+    holding a lock file, and a Feather file is only removed once no index
+    entry points to it.
+'''
+
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import json
+import os
+import pandas as pd
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    pa = feather = None
+
+CACHE_DIR = ".frame_cache"
+INDEX = "index.json"
+LOCK = "index.lock"
+CHUNK = 1 << 20
+
+
+def cache_directory(path, cache=None):
+    """ Return the cache directory for a source file
+        Keyword arguments:
+          path: source file
+          cache: cache directory (defaults to .frame_cache next to the source)
+        Returns:
+          cache directory
+    """
+    return cache or os.path.join(os.path.dirname(os.path.abspath(path)), CACHE_DIR)
+
+
+def source_hash(path):
+    """ Return the content hash of a file
+        Keyword arguments:
+          path: file
+        Returns:
+          hex digest
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as infile:
+        for chunk in iter(lambda: infile.read(CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_index(cache):
+    """ Read a cache directory's index
+        Keyword arguments:
+          cache: cache directory
+        Returns:
+          dictionary of source path: {"size", "mtime", "hash"}
+    """
+    try:
+        with open(os.path.join(cache, INDEX), encoding="ascii") as infile:
+            return json.load(infile)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+@contextmanager
+def index_lock(cache):
+    """ Hold a cache directory's index lock
+        Keyword arguments:
+          cache: cache directory
+        Returns:
+          None
+    """
+    with open(os.path.join(cache, LOCK), "a", encoding="ascii") as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def write_index(cache, index):
+    """ Replace a cache directory's index (call while holding index_lock)
+        Keyword arguments:
+          cache: cache directory
+          index: index dictionary
+        Returns:
+          None
+    """
+    tmpname = os.path.join(cache, f"{INDEX}.{os.getpid()}.tmp")
+    with open(tmpname, "w", encoding="ascii") as outfile:
+        json.dump(index, outfile, indent=1)
+    os.replace(tmpname, os.path.join(cache, INDEX))
+
+
+def cached_file(path, cache=None):
+    """ Return the Feather file for a TSV, building it if it's missing or stale.
+        The source's index entry is recorded before the Feather file is used,
+        so no other process will remove it.
+        Keyword arguments:
+          path: source TSV
+          cache: cache directory
+        Returns:
+          Feather file path
+    """
+    cache = cache_directory(path, cache)
+    os.makedirs(cache, exist_ok=True)
+    source = os.path.abspath(path)
+    stat = os.stat(source)
+    entry = read_index(cache).get(source, {})
+    if entry.get("size") != stat.st_size or entry.get("mtime") != stat.st_mtime_ns:
+        entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": source_hash(source)}
+    with index_lock(cache):
+        # Other processes may have updated the index since it was read
+        index = read_index(cache)
+        previous = index.get(source, {}).get("hash")
+        index[source] = entry
+        write_index(cache, index)
+        # Drop the stale file unless another source has the same content
+        if previous and previous != entry["hash"] \
+           and all(other["hash"] != previous for other in index.values()):
+            stale = os.path.join(cache, f"{previous}.feather")
+            if os.path.exists(stale):
+                os.remove(stale)
+    cname = os.path.join(cache, f"{entry['hash']}.feather")
+    if not os.path.exists(cname):
+        dfr = pd.read_csv(source, header=0, delimiter="\t")
+        tmpname = f"{cname}.{os.getpid()}.tmp"
+        feather.write_feather(dfr, tmpname, compression="uncompressed")
+        os.replace(tmpname, cname)
+    return cname
+
+
+def frame_columns(path, cache=None):
+    """ Return the column names of an input file without reading its data
+        Keyword arguments:
+          path: input file (TSV, pickle, or Feather)
+          cache: cache directory
+        Returns:
+          list of column names
+    """
+    if path.endswith((".pk", ".pkl")):
+        return list(pd.read_pickle(path).columns)
+    if feather and not path.endswith((".feather", ".arrow")):
+        path = cached_file(path, cache)
+    if path.endswith((".feather", ".arrow")):
+        if not feather:
+            raise ImportError("pyarrow is required to read Feather files")
+        with pa.memory_map(path) as source:
+            return pa.ipc.open_file(source).schema.names
+    return list(pd.read_csv(path, header=0, delimiter="\t", nrows=0).columns)
+
+
+def read_frame(path, columns=None, cache=None):
+    """ Read an input file into a dataframe
+        Keyword arguments:
+          path: input file (TSV, pickle, or Feather)
+          columns: columns to load, in order (defaults to all)
+          cache: cache directory
+        Returns:
+          dataframe
+    """
+    if path.endswith((".pk", ".pkl")):
+        dfr = pd.read_pickle(path)
+        return dfr if columns is None else dfr[list(columns)]
+    if feather and not path.endswith((".feather", ".arrow")):
+        path = cached_file(path, cache)
+    if path.endswith((".feather", ".arrow")):
+        if not feather:
+            raise ImportError("pyarrow is required to read Feather files")
+        table = feather.read_table(path, columns=None if columns is None else list(columns),
+                                   memory_map=True)
+        return table.to_pandas()
+    dfr = pd.read_csv(path, header=0, delimiter="\t",
+                      usecols=None if columns is None else list(columns))
+    return dfr if columns is None else dfr[list(columns)]
@@ -4,11 +4,13 @@
     Each row is a set of measurements for one bird. Required columns are:
       1) Column name stored in BIRD_COL (typically "IND_ID")
       2) SEX ("M" or "F")
-      3) Phenotype name (stored in ARG.PHENOTYPE)
-      4) One or more marker columns, immediately following the phenotype name
+      3) One or more phenotype columns (named in ARG.PHENOTYPE, or "all")
+      4) One or more marker columns, immediately following the phenotype columns
     Example:
       IND_ID  SEX     MEDIAN_TEMPO    2       3       4       5
       1       M       6.69460301396   C/G     C/C     ./.     C/C
+    Every phenotype is scored in the same pass. The analyzed output carries
+    the first phenotype only.
     Tables updated are:
       bird
       score
@@ -17,16 +19,22 @@
 '''
 
 import argparse
+from collections import deque
 import hashlib
+import multiprocessing
 import os
 import re
 import socket
 import sys
+import tempfile
 import colorlog
 import MySQLdb
+import numpy as np
 import pandas as pd
 import requests
 from tqdm import tqdm
+from frame_cache import frame_columns, read_frame, source_hash
+from similarity_engine import is_het
 
 # pylint: disable=R1710, W0703
 
@@ -34,10 +42,18 @@ from tqdm import tqdm
 CONFIG = {'config': {'url': os.environ.get('CONFIG_SERVER_URL')}}
 BAND = {}
 BIRD = {}
+BIRDID = {} # {bird ID: {"name", "sex", "band"}}
 COLOR = {}
-PHENMAP = {} # MD5 hash: phenotype value
-PHENCOL = {}
-PHENVAL = {} # {IND_ID: phenotype value}
+PHENMAP = {} # MD5 hash: {phenotype: value}
+PHENCOL = {} # Phenotype file calls: birds, markers, codes, vocab, and per-marker-set lookups
+PHENVAL = {} # {IND_ID: {phenotype: value}}
+PHENOTYPES = [] # Phenotype columns read from the phenotype file
+SCORES = [] # Buffered (bird ID, phenotype type ID, value, valid) rows
+STATES = [] # Buffered (session_id, marker, state) rows
+BLOBS = [] # Buffered (session_id, marker_set_id, vocab, calls) rows
+PACKED = {"set": None, "calls": 0} # Current marker set ID, calls buffered in BLOBS
+LEDGER = {"hash": None, "birds": set()} # Source file hash, bird IDs already loaded from it
+SUMMARY = {} # Source file hash: {"markers", "birds", "counts"} per-marker QC totals
 # General
 BIRD_COL = "IND_ID" # Column name for bird
 BDAY_COL = "IND_BD" # Column name for bird birth date
@@ -46,22 +62,45 @@ NEST_COL = "FAM_ID" # Column name for nest
 SIRE_COL = "FATHER_ID"
 DAMSEL_COL = "MOTHER_ID"
 LIMIT = 5 # Number of allele mismatches to allow
+ALLELES = "ACGT" # Alleles counted in the per-marker summary
+BIRD_QC = ("markers_sequenced", "markers_missing", "markers_heterozygous", "call_rate")
 COUNT = {"missing": 0, "phenotype": 0, "processed": 0, "read": 0, "score": 0,
-         "session": 0, "sex": 0, "state": 0, "birds": 0,
+         "session": 0, "sex": 0, "state": 0, "birds": 0, "loaded": 0, "duplicate": 0,
          "seq_close": 0, "seq_match": 0, "seq_mismatch": 0}
 # Database
 CONN = {}
 CURSOR = {}
-READ = {"BIRD": "SELECT name,sex FROM bird_vw WHERE id=%s",
+READ = {"BIRDS": "SELECT id,name,band,sex FROM bird_vw",
         "SPECIES": "SELECT id FROM species WHERE common_name='%s'",
-        "TERMS": "SELECT id,cv,cv_term FROM cv_term_vw where cv IN ('phenotype','genotype')"
+        "TERMS": "SELECT id,cv,cv_term FROM cv_term_vw where cv IN ('phenotype','genotype')",
+        "LEDGER": "SELECT bird_id FROM genotype_load WHERE file_hash=%s",
+        "MARKERSET": "SELECT id FROM genotype_marker_set WHERE hash=%s",
+        "LASTSESSION": "SELECT COALESCE(MAX(id),0) AS id FROM session",
+        "PSESSIONS": "SELECT id,bird_id,type_id FROM session WHERE id>%s AND type_id IN (%s) "
+                     + "AND bird_id IN (%s) ORDER BY id",
+        "INDEXES": "SELECT index_name,non_unique,GROUP_CONCAT(column_name ORDER BY seq_in_index) "
+                   + "AS columns FROM information_schema.statistics WHERE table_schema=DATABASE() "
+                   + "AND table_name='state' AND index_name<>'PRIMARY' AND index_name NOT IN "
+                   + "(SELECT constraint_name FROM information_schema.referential_constraints "
+                   + "WHERE constraint_schema=DATABASE() AND table_name='state') "
+                   + "GROUP BY 1,2"
        }
 WRITE = {"BIRD": "INSERT INTO bird (species_id,name,band,location_id,sex,alive) VALUES "
                  + "(%s,%s,%s,getCVTermId('location',%s,''),%s,0)",
          "SESSION": "INSERT INTO session (name,type_id,bird_id,user_id) VALUES "
                     + "(%s,%s,%s,%s)",
          "SCORE": "INSERT INTO score (session_id,type_id,value) VALUES(%s,%s,%s)",
-         "STATE": "INSERT INTO state (session_id,marker,state) VALUES (%s,%s,%s)"
+         "BLOB": "INSERT INTO genotype_blob (session_id,marker_set_id,vocab,calls) VALUES "
+                 + "(%s,%s,%s,%s)",
+         "MARKER": "INSERT INTO genotype_marker (marker_set_id,position,marker) VALUES (%s,%s,%s)",
+         "MARKERSET": "INSERT INTO genotype_marker_set (hash,marker_count) VALUES (%s,%s)",
+         "LEDGER": "INSERT INTO genotype_load (bird_id,file_hash,session_id) VALUES (%s,%s,%s)",
+         "SUMMARY": "REPLACE INTO genotype_marker_summary (file_hash,marker,birds,called,missing,"
+                    + "heterozygous,allele_a,allele_c,allele_g,allele_t,call_rate) VALUES "
+                    + "(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)",
+         "STATE": "INSERT INTO state (session_id,marker,state) VALUES (%s,%s,%s)",
+         "STATEFILE": "LOAD DATA LOCAL INFILE %s INTO TABLE state FIELDS TERMINATED BY '\\t' "
+                      + "(session_id,marker,state)"
         }
 
 
@@ -127,7 +166,8 @@ def db_connect(dbd):
     LOGGER.info("Connecting to %s on %s", dbd['name'], dbd['host'])
     try:
         conn = MySQLdb.connect(host=dbd['host'], user=dbd['user'],
-                               passwd=dbd['password'], db=dbd['name'])
+                               passwd=dbd['password'], db=dbd['name'],
+                               local_infile=int(ARG.INFILE))
     except MySQLdb.Error as err:
         sql_error(err)
     try:
@@ -150,13 +190,14 @@ def initialize_program():
     data = call_responder('config', 'config/db_config')
     (CONN['bird'], CURSOR['bird']) = db_connect(data['config']['birdsong'][ARG.MANIFOLD])
     try:
-        CURSOR['bird'].execute("SELECT id,name,band FROM bird")
+        CURSOR['bird'].execute(READ["BIRDS"])
         rows = CURSOR['bird'].fetchall()
     except Exception as err:
         sql_error(err)
     for row in rows:
         BAND[row['band']] = True
         BIRD[row['name']] = row['id']
+        BIRDID[row['id']] = {"name": row['name'], "sex": row['sex'], "band": row['band']}
     try:
         CURSOR['bird'].execute("SELECT display_name,cv_term FROM cv_term_vw WHERE cv='color'")
         rows = CURSOR['bird'].fetchall()
@@ -190,45 +231,270 @@ def get_terms():
     return term
 
 
-def process_phenotype_file():
+def get_marker_set(markers):
+    """ Get the ID of the shared marker order for packed genotypes, creating
+        it if needed
+        Keyword arguments:
+          markers: list of marker names
+        Returns:
+          Marker set ID
+    """
+    key = hashlib.md5("\t".join(markers).encode()).hexdigest()
+    try:
+        CURSOR['bird'].execute(READ["MARKERSET"], (key,))
+        row = CURSOR['bird'].fetchone()
+        if row:
+            return row["id"]
+        CURSOR['bird'].execute(WRITE["MARKERSET"], (key, len(markers)))
+        set_id = CURSOR['bird'].lastrowid
+        CURSOR['bird'].executemany(WRITE["MARKER"], [(set_id, pos, marker) for pos, marker
+                                                     in enumerate(markers, start=1)])
+    except Exception as err:
+        sql_error(err)
+    LOGGER.info("Created marker set %s for %d markers", set_id, len(markers))
+    return set_id
+
+
+def encode_calls(calls):
+    """ Pack a bird's calls into one byte per marker
+        Keyword arguments:
+          calls: list of calls
+        Returns:
+          Comma-separated vocabulary, bytes of 1-based vocabulary positions
+    """
+    vocab = {}
+    try:
+        codes = bytes(vocab.setdefault(call, len(vocab) + 1) for call in calls)
+    except ValueError:
+        terminate_program("Too many distinct calls to pack (limit is 255)")
+    return ",".join(vocab), codes
+
+
+def flush_blobs():
+    """ Bulk-load buffered packed genotypes
+        Keyword arguments:
+          None
+        Returns:
+          None
+    """
+    if not BLOBS:
+        return
+    try:
+        CURSOR['bird'].executemany(WRITE["BLOB"], BLOBS)
+    except Exception as err:
+        LOGGER.error("Could not load %d packed genotypes", len(BLOBS))
+        sql_error(err)
+    COUNT["state"] += PACKED["calls"]
+    PACKED["calls"] = 0
+    BLOBS.clear()
+
+
+def flush_scores():
+    """ Bulk-load buffered phenotype scores. Sessions are inserted with
+        executemany and read back to get their IDs. lastrowid can't be used:
+        MySQLdb splits a long multi-row INSERT into several statements, and
+        InnoDB doesn't promise consecutive IDs within one.
+        Keyword arguments:
+          None
+        Returns:
+          None
+    """
+    if not SCORES:
+        return
+    sessions = {}
+    try:
+        CURSOR['bird'].execute(READ["LASTSESSION"])
+        last = CURSOR['bird'].fetchone()["id"]
+        CURSOR['bird'].executemany(WRITE["SESSION"], [(bid, ptid, bid, 2)
+                                                      for bid, ptid, _, _ in SCORES])
+        ptids = sorted({row[1] for row in SCORES})
+        bids = sorted({row[0] for row in SCORES})
+        CURSOR['bird'].execute(READ["PSESSIONS"] % ("%s", ",".join(["%s"] * len(ptids)),
+                                                    ",".join(["%s"] * len(bids))),
+                               [last] + ptids + bids)
+        for row in CURSOR['bird'].fetchall():
+            sessions.setdefault((row["bird_id"], row["type_id"]), deque()).append(row["id"])
+        scores = [(sessions[(bid, ptid)].popleft(), ptid, val)
+                  for bid, ptid, val, valid in SCORES if valid]
+        CURSOR['bird'].executemany(WRITE["SCORE"], scores)
+    except Exception as err:
+        LOGGER.error("Could not load %d phenotype scores", len(SCORES))
+        sql_error(err)
+    COUNT["session"] += len(SCORES)
+    COUNT["score"] += len(scores)
+    SCORES.clear()
+
+
+def flush_states():
+    """ Bulk-load buffered packed genotypes, phenotype scores, and allelic
+        states. States use a multi-row INSERT or (with --infile) LOAD DATA
+        LOCAL INFILE.
+        Keyword arguments:
+          None
+        Returns:
+          None
+    """
+    flush_blobs()
+    flush_scores()
+    if not STATES:
+        return
+    try:
+        if ARG.INFILE:
+            with tempfile.NamedTemporaryFile("w", suffix=".tsv", encoding="ascii") as tmpfile:
+                tmpfile.write("".join(f"{row[0]}\t{row[1]}\t{row[2]}\n" for row in STATES))
+                tmpfile.flush()
+                CURSOR['bird'].execute(WRITE["STATEFILE"], (tmpfile.name,))
+        else:
+            CURSOR['bird'].executemany(WRITE["STATE"], STATES)
+    except Exception as err:
+        LOGGER.error("Could not load %d allelic states", len(STATES))
+        sql_error(err)
+    COUNT["state"] += len(STATES)
+    STATES.clear()
+
+
+def commit_batch():
+    """ Load buffered allelic states and commit everything written so far.
+        Batches end on bird boundaries, so a failure loses at most one batch
+        and the ledger never lists a bird whose data wasn't committed.
+        Keyword arguments:
+          None
+        Returns:
+          None
+    """
+    flush_states()
+    if ARG.WRITE:
+        try:
+            CONN['bird'].commit()
+        except Exception as err:
+            sql_error(err)
+
+
+def read_ledger(fhash):
+    """ Find the birds that already have sessions loaded from a file
+        Keyword arguments:
+          fhash: content hash of the source file (or None to disable the ledger)
+        Returns:
+          None
+    """
+    LEDGER["hash"] = fhash
+    LEDGER["birds"] = set()
+    if not fhash or ARG.SKIP:
+        return
+    try:
+        CURSOR['bird'].execute(READ["LEDGER"], (fhash,))
+        rows = CURSOR['bird'].fetchall()
+    except Exception as err:
+        sql_error(err)
+    LEDGER["birds"].update(row["bird_id"] for row in rows)
+    if rows:
+        LOGGER.warning("%d birds were already loaded from this file", len(rows))
+
+
+def defer_indexes():
+    """ Turn off unique and foreign key checks for this connection, and drop
+        the state table's secondary indexes so that they're rebuilt once
+        after the load instead of maintained row by row. Indexes that back
+        foreign keys are kept.
+        Keyword arguments:
+          None
+        Returns:
+          List of statements that restore the indexes
+    """
+    try:
+        CURSOR['bird'].execute(READ["INDEXES"])
+        rows = CURSOR['bird'].fetchall()
+        CURSOR['bird'].execute("SET unique_checks=0,foreign_key_checks=0")
+    except Exception as err:
+        sql_error(err)
+    restore = []
+    for row in rows:
+        LOGGER.warning("Dropping index %s on state", row["index_name"])
+        try:
+            CURSOR['bird'].execute(f"ALTER TABLE state DROP INDEX `{row['index_name']}`")
+        except Exception as err:
+            sql_error(err)
+        restore.append(f"ALTER TABLE state ADD {'' if row['non_unique'] else 'UNIQUE '}INDEX "
+                       + f"`{row['index_name']}` ({row['columns']})")
+    return restore
+
+
+def restore_indexes(restore):
+    """ Rebuild indexes dropped by defer_indexes and turn checks back on
+        Keyword arguments:
+          restore: list of statements from defer_indexes
+        Returns:
+          None
+    """
+    for sql in restore:
+        LOGGER.warning(sql)
+        try:
+            CURSOR['bird'].execute(sql)
+        except Exception as err:
+            LOGGER.critical("Could not restore index: %s", sql)
+            sql_error(err)
+    try:
+        CURSOR['bird'].execute("SET unique_checks=1,foreign_key_checks=1")
+    except Exception as err:
+        sql_error(err)
+
+
+def process_phenotype_file(term=None):
+    """ Read the phenotype file: phenotype values and calls for each bird
+        Keyword arguments:
+          term: term dictionary (read from the database if not given)
+        Returns:
+          None
+    """
     LOGGER.info("Reading %s", ARG.PHENFILE)
-    if ARG.PHENFILE.endswith(".pk") or ARG.PHENFILE.endswith(".pkl"):
-        dfrp = pd.read_pickle(ARG.PHENFILE)
+    name = frame_columns(ARG.PHENFILE, ARG.CACHE)
+    term = (term or get_terms()).get("phenotype", {})
+    known = [col for col in name if col.lower() in term]
+    if "all" in ARG.PHENOTYPE:
+        PHENOTYPES.extend(known)
     else:
-        dfrp = pd.read_csv(ARG.PHENFILE, header=0, delimiter="\t")
-        newname = ARG.PHENFILE.replace("." + ARG.PHENFILE.split(".")[-1], ".pkl")
-        if newname == ARG.PHENFILE:
-            newname += ".pkl"
-        LOGGER.info("Saving phenotype dataframe to %s", newname)
-        dfrp.to_pickle(newname)
-    name = list(dfrp.columns)
-    first_marker = name.index(ARG.PHENOTYPE.upper()) + 1
-    LOGGER.info("Dimensions: %dx%d", dfrp.shape[0], dfrp.shape[1])
+        PHENOTYPES.extend(phenotype.upper() for phenotype in ARG.PHENOTYPE)
+    for phenotype in PHENOTYPES:
+        if phenotype not in name:
+            terminate_program(f"Phenotype {phenotype} is not in {ARG.PHENFILE}")
+        if phenotype.lower() not in term:
+            terminate_program(f"Phenotype {phenotype} is not a phenotype CV term")
+    if not PHENOTYPES:
+        terminate_program(f"No phenotype columns in {ARG.PHENFILE}")
+    LOGGER.info("Phenotypes: %s", ", ".join(PHENOTYPES))
+    # Markers follow the last phenotype column
+    first_marker = max(name.index(col) for col in known + PHENOTYPES) + 1
+    markers = [col for col in name[first_marker:]
+               if col not in ('23458', '24704', '26835')] #PLUG
+    dfrp = read_frame(ARG.PHENFILE, [BIRD_COL] + PHENOTYPES + markers, ARG.CACHE)
+    LOGGER.info("Dimensions: %dx%d", dfrp.shape[0], len(name))
     LOGGER.info("Birds: %d", len(dfrp[BIRD_COL].unique()))
     LOGGER.info("Markers: %d", (len(name) - first_marker))
-    for _, row in tqdm(dfrp.iterrows(), total=dfrp.shape[0], desc="Loading phenotypes"):
-        PHENCOL[row[BIRD_COL]] = {}
-        PHENVAL[row[BIRD_COL]] = row[ARG.PHENOTYPE.upper()]
-        colrange = range(first_marker, len(row))
-        idstr = ""
-        for col in colrange:
-            if name[col] in ('23458', '24704', '26835'): #PLUG
-                continue
-            PHENCOL[row[BIRD_COL]][name[col]] = True
-            if len(row[name[col]]) != 3:
-                #LOGGER.warning(f"Invalid allele state {row[name[col]]}")
-                if row[name[col]][-1:] == "/":
-                    row[name[col]] += "."
-                else:
-                    row[name[col]] = "." + row[name[col]]
-            idstr += row[name[col]]
-            PHENCOL[row[BIRD_COL]][name[col]] = row[name[col]] #PLUG
-        key = hashlib.md5(idstr.encode()).hexdigest()
-        #print(idstr[0:30], idstr[-30:], len(colrange)) #PLUG
+    calls = dfrp[markers].to_numpy(dtype=object)
+    short = np.vectorize(len, otypes=[int])(calls) != 3 if calls.size else calls.astype(bool)
+    if short.any():
+        #LOGGER.warning(f"Invalid allele state {row[name[col]]}")
+        fixed = [call + "." if call[-1:] == "/" else "." + call for call in calls[short]]
+        calls[short] = fixed
+    values = dfrp[PHENOTYPES].to_numpy(dtype=object)
+    for bird, pvals, row in tqdm(zip(dfrp[BIRD_COL], values, calls),
+                                 total=dfrp.shape[0], desc="Loading phenotypes"):
+        # Missing values don't get scores
+        pval = {phenotype: val for phenotype, val in zip(PHENOTYPES, pvals) if not pd.isna(val)}
+        PHENVAL[bird] = pval
+        key = hashlib.md5("".join(row).encode()).hexdigest()
         if key in PHENMAP:
-            terminate_program(f"Hash key collision for bird ID {row[BIRD_COL]}")
-        PHENMAP[key] = row[ARG.PHENOTYPE.upper()]
-    LOGGER.info("Markers in phenotype file: %d", len(PHENCOL[0]))
+            terminate_program(f"Hash key collision for bird ID {bird}")
+        PHENMAP[key] = pval
+    # Calls are stored as small integer codes so that a genotype can be
+    # compared against every phenotype bird at once
+    vocab, codes = np.unique(calls.astype(str), return_inverse=True)
+    PHENCOL.update({"birds": dfrp[BIRD_COL].tolist(), "markers": markers,
+                    "codes": codes.reshape(calls.shape).astype(np.int16),
+                    "calls": vocab.tolist(),
+                    "vocab": {call: code for code, call in enumerate(vocab)},
+                    "lookup": {}})
+    LOGGER.info("Markers in phenotype file: %d", len(PHENCOL["markers"]))
 
 
 def convert_band(iband):
@@ -255,6 +521,28 @@ def convert_band(iband):
     return band
 
 
+def get_bird_names(bands, birthdays):
+    """ Build bird names from abbreviated color bands and birth dates
+        (vectorized version of convert_band and the naming in valid_bird)
+        Keyword arguments:
+          bands: Series of abbreviated color bands
+          birthdays: Series of birth dates (MM/DD/YYYY)
+        Returns:
+          Series of bird names (None if a band can't be converted)
+    """
+    field = bands.str.findall(r"([a-z]+|\d+)")
+    convertible = field.str.len() == 4
+    unknown = convertible & ~(field.str[0].isin(COLOR) & field.str[2].isin(COLOR))
+    if unknown.any():
+        bad = field[unknown.idxmax()]
+        terminate_program("Unknown color abbreviation " \
+                          + f"{bad[0] if bad[0] not in COLOR else bad[2]}")
+    band = field.str[0].map(COLOR) + field.str[1] + field.str[2].map(COLOR) + field.str[3]
+    date = birthdays.str.split("/")
+    names = date.str[2] + date.str[0] + date.str[1] + "_" + band
+    return names.where(convertible, None)
+
+
 def valid_bird(row):
     """ Determine if a bird is valid (must exist in db and sex must match)
         Keyword arguments:
@@ -276,11 +564,7 @@ def valid_bird(row):
         LOGGER.error("Bird %s is not in the database", name)
         return None
     row[BIRD_COL] = bid = BIRD[name]
-    try:
-        CURSOR['bird'].execute(READ["BIRD"] % (bid,))
-        bird = CURSOR['bird'].fetchone()
-    except Exception as err:
-        sql_error(err)
+    bird = BIRDID.get(bid)
     if not bird:
         COUNT["missing"] += 1
         LOGGER.error("Bird ID %s is unknown", bid)
@@ -292,90 +576,118 @@ def valid_bird(row):
     return name
 
 
-def process_phenotype(row, term, val=None):
-    """ Process a single phenotype for one bird. This will insert one session and one score.
+def process_phenotype(bid, term, val):
+    """ Process the phenotypes for one bird. Each phenotype gets one session
+        and one score; they're buffered and loaded in bulk by flush_scores.
         Keyword arguments:
-          row: row from input file
+          bid: bird ID
           term: term dictionary
+          val: dictionary of phenotype: value
         Returns:
           None
     """
-    bid = row[BIRD_COL]
-    bind = (bid, term["phenotype"][ARG.PHENOTYPE.lower()], bid, 2)
-    LOGGER.debug(WRITE["SESSION"], bind)
-    try:
-        CURSOR['bird'].execute(WRITE["SESSION"], bind)
-        session_id = CURSOR['bird'].lastrowid
-        COUNT["session"] += 1
-    except Exception as err:
-        sql_error(err)
-    if not val:
-        val = row[ARG.PHENOTYPE.upper()]
-    bind = (session_id, term["phenotype"][ARG.PHENOTYPE.lower()], val)
-    good_val = False
-    try:
-        float(val)
-        good_val = True
-    except ValueError:
-        LOGGER.warning("Invalid %s (%s) for bird ID %s", ARG.PHENOTYPE.upper(), val, bid)
-        COUNT["phenotype"] += 1
-    except Exception as err:
-        LOGGER.warning("Invalid %s (%s) for bird ID %s", ARG.PHENOTYPE.upper(), val, bid)
-        sys.exit(-1)
-    if good_val:
-        LOGGER.debug(WRITE["SCORE"], bind)
+    for phenotype, pval in val.items():
+        valid = False
         try:
-            CURSOR['bird'].execute(WRITE["SCORE"], bind)
-            COUNT["score"] += 1
+            float(pval)
+            valid = True
+        except ValueError:
+            LOGGER.warning("Invalid %s (%s) for bird ID %s", phenotype, pval, bid)
+            COUNT["phenotype"] += 1
         except Exception as err:
-            sql_error(err)
+            LOGGER.warning("Invalid %s (%s) for bird ID %s", phenotype, pval, bid)
+            sys.exit(-1)
+        SCORES.append((bid, term["phenotype"][phenotype.lower()], pval, valid))
 
 
-def compare_calls(row, name, colrange):
-    idstr = ""
-    for col in colrange:
-        idstr += row[name[col]]
-    #LOGGER.info("%s %s %s", idstr[0:30], idstr[-30:], len(colrange))
-    for comp in PHENCOL:
-        message = []
-        bdcol = {}
-        for col in colrange:
-            bdcol[name[col]] = True
-            if row[name[col]] != PHENCOL[comp][name[col]]:
-                message.append(f"Marker {name[col]} mismatch " \
-                               + f"{row[name[col]]} != {PHENCOL[comp][name[col]]}")
-                if len(message) >= LIMIT:
-                    break
-        if len(message) >= LIMIT:
-            continue
-        if not message:
+def primary_phenotype():
+    """ Return the phenotype column carried in the analyzed output
+        Keyword arguments:
+          None
+        Returns:
+          Column name
+    """
+    return PHENOTYPES[0] if PHENOTYPES else ARG.PHENOTYPE[0].upper()
+
+
+def phenotype_lookup(markers):
+    """ Return the phenotype file index for a set of genotype markers: the
+        phenotype file codes in genotype marker order, and an exact-match
+        hash of each phenotype bird's calls. Built once per marker set.
+        Keyword arguments:
+          markers: list of marker names
+        Returns:
+          Lookup dictionary
+    """
+    key = tuple(markers)
+    if key in PHENCOL["lookup"]:
+        return PHENCOL["lookup"][key]
+    column = {marker: col for col, marker in enumerate(PHENCOL["markers"])}
+    missing = [marker for marker in markers if marker not in column]
+    if missing:
+        terminate_program(f"Marker {missing[0]} is not in the phenotype file")
+    codes = np.ascontiguousarray(PHENCOL["codes"][:, [column[marker] for marker in markers]])
+    exact = {}
+    for row, bcodes in enumerate(codes):
+        exact.setdefault(bcodes.tobytes(), row)
+    PHENCOL["lookup"][key] = {"codes": codes, "exact": exact,
+                              "extra": [marker for marker in PHENCOL["markers"]
+                                        if marker not in set(markers)]}
+    return PHENCOL["lookup"][key]
+
+
+def compare_calls(calls, markers):
+    """ Find the phenotype file bird with the same calls as a genotyped bird.
+        The first phenotype file bird with fewer than LIMIT mismatches wins.
+        A bird with no such match is counted as a mismatch.
+        Keyword arguments:
+          calls: list of calls
+          markers: list of marker names
+        Returns:
+          Dictionary of phenotype: value (or None)
+    """
+    lookup = phenotype_lookup(markers)
+    unknown = len(PHENCOL["vocab"])
+    gcodes = np.fromiter((PHENCOL["vocab"].get(call, unknown) for call in calls),
+                         dtype=np.int16, count=len(calls))
+    # An exact match only has to be checked against the birds before it
+    stop = lookup["exact"].get(gcodes.tobytes(), len(lookup["codes"]))
+    mismatches = (lookup["codes"][:stop] != gcodes).sum(axis=1)
+    close = np.flatnonzero(mismatches < LIMIT)
+    if not close.size:
+        if stop < len(lookup["codes"]):
             COUNT["seq_match"] += 1
-            return PHENVAL[comp]
-        for key in bdcol:
-            if key not in PHENCOL[comp]:
-                LOGGER.error("%s is in bd but not in Genetic", key)
-        for key in PHENCOL[comp]:
-            if key not in bdcol:
-                LOGGER.error("%s is in Genetic but not in bd", key)
-        LOGGER.info("\n".join(message))
-        if len(message) < LIMIT: # Permissive
-            COUNT["seq_close"] += 1
-            return PHENVAL[comp]
-    COUNT["seq_mismatch" if len(message) > LIMIT else "seq_close"] += 1
-    return None
-
-
-def process_genotype(row, term, name, first_marker):
-    """ Process a single genotype for one bird. This will insert one session and one state.
+            return PHENVAL[PHENCOL["birds"][stop]]
+        COUNT["seq_mismatch"] += 1
+        return None
+    comp = close[0]
+    if not mismatches[comp]:
+        COUNT["seq_match"] += 1
+        return PHENVAL[PHENCOL["birds"][comp]]
+    for key in lookup["extra"]:
+        LOGGER.error("%s is in Genetic but not in bd", key)
+    phencodes = lookup["codes"][comp]
+    message = [f"Marker {markers[col]} mismatch " \
+               + f"{calls[col]} != {PHENCOL['calls'][phencodes[col]]}"
+               for col in np.flatnonzero(phencodes != gcodes)]
+    LOGGER.info("\n".join(message))
+    COUNT["seq_close"] += 1
+    return PHENVAL[PHENCOL["birds"][comp]]
+
+
+def process_genotype(bid, calls, term, markers, qc, ptype):
+    """ Process a single genotype for one bird. This will insert one session,
+        its states, and its QC scores.
         Keyword arguments:
-          row: row from input file
+          bid: bird ID
+          calls: list of calls
           term: term dictionary
-          name: list of column names
-          first_marker: number of first marker column
+          markers: list of marker names
+          qc: dictionary of genotype QC term: value
+          ptype: phenotype values from compare_calls (or None)
         Returns:
-          None
+          Dictionary of phenotype values from the phenotype file (or None)
     """
-    bid = row[BIRD_COL]
     # Write session
     if ARG.SKIP:
         COUNT["session"] += 1
@@ -386,61 +698,138 @@ def process_genotype(row, term, name, first_marker):
             CURSOR['bird'].execute(WRITE["SESSION"], bind)
             session_id = CURSOR['bird'].lastrowid
             COUNT["session"] += 1
+            if LEDGER["hash"]:
+                CURSOR['bird'].execute(WRITE["LEDGER"], (bid, LEDGER["hash"], session_id))
+                LEDGER["birds"].add(bid)
         except Exception as err:
             sql_error(err)
     # Write allelic states
-    seq_count = 0
-    colrange = range(first_marker, len(row))
-    ptype = None
-    if PHENCOL:
-        ptype = compare_calls(row, name, colrange)
-    idstr = ""
-    for col in colrange:
-        idstr += row[name[col]]
-        if len(row[name[col]]) != 3:
-            LOGGER.warning("Invalid allele state %s", {row[name[col]]})
-        if row[name[col]] != "./.":
-            seq_count += 1
-        if ARG.SKIP:
-            COUNT["state"] += 1
-        else:
-            bind = (session_id, name[col], row[name[col]])
-            LOGGER.debug(WRITE["STATE"], bind)
-            try:
-                CURSOR['bird'].execute(WRITE["STATE"], bind)
-                COUNT["state"] += 1
-            except Exception as err:
-                sql_error(err)
     if ARG.SKIP:
+        COUNT["state"] += len(calls)
         return None
-    # Write sequenced count
-    bind = (session_id, term["genotype"]["markers_sequenced"], seq_count)
+    if ARG.PACKED:
+        BLOBS.append((session_id, PACKED["set"]) + encode_calls(calls))
+        PACKED["calls"] += len(calls)
+    else:
+        STATES.extend(zip([session_id] * len(calls), markers, calls))
+    # Write QC scores
+    bind = [(session_id, term["genotype"][key], val) for key, val in qc.items()]
     LOGGER.debug(WRITE["SCORE"], bind)
     try:
-        CURSOR['bird'].execute(WRITE["SCORE"], bind)
-        COUNT["score"] += 1
+        CURSOR['bird'].executemany(WRITE["SCORE"], bind)
+        COUNT["score"] += len(bind)
     except Exception as err:
         sql_error(err)
     # Process phenotype
     if ptype:
-        process_phenotype(row, term, ptype)
+        process_phenotype(bid, term, ptype)
     else:
-        key = hashlib.md5(idstr.encode()).hexdigest()
+        key = hashlib.md5("".join(calls).encode()).hexdigest()
         if key in PHENMAP:
-            process_phenotype(row, term, PHENMAP[key])
+            process_phenotype(bid, term, PHENMAP[key])
+    if len(STATES) + PACKED["calls"] >= ARG.BATCH:
+        commit_batch()
     return ptype
 
 
-def perform_analysis(dfr):
-    """ Analyze dataframe
+def genotype_summary(calls):
+    """ Compute QC counts for a birds x markers array of calls in one pass.
+        Each distinct call is split into its alleles once, and the results
+        are mapped back over the whole array.
         Keyword arguments:
-          dfr: dataframe
+          calls: array of calls
+        Returns:
+          Per-bird dictionary of BIRD_QC term: array
+          Per-marker array of counts (called, missing, heterozygous, then
+          one column per allele in ALLELES)
+    """
+    codes, uniques = pd.factorize(calls.ravel())
+    codes = codes.reshape(calls.shape)
+    # Missing values get code -1, which picks the trailing all-zero entry
+    table = np.zeros((len(uniques) + 1, 2 + len(ALLELES)), dtype=np.int64)
+    for pos, call in enumerate(uniques):
+        alleles = call.split("/") if isinstance(call, str) else []
+        table[pos, 0] = call == "./."
+        table[pos, 1] = is_het(call)
+        if len(alleles) == 2:
+            table[pos, 2:] = [alleles.count(allele) for allele in ALLELES]
+    missing = table[codes, 0]
+    het = table[codes, 1]
+    called = calls.shape[1] - missing.sum(axis=1)
+    bird = {"markers_sequenced": called, "markers_missing": missing.sum(axis=1),
+            "markers_heterozygous": het.sum(axis=1),
+            "call_rate": np.round(called / max(calls.shape[1], 1), 8)}
+    counts = [calls.shape[0] - missing.sum(axis=0), missing.sum(axis=0), het.sum(axis=0)]
+    for col in range(len(ALLELES)):
+        counts.append(table[codes, 2 + col].sum(axis=0))
+    return bird, np.stack(counts, axis=1)
+
+
+def add_summary(fhash, markers, birds, counts):
+    """ Add a frame's per-marker QC counts to its source file's totals
+        Keyword arguments:
+          fhash: content hash of the source file
+          markers: list of marker names
+          birds: number of birds counted
+          counts: per-marker counts from genotype_summary
         Returns:
           None
     """
+    if fhash not in SUMMARY:
+        SUMMARY[fhash] = {"markers": markers, "birds": 0, "counts": np.zeros_like(counts)}
+    elif SUMMARY[fhash]["markers"] != markers:
+        terminate_program("Marker columns changed within a file")
+    SUMMARY[fhash]["birds"] += birds
+    SUMMARY[fhash]["counts"] += counts
+
+
+def write_summary(fhash):
+    """ Write a source file's per-marker QC summary, replacing any earlier
+        summary of the same file
+        Keyword arguments:
+          fhash: content hash of the source file
+        Returns:
+          None
+    """
+    summary = SUMMARY.pop(fhash, None)
+    if not summary or ARG.SKIP:
+        return
+    birds, counts = summary["birds"], summary["counts"]
+    rate = np.round(counts[:, 0] / max(birds, 1), 8)
+    if len(rate):
+        LOGGER.info("Mean marker call rate: %.4f", rate.mean())
+    bind = [(fhash, marker, birds) + tuple(counts[pos].tolist()) + (rate[pos].item(),)
+            for pos, marker in enumerate(summary["markers"])]
+    try:
+        CURSOR['bird'].executemany(WRITE["SUMMARY"], bind)
+    except Exception as err:
+        sql_error(err)
+
+
+def validate_frame(dfr):
+    """ Validate a genotype dataframe. Bands, sexes, names, and validity are
+        computed for all birds at once; rows that fail validation are
+        rechecked one at a time by valid_bird to report why. Valid birds are
+        matched against the phenotype file. A bird that appears more than
+        once is only loaded from its first row. Nothing is written to the
+        database, so this can run in a worker process.
+        Keyword arguments:
+          dfr: dataframe
+        Returns:
+          Frame dictionary:
+            dfr: output dataframe (with IND_NAME and phenotype columns)
+            delete: index of invalid rows
+            markers: list of marker names
+            index: index of valid rows
+            bids: bird IDs for valid rows
+            calls: valid rows x markers array of calls
+            qc: per-bird QC arrays for valid rows (from genotype_summary)
+            counts: per-marker QC counts over valid rows
+            ptype: phenotype file values for valid rows
+    """
     newdfr = dfr.copy()
     newdfr.insert(8, "IND_NAME", None)
-    newdfr.insert(10, ARG.PHENOTYPE.upper(), None)
+    newdfr.insert(10, primary_phenotype(), None)
     name = list(dfr.columns)
     #PLUG
     #if ARG.PHENOTYPE.upper() not in name:
@@ -448,59 +837,251 @@ def perform_analysis(dfr):
     #first_marker = name.index(ARG.PHENOTYPE.upper()) + 1
     first_marker = name.index("SEX") + 1 #PLUG
     LOGGER.info("Markers: %d", (len(name) - first_marker))
+    COUNT["read"] += dfr.shape[0]
+    bands = dfr[BIRD_COL].str.replace("yw", "ye", regex=False)
+    sex = dfr['SEX'].where(dfr['SEX'] != ".", "U")
+    names = get_bird_names(bands, dfr[BDAY_COL])
+    bids = names.map(BIRD).astype("Int64")
+    valid = bands.isin(BAND) & bids.notna()
+    dbsex = bids.map(lambda bid: BIRDID[bid]["sex"] if bid in BIRDID else None,
+                     na_action="ignore")
+    valid &= dbsex.eq(sex).fillna(False).astype(bool)
+    to_delete = dfr.index[~valid].tolist()
+    for idx in to_delete:
+        # valid_bird logs the reason and updates the counts
+        row = dfr.loc[idx].copy()
+        row[BIRD_COL], row['SEX'] = bands[idx], sex[idx]
+        valid_bird(row)
+    # The ledger allows one session per bird and file
+    duplicate = bids.where(valid).duplicated() & valid
+    for idx in dfr.index[duplicate]:
+        COUNT["duplicate"] += 1
+        LOGGER.warning("Bird %s appears more than once, so only its first row is loaded",
+                       names[idx])
+    valid &= ~duplicate
+    to_delete.extend(dfr.index[duplicate])
+    newdfr[BIRD_COL] = newdfr[BIRD_COL].astype(object)
+    newdfr.loc[valid, BIRD_COL] = bids[valid].astype(object)
+    newdfr.loc[valid, "IND_NAME"] = names[valid]
+    COUNT["processed"] += int(valid.sum())
+    markers = name[first_marker:]
+    calls = dfr.loc[valid].iloc[:, first_marker:].to_numpy(dtype=object)
+    qc, counts = genotype_summary(calls)
+    for call in calls[np.vectorize(len, otypes=[int])(calls) != 3] if calls.size else []:
+        LOGGER.warning("Invalid allele state %s", {call})
+    ptype = [compare_calls(row.tolist(), markers) for row in calls] \
+            if PHENCOL.get("birds") else [None] * len(calls)
+    return {"dfr": newdfr, "delete": to_delete, "markers": markers,
+            "index": dfr.index[valid], "bids": bids[valid].astype(int).tolist(),
+            "calls": calls, "qc": qc, "counts": counts, "ptype": ptype}
+
+
+def load_frame(frame, fhash=None):
+    """ Write the sessions, states, and scores for a validated dataframe.
+        Birds that the ledger shows were already loaded from the same file
+        are skipped.
+        Keyword arguments:
+          frame: frame dictionary from validate_frame
+          fhash: content hash of the source file (or None to disable the ledger)
+        Returns:
+          Dataframe of valid birds
+    """
     term = get_terms()
-    to_delete = []
-    for idx, row in tqdm(dfr.iterrows(), total=dfr.shape[0], desc="Analyzing"):
-        COUNT["read"] += 1
-        if "yw" in row[BIRD_COL]:
-            row[BIRD_COL] = row[BIRD_COL].replace("yw", "ye")
-        if row['SEX'] == ".":
-            row['SEX'] = "U"
-        birdname = valid_bird(row)
-        if not birdname:
-            to_delete.append(idx)
-            continue
-        newdfr.at[idx, BIRD_COL] = row[BIRD_COL]
-        newdfr.at[idx, "IND_NAME"] = birdname
-        COUNT["processed"] += 1
-        ptype = process_genotype(row, term, name, first_marker)
-        if ptype:
-            newdfr.at[idx, ARG.PHENOTYPE.upper()] = ptype
-    if to_delete:
-        newdfr = newdfr.drop(labels=to_delete, axis=0)
+    missing = [key for key in BIRD_QC if key not in term.get("genotype", {})]
+    if missing:
+        terminate_program(f"Genotype term {missing[0]} is not in the database")
+    if fhash:
+        add_summary(fhash, frame["markers"], len(frame["bids"]), frame["counts"])
+    if fhash != LEDGER["hash"]:
+        read_ledger(fhash)
+    if ARG.PACKED and not ARG.SKIP:
+        PACKED["set"] = get_marker_set(frame["markers"])
+    newdfr = frame["dfr"]
+    for pos, idx in enumerate(tqdm(frame["index"], desc="Analyzing")):
+        if frame["bids"][pos] in LEDGER["birds"]:
+            COUNT["loaded"] += 1
+            ptype = frame["ptype"][pos]
+        else:
+            qc = {key: frame["qc"][key][pos].item() for key in BIRD_QC}
+            ptype = process_genotype(frame["bids"][pos], frame["calls"][pos].tolist(), term,
+                                     frame["markers"], qc, frame["ptype"][pos])
+        if ptype and primary_phenotype() in ptype:
+            newdfr.at[idx, primary_phenotype()] = ptype[primary_phenotype()]
+    commit_batch()
+    return newdfr.drop(labels=frame["delete"], axis=0)
+
+
+def perform_analysis(dfr, stream=None, fhash=None):
+    """ Analyze dataframe
+        Keyword arguments:
+          dfr: dataframe
+          stream: open analyzed TSV to append valid birds to (default is analyzed.pkl)
+          fhash: content hash of the source file (or None to disable the ledger)
+        Returns:
+          None
+    """
+    frame = validate_frame(dfr)
+    newdfr = load_frame(frame, fhash)
+    if stream:
+        newdfr.to_csv(stream, sep="\t", index=False, header=not stream.tell())
+        return
+    write_summary(fhash)
+    if frame["delete"]:
         newdfr.to_pickle("analyzed.pkl")
 
 
+def parse_file(path):
+    """ Read and validate one genotype file (run in a worker process)
+        Keyword arguments:
+          path: genotype file
+        Returns:
+          Frame dictionary from validate_frame, plus the file name and the
+          changes it made to COUNT
+    """
+    before = dict(COUNT)
+    LOGGER.info("Reading %s", path)
+    try:
+        frame = validate_frame(read_frame(path, cache=ARG.CACHE))
+    except SystemExit as err:
+        # A pool doesn't pass SystemExit back to the parent, which would wait forever
+        raise RuntimeError(f"Could not process {path}") from err
+    frame["file"] = path
+    frame["hash"] = source_hash(path)
+    frame["count"] = {key: COUNT[key] - before[key] for key in COUNT}
+    return frame
+
+
+def ingest_files(files):
+    """ Parse and validate genotype files in a pool of ARG.WORKERS processes.
+        This process is the only writer: frames are loaded one file at a
+        time, in file order, as they become available. If a file can't be
+        processed, the pool is terminated.
+        Keyword arguments:
+          files: list of genotype files
+        Returns:
+          None
+    """
+    pool = multiprocessing.Pool(ARG.WORKERS) if ARG.WORKERS > 1 else None
+    analyzed = []
+    frames = pool.imap(parse_file, files) if pool else map(parse_file, files)
+    try:
+        while True:
+            try:
+                frame = next(frames)
+            except StopIteration:
+                break
+            except Exception as err:
+                if pool:
+                    pool.terminate()
+                terminate_program(str(err))
+            if pool:
+                for key, val in frame["count"].items():
+                    COUNT[key] += val
+            LOGGER.info("Loading %d birds from %s", len(frame["index"]), frame["file"])
+            analyzed.append(load_frame(frame, frame["hash"]))
+            write_summary(frame["hash"])
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    pd.concat(analyzed, ignore_index=True).to_pickle("analyzed.pkl")
+
+
+def stream_data_frame(path, stream):
+    """ Read and process a genotype TSV in chunks of ARG.CHUNK rows. Marker
+        columns are read as categoricals (one byte per call), and each chunk
+        is validated and loaded before the next one is read.
+        Keyword arguments:
+          path: genotype file
+          stream: open analyzed TSV to append valid birds to
+        Returns:
+          None
+    """
+    if path.endswith((".pk", ".pkl", ".feather", ".arrow")):
+        terminate_program("--chunk requires a TSV file")
+    name = list(pd.read_csv(path, header=0, delimiter="\t", nrows=0).columns)
+    dtype = {marker: "category" for marker in name[name.index("SEX") + 1:]} #PLUG
+    birds = set()
+    read = COUNT["read"]
+    fhash = source_hash(path)
+    for dfr in pd.read_csv(path, header=0, delimiter="\t", dtype=dtype, chunksize=ARG.CHUNK):
+        birds.update(dfr[BIRD_COL])
+        perform_analysis(dfr, stream, fhash)
+    write_summary(fhash)
+    LOGGER.info("Dimensions: %dx%d", COUNT["read"] - read, len(name))
+    LOGGER.info("Birds: %d", len(birds))
+
+
+def input_files(paths):
+    """ Expand directories in a list of input paths
+        Keyword arguments:
+          paths: list of files and directories
+        Returns:
+          list of files
+    """
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        found = sorted(os.path.join(path, fname) for fname in os.listdir(path)
+                       if fname.endswith((".tsv", ".pk", ".pkl", ".feather", ".arrow")))
+        if not found:
+            LOGGER.warning("No genotype files in %s", path)
+        files.extend(found)
+    if not files:
+        terminate_program("No genotype files to process")
+    return files
+
+
 def process_data_frame():
-    """ Read CSV or pickle file in to a dataframe, then process it.
-        If we read in a CSV file, save it as a pickle.
+    """ Read the input files (TSVs go through the frame cache) in to
+        dataframes, then process them.
         Keyword arguments:
           None
         Returns:
           None
     """
-    print(f"Processing {ARG.FILE} for phenotype {ARG.PHENOTYPE.lower()}")
+    files = input_files(ARG.FILE)
+    print(f"Processing {', '.join(files)} for phenotype {', '.join(ARG.PHENOTYPE).lower()}")
     if ARG.PHENFILE:
         process_phenotype_file()
-    LOGGER.info("Reading %s", ARG.FILE)
-    if ARG.FILE.endswith(".pk") or ARG.FILE.endswith(".pkl"):
-        dfr = pd.read_pickle(ARG.FILE)
-    else:
-        dfr = pd.read_csv(ARG.FILE, header=0, delimiter="\t")
-        newname = ARG.FILE.replace("." + ARG.FILE.split(".")[-1], ".pkl")
-        if newname == ARG.FILE:
-            newname += ".pkl"
-        LOGGER.info("Saving dataframe to %s", newname)
-        dfr.to_pickle(newname)
-    LOGGER.info("Dimensions: %dx%d", dfr.shape[0], dfr.shape[1])
-    LOGGER.info("Birds: %d", len(dfr[BIRD_COL].unique()))
-    perform_analysis(dfr)
-    if ARG.WRITE:
-        CONN['bird'].commit()
+    single = len(files) == 1 and not ARG.CHUNK and ARG.WORKERS <= 1
+    if single:
+        LOGGER.info("Reading %s", files[0])
+        dfr = read_frame(files[0], cache=ARG.CACHE)
+        LOGGER.info("Dimensions: %dx%d", dfr.shape[0], dfr.shape[1])
+        LOGGER.info("Birds: %d", len(dfr[BIRD_COL].unique()))
+    restore = defer_indexes() if ARG.DEFER else []
+    try:
+        if single:
+            perform_analysis(dfr, fhash=source_hash(files[0]))
+        elif ARG.CHUNK:
+            with open("analyzed.tsv", "w", encoding="ascii") as stream:
+                for path in files:
+                    LOGGER.info("Reading %s", path)
+                    stream_data_frame(path, stream)
+        else:
+            ingest_files(files)
+        if ARG.WRITE:
+            CONN['bird'].commit()
+    except BaseException:
+        # Restoring indexes commits implicitly, so the failed batch has to
+        # be rolled back first
+        try:
+            CONN['bird'].rollback()
+        except Exception as err:
+            LOGGER.error("Could not roll back: %s", err)
+        raise
+    finally:
+        if ARG.DEFER:
+            restore_indexes(restore)
     print(f"Birds read:          {COUNT['read']}")
     print(f"Birds not in db:     {COUNT['missing']}")
     print(f"Sex mismatch:        {COUNT['sex']}")
     print(f"Birds processed:     {COUNT['processed']}")
+    print(f"Duplicate birds:     {COUNT['duplicate']}")
+    print(f"Already loaded:      {COUNT['loaded']}")
     print(f"Sessions written:    {COUNT['session']}")
     print(f"Scores written:      {COUNT['score']}")
     print(f"Invalid phenotypes:  {COUNT['phenotype']}")
@@ -514,17 +1095,33 @@ def process_data_frame():
 
 if __name__ == '__main__':
     PARSER = argparse.ArgumentParser(description="Load allelic states and phenotypes")
-    PARSER.add_argument('--file', dest='FILE', action='store',
-                        help='File', required=True)
+    PARSER.add_argument('--file', dest='FILE', action='store', nargs='+',
+                        help='Genotype files or directories', required=True)
     PARSER.add_argument('--phenfile', dest='PHENFILE', action='store',
                         help='Phenotype file')
+    PARSER.add_argument('--workers', dest='WORKERS', action='store', type=int, default=1,
+                        help='Processes for parsing and validating files [1]')
+    PARSER.add_argument('--chunk', dest='CHUNK', action='store', type=int, default=0,
+                        help='Stream the genotype TSV in chunks of this many birds')
+    PARSER.add_argument('--cache', dest='CACHE', action='store',
+                        help='Cache directory for TSV input [.frame_cache next to the file]')
     PARSER.add_argument('--species', dest='SPECIES', action='store',
                         default='Bengalese finch', help='Species [Bengalese finch]')
-    PARSER.add_argument('--phenotype', dest='PHENOTYPE', action='store',
-                        default='median_tempo', help='Phenotype [median_tempo]')
+    PARSER.add_argument('--phenotype', dest='PHENOTYPE', action='store', nargs='+',
+                        default=['median_tempo'],
+                        help='Phenotypes, or "all" for every phenotype column [median_tempo]')
     PARSER.add_argument('--manifold', dest='MANIFOLD', action='store',
                         default='dev', choices=["dev", "prod"],
                         help='Manifold')
+    PARSER.add_argument('--batch', dest='BATCH', action='store', type=int,
+                        default=50000, help='Allelic states per load and commit batch [50000]')
+    PARSER.add_argument('--packed', dest='PACKED', action='store_true',
+                        default=False, help='Store each genotype as one packed genotype_blob row')
+    PARSER.add_argument('--infile', dest='INFILE', action='store_true',
+                        default=False, help='Load allelic states with LOAD DATA LOCAL INFILE')
+    PARSER.add_argument('--defer', dest='DEFER', action='store_true',
+                        default=False, help='Defer state index maintenance until after the load '
+                                            + '(requires --write)')
     PARSER.add_argument('--skip', dest='SKIP', action='store_true',
                         default=False, help='Skip state processing')
     PARSER.add_argument('--write', dest='WRITE', action='store_true',
@@ -534,6 +1131,12 @@ if __name__ == '__main__':
     PARSER.add_argument('--debug', dest='DEBUG', action='store_true',
                         default=False, help='Flag, Very chatty')
     ARG = PARSER.parse_args()
+    if ARG.DEFER and not ARG.WRITE:
+        PARSER.error("--defer requires --write (index changes can't be rolled back)")
+    if "all" in ARG.PHENOTYPE and not ARG.PHENFILE:
+        PARSER.error("--phenotype all requires --phenfile")
+    if ARG.CHUNK and ARG.WORKERS > 1:
+        PARSER.error("--chunk can't be used with --workers")
     LOGGER = colorlog.getLogger()
     ATTR = colorlog.colorlog.logging if "colorlog" in dir(colorlog) else colorlog
     if ARG.DEBUG:
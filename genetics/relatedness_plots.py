@@ -1,5 +1,8 @@
 ''' relatedness_plots.py
-    Generate plots for bird comparisons
+    Generate plots for bird comparisons. With --aggregate, the genotype and
+    phenotype comparisons are joined and binned in the database (or streamed
+    against a similarity matrix store), and only the histogram counts and an
+    optional sample of points are brought back.
 '''
 
 import argparse
@@ -11,6 +14,7 @@ import MySQLdb
 import numpy as np
 import requests
 from tqdm import tqdm
+from similarity_store import condensed_index, get_pair, open_store
 
 # pylint: disable=W0703
 
@@ -19,6 +23,33 @@ CONFIG = {'config': {'url': os.environ.get('CONFIG_SERVER_URL')}}
 # Database
 CONN = {}
 CURSOR = {}
+BLOCK = 100000 # Rows per fetch when streaming comparisons
+PAIRS = "FROM bird_comparison p " \
+        + "JOIN bird b1 ON (b1.id=p.bird1_id AND b1.sex='M') " \
+        + "JOIN bird b2 ON (b2.id=p.bird2_id AND b2.sex='M') "
+# Comparisons are per session pair, so a bird pair with more than one
+# genotype session has several rows of each comparison
+GPAIRS = PAIRS + "JOIN bird_comparison g ON (g.bird1_id=p.bird1_id AND " \
+         + "g.bird1_session_id=p.bird1_session_id AND g.comparison_id=%s AND " \
+         + "g.bird2_id=p.bird2_id AND g.bird2_session_id=p.bird2_session_id) "
+RELATED = "EXISTS(SELECT 1 FROM bird_relationship br WHERE br.subject_id=p.bird1_id " \
+          + "AND br.object_id=p.bird2_id)"
+READ = {"TERM": "SELECT getCvTermId('bird_comparison',%s,'') AS id",
+        "RANGE": "SELECT COUNT(1) AS cnt,MIN(ABS(p.value)) AS xmin,MAX(ABS(p.value)) AS xmax,"
+                 + "MIN(ROUND(g.value,4)) AS ymin,MAX(ROUND(g.value,4)) AS ymax " + GPAIRS
+                 + "WHERE p.comparison_id=%s",
+        "HISTOGRAM": f"SELECT {RELATED} AS related,"
+                     + "LEAST(GREATEST(FLOOR((ABS(p.value)-%s)/%s),0),%s) AS xbin,"
+                     + "LEAST(GREATEST(FLOOR((ROUND(g.value,4)-%s)/%s),0),%s) AS ybin,"
+                     + "COUNT(1) AS cnt "
+                     + GPAIRS + "WHERE p.comparison_id=%s GROUP BY 1,2,3",
+        "SAMPLE": f"SELECT ABS(p.value) AS x,ROUND(g.value,4) AS y,{RELATED} AS related "
+                  + GPAIRS + "WHERE p.comparison_id=%s AND RAND()<%s",
+        "PRANGE": "SELECT COUNT(1) AS cnt,MIN(ABS(p.value)) AS xmin,MAX(ABS(p.value)) AS xmax "
+                  + PAIRS + "WHERE p.comparison_id=%s",
+        "PHENOTYPE": f"SELECT b1.name AS bird1,b2.name AS bird2,ABS(p.value) AS value,"
+                     + f"{RELATED} AS related " + PAIRS + "WHERE p.comparison_id=%s"
+       }
 
 def terminate_program(msg=None):
     """ Log an optional error to output, close files, and exit
@@ -100,13 +131,29 @@ def initialize_program():
     (CONN['bird'], CURSOR['bird']) = db_connect(data['config']['birdsong'][ARG.MANIFOLD])
 
 
+def open_matrix():
+    """ Open the similarity matrix store for the genotype comparison
+        Keyword arguments:
+          None
+        Returns:
+           Similarity matrix store
+    """
+    LOGGER.info("Mapping %s from %s", ARG.GENOTYPE, ARG.MATRIX)
+    store = open_store(ARG.MATRIX)
+    if ARG.GENOTYPE not in store["metrics"]:
+        terminate_program(f"{ARG.GENOTYPE} is not in {ARG.MATRIX}")
+    return store
+
+
 def prefetch_matches(males):
     """ Get a list of genotype comparisons for males
         Keyword arguments:
           males: dict of male birds
         Returns:
-           Dictionary of genotype comparisons
+           Dictionary of genotype comparisons (or a similarity matrix store)
     """
+    if ARG.MATRIX:
+        return open_matrix()
     LOGGER.info("Fetching %s", ARG.GENOTYPE)
     try:
         CURSOR['bird'].execute("SELECT bird1,bird2,value FROM bird_comparison_vw WHERE " \
@@ -127,6 +174,20 @@ def prefetch_matches(males):
     return pdict
 
 
+def genotype_match(ams, bird1, bird2):
+    """ Return the genotype comparison for a pair of birds
+        Keyword arguments:
+          ams: genotype comparisons from prefetch_matches
+          bird1: bird1 name
+          bird2: bird2 name
+        Returns:
+           Comparison value
+    """
+    if ARG.MATRIX:
+        return round(get_pair(ams, ARG.GENOTYPE, bird1, bird2), 4)
+    return round(float(ams[bird1][bird2]), 4)
+
+
 def generate_heatmap(xlist, ylist, title):
     """ Generate a heatmap
         Keyword arguments:
@@ -137,6 +198,19 @@ def generate_heatmap(xlist, ylist, title):
            None
     """
     heatmap, xedges, yedges = np.histogram2d(xlist, ylist, bins=100)
+    plot_heatmap(heatmap, xedges, yedges, title)
+
+
+def plot_heatmap(heatmap, xedges, yedges, title):
+    """ Plot binned counts as a heatmap
+        Keyword arguments:
+          heatmap: X bins x Y bins array of counts
+          xedges: X bin edges
+          yedges: Y bin edges
+          title: graph title
+        Returns:
+           None
+    """
     extent = [xedges[0], xedges[-1], yedges[0], yedges[-1]]
     plt.figure(figsize=(10, 10))
     plt.clf()
@@ -177,6 +251,204 @@ def generate_plots(xpoint, ypoint, xpointr, ypointr, count):
     plt.savefig("heatmap_related.png")
 
 
+def comparison_id(cvt):
+    """ Get the CV term ID for a bird comparison
+        Keyword arguments:
+          cvt: comparison name
+        Returns:
+           CV term ID
+    """
+    try:
+        CURSOR['bird'].execute(READ["TERM"], (cvt,))
+        row = CURSOR['bird'].fetchone()
+    except Exception as err:
+        sql_error(err)
+    if not row or not row["id"]:
+        terminate_program(f"{cvt} is not a bird comparison")
+    return row["id"]
+
+
+def bin_edges(vmin, vmax):
+    """ Return ARG.BINS equal-width bin edges for a range (an empty range
+        is widened the same way np.histogram2d widens it)
+        Keyword arguments:
+          vmin: minimum value
+          vmax: maximum value
+        Returns:
+           array of bin edges
+    """
+    vmin, vmax = float(vmin), float(vmax)
+    if vmin == vmax:
+        vmin, vmax = vmin - 0.5, vmax + 0.5
+    return np.linspace(vmin, vmax, ARG.BINS + 1)
+
+
+def empty_aggregate(xedges, yedges):
+    """ Return an empty aggregate
+        Keyword arguments:
+          xedges: phenotype bin edges
+          yedges: genotype bin edges
+        Returns:
+           Aggregate dictionary: bin edges, and histogram counts and sampled
+           points for related and unrelated pairs
+    """
+    return {"xedges": xedges, "yedges": yedges,
+            "related": np.zeros((ARG.BINS, ARG.BINS)), "unrelated": np.zeros((ARG.BINS, ARG.BINS)),
+            "sample": {"related": ([], []), "unrelated": ([], [])}}
+
+
+def aggregate_database():
+    """ Join the phenotype and genotype comparisons on bird pairs and bin them
+        in the database. Only the bin counts (and ARG.SAMPLE points, if
+        requested) are fetched.
+        Keyword arguments:
+          None
+        Returns:
+           Aggregate dictionary (see empty_aggregate)
+    """
+    gid = comparison_id(ARG.GENOTYPE)
+    pid = comparison_id(ARG.PHENOTYPE)
+    LOGGER.info("Binning %s vs %s", ARG.PHENOTYPE, ARG.GENOTYPE)
+    try:
+        CURSOR['bird'].execute(READ["RANGE"], (gid, pid))
+        span = CURSOR['bird'].fetchone()
+    except Exception as err:
+        sql_error(err)
+    if not span["cnt"]:
+        terminate_program(f"No bird pairs have both {ARG.PHENOTYPE} and {ARG.GENOTYPE}")
+    agg = empty_aggregate(bin_edges(span["xmin"], span["xmax"]),
+                          bin_edges(span["ymin"], span["ymax"]))
+    bind = (agg["xedges"][0], agg["xedges"][1] - agg["xedges"][0], ARG.BINS - 1,
+            agg["yedges"][0], agg["yedges"][1] - agg["yedges"][0], ARG.BINS - 1, gid, pid)
+    try:
+        CURSOR['bird'].execute(READ["HISTOGRAM"], bind)
+        rows = CURSOR['bird'].fetchall()
+    except Exception as err:
+        sql_error(err)
+    for row in rows:
+        agg["related" if row["related"] else "unrelated"][int(row["xbin"]),
+                                                          int(row["ybin"])] += row["cnt"]
+    if not ARG.SAMPLE:
+        return agg
+    try:
+        CURSOR['bird'].execute(READ["SAMPLE"], (gid, pid, ARG.SAMPLE / span["cnt"]))
+        rows = CURSOR['bird'].fetchall()
+    except Exception as err:
+        sql_error(err)
+    for row in rows:
+        xlist, ylist = agg["sample"]["related" if row["related"] else "unrelated"]
+        xlist.append(float(row["x"]))
+        ylist.append(float(row["y"]))
+    return agg
+
+
+def aggregate_matrix(store):
+    """ Stream the phenotype comparisons in blocks of BLOCK rows, look up
+        each block's genotype comparisons in a similarity matrix store, and
+        bin them
+        Keyword arguments:
+          store: similarity matrix store
+        Returns:
+           Aggregate dictionary (see empty_aggregate)
+    """
+    pid = comparison_id(ARG.PHENOTYPE)
+    metric = store["metrics"][ARG.GENOTYPE]
+    try:
+        CURSOR['bird'].execute(READ["PRANGE"], (pid,))
+        span = CURSOR['bird'].fetchone()
+    except Exception as err:
+        sql_error(err)
+    if not span["cnt"]:
+        terminate_program(f"No bird pairs have {ARG.PHENOTYPE}")
+    agg = empty_aggregate(bin_edges(span["xmin"], span["xmax"]),
+                          bin_edges(round(float(np.nanmin(metric)), 4),
+                                    round(float(np.nanmax(metric)), 4)))
+    generator = np.random.default_rng()
+    try:
+        cursor = CONN['bird'].cursor(MySQLdb.cursors.SSDictCursor)
+        cursor.execute(READ["PHENOTYPE"], (pid,))
+        with tqdm(total=span["cnt"], desc=ARG.PHENOTYPE) as pbar:
+            while True:
+                rows = cursor.fetchmany(BLOCK)
+                if not rows:
+                    break
+                pbar.update(len(rows))
+                row1 = np.array([store["index"].get(row["bird1"], -1) for row in rows])
+                row2 = np.array([store["index"].get(row["bird2"], -1) for row in rows])
+                xval = np.array([float(row["value"]) for row in rows])
+                related = np.array([bool(row["related"]) for row in rows])
+                keep = (row1 >= 0) & (row2 >= 0) & (row1 != row2)
+                yval = np.full(len(rows), np.nan)
+                yval[keep] = np.round(metric[condensed_index(len(store["birds"]), row1[keep],
+                                                             row2[keep])].astype(float), 4)
+                keep &= np.isfinite(yval)
+                if ARG.SAMPLE:
+                    sampled = generator.random(len(rows)) < ARG.SAMPLE / span["cnt"]
+                for key, mask in (("related", keep & related), ("unrelated", keep & ~related)):
+                    agg[key] += np.histogram2d(xval[mask], yval[mask],
+                                               bins=[agg["xedges"], agg["yedges"]])[0]
+                    if ARG.SAMPLE:
+                        agg["sample"][key][0].extend(xval[mask & sampled].tolist())
+                        agg["sample"][key][1].extend(yval[mask & sampled].tolist())
+        cursor.close()
+    except Exception as err:
+        sql_error(err)
+    return agg
+
+
+def plot_aggregate(agg, count):
+    """ Generate plots from binned comparisons
+        Keyword arguments:
+          agg: aggregate dictionary
+          count: bird count dictionary
+        Returns:
+           None
+    """
+    print(f"Pairs binned: {int(agg['related'].sum())} (related), "
+          + f"{int(agg['unrelated'].sum())} (unrelated)")
+    if ARG.SAMPLE:
+        xpoint, ypoint = agg["sample"]["unrelated"]
+        xpointr, ypointr = agg["sample"]["related"]
+        print(f"Points sampled: {len(xpointr)} (related), {len(xpoint)} (unrelated)")
+        plt.figure(figsize=(10, 10))
+        plt.scatter(xpoint, ypoint, s=1.5, c="gray",
+                    label=f"{count['unrelated']} unrelated birds")
+        plt.scatter(xpointr, ypointr, s=1.5, c="blue", label=f"{count['related']} related birds")
+        plt.title(f"{ARG.PHENOTYPE} vs {ARG.GENOTYPE} (sample)")
+        plt.xlabel(ARG.PHENOTYPE)
+        plt.ylabel(ARG.GENOTYPE)
+        plt.legend(loc="upper right")
+        plt.savefig("scatterplot.png")
+    plot_heatmap(agg["unrelated"], agg["xedges"], agg["yedges"], f"{count['unrelated']} " \
+                 + f"unrelated birds {ARG.PHENOTYPE} vs {ARG.GENOTYPE}")
+    plt.savefig("heatmap_unrelated.png")
+    plot_heatmap(agg["related"], agg["xedges"], agg["yedges"], f"{count['related']} " \
+                 + f"related birds {ARG.PHENOTYPE} vs {ARG.GENOTYPE}")
+    plt.savefig("heatmap_related.png")
+
+
+def bird_counts():
+    """ Count the phenotyped birds with and without relationships
+        Keyword arguments:
+          None
+        Returns:
+           Bird count dictionary
+    """
+    sql = "SELECT COUNT(1) AS cnt FROM session WHERE " \
+          + f"type_id=getCvTermId('phenotype','{ARG.PHENOTYPE}',NULL)" \
+          + " AND bird_id NOT IN (SELECT subject_id FROM bird_relationship)"
+    count = {}
+    try:
+        CURSOR["bird"].execute(sql)
+        count["unrelated"] = CURSOR['bird'].fetchone()["cnt"]
+        sql = sql.replace("NOT IN", "IN")
+        CURSOR["bird"].execute(sql)
+        count["related"] = CURSOR['bird'].fetchone()["cnt"]
+    except Exception as err:
+        sql_error(err)
+    return count
+
+
 def process_data():
     """ Process comparisons
         Keyword arguments:
@@ -184,6 +456,13 @@ def process_data():
         Returns:
            None
     """
+    if ARG.AGGREGATE:
+        if ARG.MATRIX:
+            agg = aggregate_matrix(open_matrix())
+        else:
+            agg = aggregate_database()
+        plot_aggregate(agg, bird_counts())
+        return
     LOGGER.info("Fetching males")
     # Correction in case any females/unknowns have phenotype measurement
     males = {}
@@ -213,23 +492,11 @@ def process_data():
             continue
         if row["relationship"]:
             xpointr.append(float(row["value"]))
-            ypointr.append(round(float(ams[row["bird1"]][row["bird2"]]), 4))
+            ypointr.append(genotype_match(ams, bird1, bird2))
         else:
             xpoint.append(float(row["value"]))
-            ypoint.append(round(float(ams[row["bird1"]][row["bird2"]]), 4))
-    sql = "SELECT COUNT(1) AS cnt FROM session WHERE " \
-          + f"type_id=getCvTermId('phenotype','{ARG.PHENOTYPE}',NULL)" \
-          + " AND bird_id NOT IN (SELECT subject_id FROM bird_relationship)"
-    count = {}
-    try:
-        CURSOR["bird"].execute(sql)
-        count["unrelated"] = CURSOR['bird'].fetchone()["cnt"]
-        sql = sql.replace("NOT IN", "IN")
-        CURSOR["bird"].execute(sql)
-        count["related"] = CURSOR['bird'].fetchone()["cnt"]
-    except Exception as err:
-        sql_error(err)
-    generate_plots(xpoint, ypoint, xpointr, ypointr, count)
+            ypoint.append(genotype_match(ams, bird1, bird2))
+    generate_plots(xpoint, ypoint, xpointr, ypointr, bird_counts())
 
 
 # *****************************************************************************
@@ -240,6 +507,16 @@ if __name__ == '__main__':
                         default="allele_match_seq", help='Genotype measurement [allele_match_seq]')
     PARSER.add_argument('--phenotype', dest='PHENOTYPE', action='store',
                         default="median_tempo", help='Phenotype [median_tempo]')
+    PARSER.add_argument('--matrix', dest='MATRIX', action='store',
+                        help='Read genotype comparisons from a similarity matrix store')
+    PARSER.add_argument('--aggregate', dest='AGGREGATE', action='store_true',
+                        default=False, help='Bin comparisons in the database instead of '
+                                            + 'fetching every pair')
+    PARSER.add_argument('--bins', dest='BINS', action='store', type=int,
+                        default=100, help='Heatmap bins per axis for --aggregate [100]')
+    PARSER.add_argument('--sample', dest='SAMPLE', action='store', type=int,
+                        default=0, help='Approximate number of points to sample for the '
+                                        + '--aggregate scatterplot [0]')
     PARSER.add_argument('--manifold', dest='MANIFOLD', action='store',
                         default='dev', choices=["dev", "prod"],
                         help='Manifold')
@@ -0,0 +1,322 @@
+''' similarity_engine.py
+    Vectorized genotype similarity for compute_similarity.py. Marker columns
+    are encoded once into an integer allele matrix, and allele match scores
+    are computed for whole blocks of bird pairs with matrix products.
+    Strictly biallelic data is also bit-packed (three bits per call) and
+    scored with XOR/AND and popcounts over 64-bit words. Every metric is
+    derived from the same per-pair counts, so they all come from one sweep.
+'''
+
+from multiprocessing import shared_memory
+import signal
+import numpy as np
+import pandas as pd
+
+MISSING = "./." # Missing allelic call
+WORKER = {} # Shared genotype dictionary for pool workers
+METRICS = ["allele_match_all", "allele_match_seq", "ibs0", "ibs1", "ibs2",
+           "informative_markers", "genomic_relationship"] # bird_comparison CV terms
+POPCOUNT = np.array([bin(val).count("1") for val in range(256)], dtype=np.uint8)
+
+
+def call_score(val1, val2):
+    """ Score a single pair of allelic calls. These are the rules used by
+        the original per-pair comparison, and are used to build lookup tables.
+        Keyword arguments:
+          val1: bird1 call
+          val2: bird2 call
+        Returns:
+          doubled match score (0, 1, or 2), sequenced match flag
+    """
+    if (val1 == val2) and (val1 != MISSING):
+        score = 2
+    else:
+        score = 0
+        v1l = val1.split("/")
+        v2l = val2.split("/")
+        if (v1l[0] != "." and v1l[0] in v2l) or (v1l[1] != "." and v1l[1] in v2l):
+            score = 1
+    seqmatch = val1 != MISSING and val2 != MISSING and val1 == val2
+    return score, seqmatch
+
+
+def is_het(val):
+    """ Determine if a call is heterozygous (two different called alleles)
+        Keyword arguments:
+          val: call
+        Returns:
+          True or False
+    """
+    alleles = val.split("/") if isinstance(val, str) else []
+    return len(alleles) == 2 and "." not in alleles and alleles[0] != alleles[1]
+
+
+def encode_genotypes(dfr, first_marker):
+    """ Encode marker columns into an integer allele matrix
+        Keyword arguments:
+          dfr: dataframe (one row per bird)
+          first_marker: number of first marker column
+        Returns:
+          Genotype dictionary:
+            codes: birds x markers matrix of call codes
+            vocab: list of calls (indexed by code)
+            sequenced: boolean array (indexed by code) of non-missing calls
+            het: boolean array (indexed by code) of heterozygous calls
+            score: doubled match score lookup table (code x code)
+            match: sequenced match lookup table (code x code)
+            markers: number of markers
+            packed: bit planes from pack_genotypes (or None)
+    """
+    calls = dfr.iloc[:, first_marker:].to_numpy()
+    codes, vocab = pd.factorize(calls.ravel())
+    vocab = list(vocab)
+    size = len(vocab)
+    score = np.zeros((size, size), dtype=np.float32)
+    match = np.zeros((size, size), dtype=bool)
+    for idx1, val1 in enumerate(vocab):
+        for idx2, val2 in enumerate(vocab):
+            score[idx1, idx2], match[idx1, idx2] = call_score(val1, val2)
+    dtype = np.uint8 if size <= 256 else np.uint16
+    geno = {"codes": codes.astype(dtype).reshape(calls.shape),
+            "vocab": vocab,
+            "sequenced": np.array([val != MISSING for val in vocab], dtype=bool),
+            "het": np.array([is_het(val) for val in vocab], dtype=bool),
+            "score": score,
+            "match": match,
+            "markers": calls.shape[1]}
+    geno["packed"] = pack_genotypes(geno)
+    return geno
+
+
+def pack_genotypes(geno):
+    """ Pack a biallelic call matrix into bit planes. Each call is stored as
+        two bits (carries first allele, carries second allele) plus a bit in
+        a sequenced-call mask, 64 markers to a word. Packing is only done when
+        it scores exactly like the call lookup tables: every marker must have
+        at most two alleles, no partial calls, and one heterozygous spelling.
+        Keyword arguments:
+          geno: genotype dictionary from encode_genotypes
+        Returns:
+          3 x birds x words uint64 array (first allele, second allele, sequenced)
+          or None if the calls can't be packed
+    """
+    vocab = geno["vocab"]
+    codes = geno["codes"]
+    parts = [val.split("/") if isinstance(val, str) else [] for val in vocab]
+    markers = np.arange(geno["markers"])
+    present = np.zeros((len(vocab), len(markers)), dtype=bool)
+    present[codes, markers] = True
+    ref = np.zeros((len(markers), len(vocab)), dtype=bool)
+    alt = np.zeros((len(markers), len(vocab)), dtype=bool)
+    for marker in markers:
+        alleles = []
+        hets = 0
+        found = np.flatnonzero(present[:, marker])
+        for code in found:
+            if vocab[code] == MISSING:
+                continue
+            if len(parts[code]) != 2 or "." in parts[code]:
+                return None
+            hets += parts[code][0] != parts[code][1]
+            for allele in parts[code]:
+                if allele not in alleles:
+                    alleles.append(allele)
+        if len(alleles) > 2 or hets > 1:
+            return None
+        for code in found:
+            if vocab[code] != MISSING:
+                ref[marker, code] = alleles[0] in parts[code]
+                alt[marker, code] = len(alleles) > 1 and alleles[1] in parts[code]
+    planes = []
+    for plane in (ref[markers, codes], alt[markers, codes], geno["sequenced"][codes]):
+        packed = np.packbits(plane, axis=1, bitorder="little")
+        pad = -packed.shape[1] % 8
+        if pad:
+            packed = np.pad(packed, ((0, 0), (0, pad)))
+        planes.append(np.ascontiguousarray(packed).view(np.uint64))
+    return np.stack(planes)
+
+
+def popcount(words):
+    """ Count set bits along the last axis
+        Keyword arguments:
+          words: uint64 array
+        Returns:
+          int64 array of bit counts
+    """
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    return POPCOUNT[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+def packed_counts(geno, rows1, rows2, hets=False):
+    """ Compute raw match counts for a block of bird pairs from bit planes.
+        Calls are identical when both are sequenced and neither allele bit
+        differs, and share an allele when either allele bit is set in both.
+        Heterozygous calls have both allele bits set.
+        Keyword arguments:
+          geno: genotype dictionary from encode_genotypes
+          rows1: bird1 row indices (or slice)
+          rows2: bird2 row indices (or slice)
+          hets: also count heterozygous calls
+        Returns:
+          Count dictionary (see block_counts)
+    """
+    ref1, alt1, seq1 = (plane[rows1] for plane in geno["packed"])
+    ref2, alt2, seq2 = (plane[rows2] for plane in geno["packed"])
+    shape = (ref1.shape[0], ref2.shape[0])
+    names = ["score", "match", "seqcount"] + (["hethet", "het1", "het2"] if hets else [])
+    counts = {name: np.empty(shape, dtype=np.int64) for name in names}
+    het2 = ref2 & alt2
+    for pos in range(shape[0]):
+        both = seq1[pos] & seq2
+        same = ~((ref1[pos] ^ ref2) | (alt1[pos] ^ alt2)) & both
+        share = (ref1[pos] & ref2) | (alt1[pos] & alt2)
+        counts["match"][pos] = popcount(same)
+        counts["score"][pos] = counts["match"][pos] + popcount(share)
+        counts["seqcount"][pos] = popcount(both)
+        if hets:
+            het1 = ref1[pos] & alt1[pos]
+            counts["hethet"][pos] = popcount(het1 & het2)
+            counts["het1"][pos] = popcount(het1 & seq2)
+            counts["het2"][pos] = popcount(het2 & seq1[pos])
+    return counts
+
+
+def block_counts(geno, rows1, rows2, hets=False):
+    """ Compute raw match counts for a block of bird pairs. Bit planes are
+        used if the calls were packed. Otherwise, counts are summed as floats,
+        which is exact as long as they stay below the mantissa limit.
+        Keyword arguments:
+          geno: genotype dictionary from encode_genotypes
+          rows1: bird1 row indices (or slice)
+          rows2: bird2 row indices (or slice)
+          hets: also count heterozygous calls
+        Returns:
+          Count dictionary (each a bird1 x bird2 int64 array):
+            score: doubled match score
+            match: sequenced matches (identical calls)
+            seqcount: markers sequenced in both birds
+            hethet: markers heterozygous in both birds (if hets)
+            het1: markers heterozygous in bird1 and sequenced in bird2 (if hets)
+            het2: markers heterozygous in bird2 and sequenced in bird1 (if hets)
+    """
+    if geno.get("packed") is not None:
+        return packed_counts(geno, rows1, rows2, hets)
+    dtype = np.float32 if 2 * geno["markers"] < 2 ** 24 else np.float64
+    codes1 = geno["codes"][rows1]
+    codes2 = geno["codes"][rows2]
+    score = np.zeros((codes1.shape[0], codes2.shape[0]), dtype=dtype)
+    match = np.zeros((codes1.shape[0], codes2.shape[0]), dtype=dtype)
+    for code in range(len(geno["vocab"])):
+        ind1 = codes1 == code
+        if not ind1.any():
+            continue
+        ind1 = ind1.astype(dtype)
+        if geno["score"][code].any():
+            score += ind1 @ geno["score"][code].astype(dtype)[codes2].T
+        if geno["match"][code].any():
+            match += ind1 @ geno["match"][code].astype(dtype)[codes2].T
+    seq1 = geno["sequenced"][codes1].astype(dtype)
+    seq2 = geno["sequenced"][codes2].astype(dtype)
+    counts = {"score": score, "match": match, "seqcount": seq1 @ seq2.T}
+    if hets:
+        het1 = geno["het"][codes1].astype(dtype)
+        het2 = geno["het"][codes2].astype(dtype)
+        counts["hethet"] = het1 @ het2.T
+        counts["het1"] = het1 @ seq2.T
+        counts["het2"] = seq1 @ het2.T
+    return {name: np.rint(count).astype(np.int64) for name, count in counts.items()}
+
+
+def pair_metrics(geno, rows1, rows2, metrics=None):
+    """ Compute comparison metrics for a block of bird pairs. IBS (identity by
+        state) counts are over markers sequenced in both birds: IBS2 calls are
+        identical, IBS1 calls share one allele, and IBS0 calls share none. The
+        genomic relationship is twice the KING-robust kinship estimate.
+        Keyword arguments:
+          geno: genotype dictionary from encode_genotypes
+          rows1: bird1 row indices (or slice)
+          rows2: bird2 row indices (or slice)
+          metrics: list of metrics (defaults to geno["metrics"], or the allele matches)
+        Returns:
+          dictionary of metric arrays (each bird1 x bird2); undefined values are NaN
+    """
+    if metrics is None:
+        metrics = geno.get("metrics", METRICS[:2])
+    counts = block_counts(geno, rows1, rows2, "genomic_relationship" in metrics)
+    ibs2 = counts["match"]
+    ibs1 = counts["score"] - 2 * ibs2
+    ibs0 = counts["seqcount"] - ibs1 - ibs2
+    result = {}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for cvt in metrics:
+            if cvt == "allele_match_all":
+                result[cvt] = counts["score"] / 2.0 / geno["markers"] * 100.0
+            elif cvt == "allele_match_seq":
+                # Undefined (NaN) for pairs with no sequenced markers in common
+                result[cvt] = np.where(counts["seqcount"] > 0,
+                                       ibs2 / counts["seqcount"] * 100.0, np.nan)
+            elif cvt == "ibs0":
+                result[cvt] = ibs0
+            elif cvt == "ibs1":
+                result[cvt] = ibs1
+            elif cvt == "ibs2":
+                result[cvt] = ibs2
+            elif cvt == "informative_markers":
+                result[cvt] = counts["seqcount"]
+            elif cvt == "genomic_relationship":
+                # Undefined (NaN) if neither bird has a heterozygous call
+                hets = counts["het1"] + counts["het2"]
+                result[cvt] = np.where(hets > 0, 2.0 * (counts["hethet"] - 2 * ibs0) / hets,
+                                       np.nan)
+    return result
+
+
+def share_genotypes(geno):
+    """ Copy the bit planes (or the call matrix if the calls weren't packed)
+        into shared memory so that pool workers can attach to it instead of
+        receiving a pickled copy.
+        Keyword arguments:
+          geno: genotype dictionary from encode_genotypes
+        Returns:
+          shared memory block (caller must close and unlink it)
+          genotype dictionary for attach_genotypes
+    """
+    key = "codes" if geno.get("packed") is None else "packed"
+    shm = shared_memory.SharedMemory(create=True, size=max(geno[key].nbytes, 1))
+    arr = np.ndarray(geno[key].shape, dtype=geno[key].dtype, buffer=shm.buf)
+    arr[:] = geno[key]
+    shared = {gkey: val for gkey, val in geno.items() if gkey not in ("codes", "packed")}
+    shared["shm"] = {"name": shm.name, "key": key, "shape": geno[key].shape,
+                     "dtype": geno[key].dtype.str}
+    return shm, shared
+
+
+def attach_genotypes(shared):
+    """ Pool initializer: attach to a call matrix in shared memory. Signal
+        handlers inherited from the parent are reset.
+        Keyword arguments:
+          shared: genotype dictionary from share_genotypes
+        Returns:
+          None
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    shm = shared_memory.SharedMemory(name=shared["shm"]["name"])
+    WORKER["shm"] = shm
+    WORKER["geno"] = {key: val for key, val in shared.items() if key != "shm"}
+    WORKER["geno"][shared["shm"]["key"]] = np.ndarray(shared["shm"]["shape"],
+                                                      dtype=shared["shm"]["dtype"],
+                                                      buffer=shm.buf)
+
+
+def score_tile(tile, geno=None):
+    """ Compute comparison metrics for one tile of bird pairs
+        Keyword arguments:
+          tile: (bird1 row indices, first bird2 row, last bird2 row + 1)
+          geno: genotype dictionary (defaults to the one attached by attach_genotypes)
+        Returns:
+          dictionary of metric arrays (see pair_metrics)
+    """
+    rows1, start, stop = tile
+    return pair_metrics(geno or WORKER["geno"], list(rows1), slice(start, stop))
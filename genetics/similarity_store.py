@@ -0,0 +1,169 @@
+''' similarity_store.py
+    On-disk condensed similarity matrices. A store is a directory with one
+    .npy file per comparison holding the upper triangle of the bird x bird
+    matrix (row-major, diagonal excluded), and a birds.json sidecar listing
+    the birds in matrix order and the matrix files. Matrices are
+    memory-mapped, so a pair or a row can be read without loading the file.
+    A rebuilt store gets new file names, and the sidecar is swapped in
+    atomically, so readers never see a truncated matrix. Pairs that haven't been
+    computed are NaN. Marker counts are always stored as float32, which
+    holds every count up to 2**24 exactly; float16 would round counts
+    above 2048.
+'''
+
+import json
+import os
+import uuid
+import numpy as np
+
+SIDECAR = "birds.json"
+COUNTS = ("ibs0", "ibs1", "ibs2", "informative_markers") # Comparisons that are marker counts
+
+
+def condensed_index(count, rows1, rows2):
+    """ Return positions in a condensed matrix for pairs of bird rows
+        Keyword arguments:
+          count: number of birds
+          rows1: bird1 row index (or array of them)
+          rows2: bird2 row index (or array of them)
+        Returns:
+          condensed index (or array of them)
+    """
+    rows1 = np.asarray(rows1, dtype=np.int64)
+    rows2 = np.asarray(rows2, dtype=np.int64)
+    low = np.minimum(rows1, rows2)
+    high = np.maximum(rows1, rows2)
+    return low * (2 * count - low - 1) // 2 + (high - low - 1)
+
+
+def metric_dtype(cvt, dtype):
+    """ Return the matrix dtype for a comparison
+        Keyword arguments:
+          cvt: comparison name
+          dtype: store precision (float32 or float16)
+        Returns:
+          dtype name
+    """
+    return "float32" if cvt in COUNTS else dtype
+
+
+def store_files(data):
+    """ Return the matrix file names listed in a sidecar. Stores written
+        before files were versioned use the comparison name.
+        Keyword arguments:
+          data: sidecar dictionary
+        Returns:
+          dictionary of comparison name to file name
+    """
+    return data.get("files", {cvt: f"{cvt}.npy" for cvt in data["metrics"]})
+
+
+def create_store(path, birds, metrics, dtype="float32"):
+    """ Create an empty store, replacing any store already in the directory.
+        Matrices are written to new files, the sidecar is replaced, and only
+        then are the old files removed. A reader that still has them mapped
+        keeps its copy until it reopens the store.
+        Keyword arguments:
+          path: store directory
+          birds: list of bird names (in matrix order)
+          metrics: list of comparison names
+          dtype: matrix dtype for similarities (float32 or float16)
+        Returns:
+          store dictionary (see open_store)
+    """
+    os.makedirs(path, exist_ok=True)
+    old = {}
+    if os.path.exists(os.path.join(path, SIDECAR)):
+        with open(os.path.join(path, SIDECAR), encoding="ascii") as infile:
+            old = store_files(json.load(infile))
+    version = uuid.uuid4().hex[:12]
+    files = {cvt: f"{cvt}.{version}.npy" for cvt in metrics}
+    size = len(birds) * (len(birds) - 1) // 2
+    for cvt in metrics:
+        mat = np.lib.format.open_memmap(os.path.join(path, files[cvt]), mode="w+",
+                                        dtype=metric_dtype(cvt, dtype), shape=(size,))
+        mat[:] = np.nan
+        mat.flush()
+        del mat
+    # The sidecar is written last, so a partially created store is never opened
+    tmpname = os.path.join(path, SIDECAR + ".tmp")
+    with open(tmpname, "w", encoding="ascii") as outfile:
+        json.dump({"birds": list(birds), "metrics": list(metrics), "dtype": dtype,
+                   "files": files}, outfile)
+    os.replace(tmpname, os.path.join(path, SIDECAR))
+    for fname in old.values():
+        if os.path.exists(os.path.join(path, fname)):
+            os.remove(os.path.join(path, fname))
+    return open_store(path, "r+")
+
+
+def open_store(path, mode="r"):
+    """ Open a store
+        Keyword arguments:
+          path: store directory
+          mode: memory-map mode ("r" or "r+")
+        Returns:
+          store dictionary:
+            birds: list of bird names
+            index: dictionary of bird name to row
+            metrics: dictionary of comparison name to condensed matrix
+    """
+    with open(os.path.join(path, SIDECAR), encoding="ascii") as infile:
+        data = json.load(infile)
+    store = {"birds": data["birds"],
+             "index": {bird: row for row, bird in enumerate(data["birds"])},
+             "metrics": {}}
+    for cvt, fname in store_files(data).items():
+        store["metrics"][cvt] = np.load(os.path.join(path, fname), mmap_mode=mode)
+    return store
+
+
+def get_pair(store, cvt, bird1, bird2):
+    """ Return the value for a pair of birds
+        Keyword arguments:
+          store: store dictionary
+          cvt: comparison name
+          bird1: bird1 name
+          bird2: bird2 name
+        Returns:
+          value (NaN if not computed, None if either bird is unknown or the same)
+    """
+    row1 = store["index"].get(bird1)
+    row2 = store["index"].get(bird2)
+    if row1 is None or row2 is None or row1 == row2:
+        return None
+    return float(store["metrics"][cvt][condensed_index(len(store["birds"]), row1, row2)])
+
+
+def get_row(store, cvt, bird):
+    """ Return the values for one bird against every other bird
+        Keyword arguments:
+          store: store dictionary
+          cvt: comparison name
+          bird: bird name
+        Returns:
+          array of values in matrix order (NaN for the bird itself), or None if unknown
+    """
+    row = store["index"].get(bird)
+    if row is None:
+        return None
+    others = np.arange(len(store["birds"]))
+    values = np.full(len(others), np.nan, dtype=store["metrics"][cvt].dtype)
+    others = others[others != row]
+    values[others] = store["metrics"][cvt][condensed_index(len(store["birds"]), row, others)]
+    return values
+
+
+def put_block(store, cvt, row, cols, values):
+    """ Write the values for one bird against a set of other birds
+        Keyword arguments:
+          store: store dictionary (opened with mode "r+")
+          cvt: comparison name
+          row: bird1 row index
+          cols: array of bird2 row indices
+          values: array of values
+        Returns:
+          None
+    """
+    keep = cols != row
+    store["metrics"][cvt][condensed_index(len(store["birds"]), row, cols[keep])] = values[keep]
@@ -0,0 +1,9 @@
+''' conftest.py
+    The genetics scripts are run from their own directory, so make them
+    importable from the tests.
+'''
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
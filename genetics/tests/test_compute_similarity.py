@@ -0,0 +1,452 @@
+''' test_compute_similarity.py
+    Tests for compute_similarity.py. The database cursor is replaced by a
+    fake that records the comparisons that would be inserted.
+'''
+
+import gzip
+import importlib
+import logging
+from argparse import Namespace
+import numpy as np
+import pandas as pd
+import pytest
+import compute_similarity
+from similarity_store import open_store
+from test_similarity_engine import compute_percent_match
+
+
+class FakeCursor:
+    """ Cursor that answers CV term lookups and records inserts """
+    def __init__(self, fail_after=None):
+        self.inserted = []
+        self.batches = []
+        self.fail_after = fail_after
+
+    def execute(self, sql, args=None):
+        """ Accept a query """
+        self.sql = sql
+
+    def fetchone(self):
+        """ Every bird_comparison term exists """
+        return {"id": 1}
+
+    def fetchall(self):
+        """ There are no relationships """
+        return []
+
+    def executemany(self, sql, rows):
+        """ Record inserted rows, failing after fail_after batches """
+        if len(self.batches) == self.fail_after:
+            raise RuntimeError("Lost connection")
+        self.batches.append((sql, len(rows)))
+        self.inserted.extend(rows)
+
+
+class FakeConnection:
+    """ Connection that counts commits and streams prior comparisons """
+    def __init__(self, prior=()):
+        self.commits = 0
+        self.prior = list(prior)
+
+    def commit(self):
+        """ Count a commit """
+        self.commits += 1
+
+    def cursor(self, cursorclass=None):
+        """ Prior comparisons are streamed from this connection """
+        return self
+
+    def execute(self, sql, args=None):
+        """ Accept a query """
+        self.sql = sql
+
+    def fetchmany(self, size):
+        """ Return the next prior comparisons """
+        rows, self.prior = self.prior[:size], self.prior[size:]
+        return rows
+
+    def close(self):
+        """ Nothing to close """
+
+
+def make_frame(path, birds=30, markers=120, nameless=(), missing=()):
+    """ Write an analyzed genotype file
+        Keyword arguments:
+          path: output file
+          birds: number of birds
+          markers: number of markers
+          nameless: rows with no IND_NAME
+          missing: rows with no phenotype
+        Returns:
+          None
+    """
+    rng = np.random.default_rng(7)
+    calls = np.array(["C/C", "C/G", "G/G", "./.", "A/T", "T/T"])
+    dfr = pd.DataFrame({"IND_ID": np.arange(birds) + 100,
+                        "IND_NAME": [f"2020010{i % 9}_red{i}" for i in range(birds)],
+                        "SEX": "M", "MEDIAN_TEMPO": rng.random(birds)})
+    dfr = pd.concat([dfr, pd.DataFrame(calls[rng.integers(0, len(calls), (birds, markers))],
+                                       columns=[str(i) for i in range(markers)])], axis=1)
+    dfr.loc[list(nameless), "IND_NAME"] = ""
+    dfr.loc[list(missing), "MEDIAN_TEMPO"] = np.nan
+    if str(path).endswith(".tsv"):
+        dfr.to_csv(path, sep="\t", index=False)
+    else:
+        dfr.to_pickle(path)
+
+
+def run(path, tmp_path, load, relationship=None, prior=(), cursor=None, **kwargs):
+    """ Run compute_similarity on a file
+        Keyword arguments:
+          path: analyzed genotype file
+          tmp_path: directory for results
+          load: comparisons to load
+          relationship: relationships by bird1 and bird2 name
+          prior: pairs of bird names already in the database
+          cursor: fake cursor [new FakeCursor]
+          kwargs: argument overrides
+        Returns:
+          Module, sorted inserted rows, and results file contents (TSV only)
+    """
+    module = importlib.reload(compute_similarity)
+    args = {"FILE": str(path), "CACHE": str(tmp_path / "cache"), "MARKERS": None,
+            "PHENOTYPE": "median_tempo", "SINGLE": None, "START": None, "FULL": False,
+            "INCREMENTAL": False, "CHECKPOINT": None, "TOPK": None, "BLOCK": 64,
+            "TILE": 1024, "WORKERS": 1, "BATCH": 5000, "OUTPUT": str(tmp_path / "results.tsv"),
+            "MATRIX": None, "PRECISION": "float32", "SHARD": None, "WRITE": False,
+            "PHENOTYPES": None}
+    args.update(kwargs)
+    module.ARG = Namespace(**args)
+    module.LOGGER = logging.getLogger("compute_similarity")
+    module.CONN['bird'] = FakeConnection()
+    module.CURSOR['bird'] = cursor or FakeCursor()
+    module.WILL_LOAD.extend(load)
+    module.RELATIONSHIP.update(relationship or {})
+    module.COUNT[module.ARG.PHENOTYPE] = 0
+    if module.ARG.SHARD:
+        module.FRAME['SHARD'] = tuple(int(num) for num in module.ARG.SHARD.split("/"))
+    if module.ARG.TOPK:
+        module.NEIGHBOR.update({cvt: {} for cvt in load if cvt.startswith("allele")})
+    names = pd.read_pickle(path)["IND_NAME"] if str(path).endswith(".pkl") \
+            else pd.read_csv(path, sep="\t")["IND_NAME"]
+    module.SESSION.update({name: 1000 + pos for pos, name in enumerate(names)})
+    if prior:
+        module.PROCESSED["keys"] = np.unique([module.make_comparison_key(module.SESSION[bird1],
+                                                                         module.SESSION[bird2])
+                                              for bird1, bird2 in prior])
+    module.process_data_frame()
+    if not module.ARG.OUTPUT.endswith(".tsv"):
+        return module, sorted(module.CURSOR['bird'].inserted), None
+    with open(module.ARG.OUTPUT, encoding="ascii") as results:
+        return module, sorted(module.CURSOR['bird'].inserted), results.read()
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_nameless_birds_in_blocks(tmp_path, workers):
+    """ Blocks made up only of birds without names are never planned """
+    path = tmp_path / "analyzed.pkl"
+    make_frame(path, nameless=(3, 7, 11))
+    load = ["allele_match_all", "median_tempo"]
+    _, inserted, results = run(path, tmp_path, load)
+    module, blocked, bresults = run(path, tmp_path, load, BLOCK=2, TILE=7, WORKERS=workers)
+    assert blocked == inserted
+    assert bresults == results
+    assert module.COUNT["comparisons"] == 27 * 26 // 2
+
+
+def test_reused_store_with_other_metrics(tmp_path):
+    """ A store holding a metric that this run doesn't compute keeps it """
+    path = tmp_path / "analyzed.pkl"
+    make_frame(path)
+    store = str(tmp_path / "matrix")
+    run(path, tmp_path, ["allele_match_all", "ibs0"], MATRIX=store)
+    before = np.array(open_store(store)["metrics"]["ibs0"])
+    run(path, tmp_path, ["allele_match_all"], MATRIX=store, BLOCK=4)
+    after = open_store(store)["metrics"]
+    assert np.array_equal(after["ibs0"], before, equal_nan=True)
+    assert not np.isnan(after["allele_match_all"]).any()
+
+
+@pytest.mark.parametrize("suffix", ["pkl", "tsv"])
+def test_missing_phenotypes(tmp_path, suffix):
+    """ Birds with blank phenotypes get no phenotype comparisons """
+    path = tmp_path / f"analyzed.{suffix}"
+    make_frame(path, nameless=(3,), missing=(5, 9, 13))
+    module, inserted, results = run(path, tmp_path, ["allele_match_all", "median_tempo"])
+    assert module.COUNT["median_tempo"] == 26 * 25 // 2
+    assert len(inserted) == module.COUNT["allele_match_all"] + module.COUNT["median_tempo"]
+    assert "nan" not in results
+
+
+def test_topk_keeps_phenotypes(tmp_path):
+    """ --topk limits genotype comparisons but not phenotype comparisons """
+    path = tmp_path / "analyzed.pkl"
+    make_frame(path, missing=(5,))
+    module, _, _ = run(path, tmp_path, ["allele_match_all", "median_tempo"], TOPK=2)
+    assert module.COUNT["allele_match_all"] < module.COUNT["comparisons"]
+    assert module.COUNT["median_tempo"] == 29 * 28 // 2
+
+
+def test_single_bird_pairs(tmp_path):
+    """ --single --full compares one bird to every other bird, with each pair
+        in name order and its relationship in the results
+    """
+    path = tmp_path / "analyzed.pkl"
+    make_frame(path, nameless=(3,))
+    names = sorted(pd.read_pickle(path)["IND_NAME"].tolist())
+    single = names[10]
+    relationship = {names[2]: {single: "sire_to"}, single: {names[20]: "sibling"}}
+    module, inserted, results = run(path, tmp_path, ["allele_match_all"], relationship,
+                                    SINGLE=single, FULL=True)
+    assert module.COUNT["comparisons"] == 28
+    rows = [line.split("\t") for line in results.splitlines()[1:]]
+    assert [row[1] if row[0] != single else row[0] for row in rows] == [single] * 28
+    assert all(row[0] < row[1] for row in rows)
+    related = {(row[0], row[1]): row[6] for row in rows if len(row) > 6}
+    assert related == {(names[2], single): "sire_to", (single, names[20]): "sibling"}
+    assert len(inserted) == 28
+
+
+def test_incremental_after_partial_run(tmp_path):
+    """ A new bird compared to only some birds by an earlier run that stopped
+        isn't treated as old, so its missing pairs are still compared
+    """
+    path = tmp_path / "analyzed.pkl"
+    make_frame(path)
+    names = sorted(pd.read_pickle(path)["IND_NAME"].tolist())
+    old = names[:20]
+    prior = [(bird1, bird2) for pos, bird1 in enumerate(old) for bird2 in old[pos + 1:]]
+    # The earlier run compared new birds 25 and 26 to each other, then stopped
+    prior.append((names[25], names[26]))
+    load = ["allele_match_all", "median_tempo"]
+    module, inserted, _ = run(path, tmp_path, load, prior=prior, INCREMENTAL=True)
+    assert np.count_nonzero(module.FRAME['OLD']) == len(old)
+    assert module.COUNT["present"] == len(prior)
+    assert module.COUNT["comparisons"] == 30 * 29 // 2 - len(prior)
+    _, full, _ = run(path, tmp_path, load)
+    done = {(module.SESSION[bird1], module.SESSION[bird2]) for bird1, bird2 in prior}
+    assert inserted == [row for row in full if (row[1], row[4]) not in done]
+
+
+def test_undefined_metrics_not_inserted(tmp_path):
+    """ Pairs with no sequenced markers or no heterozygous calls in common
+        keep NaN in the matrix store, but nothing is inserted for them
+    """
+    path = tmp_path / "analyzed.pkl"
+    make_frame(path)
+    dfr = pd.read_pickle(path)
+    markers = [str(i) for i in range(120)]
+    dfr.loc[0, markers] = "./."
+    dfr.loc[1, markers] = "C/C"
+    dfr.loc[2, markers] = "G/G"
+    dfr.to_pickle(path)
+    store = str(tmp_path / "matrix")
+    load = ["allele_match_all", "allele_match_seq", "genomic_relationship"]
+    module, inserted, results = run(path, tmp_path, load, MATRIX=store)
+    assert not any(row[5] in ("nan", "inf", "-inf") for row in inserted)
+    assert module.COUNT["allele_match_all"] == 30 * 29 // 2
+    assert module.COUNT["allele_match_seq"] == 29 * 28 // 2
+    assert module.COUNT["genomic_relationship"] < 29 * 28 // 2
+    assert "nan" not in results
+    rows = [line.split("\t") for line in results.splitlines()[1:]]
+    assert sum(row[5] == "" for row in rows) == 29
+    metrics = open_store(store)["metrics"]
+    assert np.isnan(metrics["allele_match_seq"]).sum() == 29
+    assert np.isnan(metrics["genomic_relationship"]).sum() == 30 * 29 // 2 \
+           - module.COUNT["genomic_relationship"]
+    assert np.isfinite(metrics["genomic_relationship"][~np.isnan(
+        metrics["genomic_relationship"])]).all()
+
+
+def test_batched_inserts_match_pairs(tmp_path):
+    """ Comparisons inserted in batches are the rows that the original
+        comparison inserted one pair at a time
+    """
+    path = tmp_path / "analyzed.pkl"
+    make_frame(path, birds=12, missing=(4,))
+    module, inserted, _ = run(path, tmp_path, ["allele_match_all", "median_tempo"],
+                              BATCH=7, WRITE=True)
+    dfr = pd.read_pickle(path)
+    session = {name: 1000 + pos for pos, name in enumerate(dfr["IND_NAME"])}
+    dfr = dfr.sort_values(by="IND_NAME").reset_index(drop=True)
+    markers = [str(i) for i in range(120)]
+    expected = []
+    for idx1 in range(len(dfr)):
+        for idx2 in range(idx1 + 1, len(dfr)):
+            row1, row2 = dfr.iloc[idx1], dfr.iloc[idx2]
+            pair = (row1["IND_ID"], session[row1["IND_NAME"]], 1,
+                    row2["IND_ID"], session[row2["IND_NAME"]])
+            match_all, _ = compute_percent_match(list(row1[markers]), list(row2[markers]))
+            expected.append(pair + (str(match_all),))
+            if not (pd.isna(row1["MEDIAN_TEMPO"]) or pd.isna(row2["MEDIAN_TEMPO"])):
+                expected.append(pair + (str(float(row1["MEDIAN_TEMPO"])
+                                            - float(row2["MEDIAN_TEMPO"])),))
+    assert inserted == sorted(expected)
+    batches = module.CURSOR['bird'].batches
+    assert len(batches) > 1
+    assert {sql for sql, _ in batches} == {module.WRITE["COMPARE"]}
+    assert "INSERT IGNORE" in module.WRITE["COMPARE"]
+    assert module.CONN['bird'].commits == len(batches)
+
+
+def test_resumed_checkpoint_matches_full_run(tmp_path):
+    """ A run that fails partway and is resumed from its checkpoint inserts
+        the same comparisons and writes the same results as one full run
+    """
+    path = tmp_path / "analyzed.pkl"
+    make_frame(path)
+    load = ["allele_match_all", "allele_match_seq", "median_tempo"]
+    _, inserted, results = run(path, tmp_path, load, BATCH=50, WRITE=True)
+    checkpoint = str(tmp_path / "checkpoint.json")
+    cursor = FakeCursor(fail_after=3)
+    with pytest.raises(SystemExit):
+        run(path, tmp_path, load, cursor=cursor, BATCH=50, WRITE=True, CHECKPOINT=checkpoint)
+    assert cursor.inserted
+    module, resumed, rresults = run(path, tmp_path, load, BATCH=50, WRITE=True,
+                                    CHECKPOINT=checkpoint)
+    assert module.FRAME['RESUMED']
+    assert sorted(cursor.inserted + resumed) == inserted
+    assert module.COUNT["comparisons"] == 30 * 29 // 2
+    assert rresults == results
+
+
+def test_shards_merge_to_full_run(tmp_path, monkeypatch):
+    """ Shards compute disjoint comparisons that together make up a full
+        run, and --merge inserts them all
+    """
+    monkeypatch.chdir(tmp_path)
+    path = tmp_path / "analyzed.pkl"
+    make_frame(path, nameless=(6,))
+    load = ["allele_match_all", "ibs0", "median_tempo"]
+    _, inserted, results = run(path, tmp_path, load)
+    shards = []
+    rows = []
+    for index in range(3):
+        output = str(tmp_path / f"results_{index}.tsv")
+        module, sinserted, sresults = run(path, tmp_path, load, SHARD=f"{index}/3",
+                                          OUTPUT=output)
+        assert not sinserted
+        shards.append(str(tmp_path / f"comparisons_{index}_of_3.tsv"))
+        rows.extend(sresults.splitlines()[1:])
+    assert sorted(rows) == sorted(results.splitlines()[1:])
+    module = importlib.reload(compute_similarity)
+    module.ARG = Namespace(MERGE=shards, BATCH=100, WRITE=True, PHENOTYPES=None,
+                           CHECKPOINT=None)
+    module.LOGGER = logging.getLogger("compute_similarity")
+    module.CONN['bird'] = FakeConnection()
+    module.CURSOR['bird'] = FakeCursor()
+    module.merge_shards()
+    merged = module.CURSOR['bird'].inserted
+    assert len(merged) == module.COUNT["merged"] == len(inserted)
+    assert sorted(merged) == sorted(tuple(str(col) for col in row) for row in inserted)
+
+
+@pytest.mark.parametrize("suffix", ["tsv.gz", "parquet"])
+def test_compressed_and_parquet_results(tmp_path, suffix):
+    """ Compressed and Parquet results hold the same rows as plain TSV """
+    if suffix == "parquet":
+        pq = pytest.importorskip("pyarrow.parquet")
+    path = tmp_path / "analyzed.pkl"
+    make_frame(path, missing=(2, 8))
+    names = sorted(pd.read_pickle(path)["IND_NAME"].tolist())
+    relationship = {names[1]: {names[4]: "sibling"}}
+    load = ["allele_match_all", "median_tempo"]
+    _, inserted, results = run(path, tmp_path, load, relationship, BATCH=40)
+    output = str(tmp_path / f"results.{suffix}")
+    _, oinserted, _ = run(path, tmp_path, load, relationship, BATCH=40, OUTPUT=output)
+    assert oinserted == inserted
+    if suffix == "parquet":
+        table = pq.read_table(output).to_pydict()
+        lines = ["\t".join(compute_similarity.RESULT_COLUMNS)]
+        for row in zip(*table.values()):
+            lines.append("\t".join([row[0], row[1]]
+                                   + ["-" if val is None else str(val) for val in row[2:4]]
+                                   + [f"{row[4]:.2f}%", f"{row[5]:.2f}%"]
+                                   + ([row[6]] if row[6] else [])))
+        assert "\n".join(lines) + "\n" == results
+    else:
+        with gzip.open(output, "rt", encoding="ascii") as infile:
+            assert infile.read() == results
+
+
+class ScoreCursor(FakeCursor):
+    """ Cursor that also answers phenotype score and session queries """
+    def __init__(self, scores, sessions):
+        super().__init__()
+        self.scores = scores
+        self.sessions = sessions
+        self.args = None
+
+    def execute(self, sql, args=None):
+        """ Accept a query """
+        self.sql = sql
+        self.args = args
+
+    def fetchone(self):
+        """ Each phenotype term has its own ID """
+        return {"id": ["median_tempo", "song_rate"].index(self.args[0]) + 1}
+
+    def fetchall(self):
+        """ Return scores or sessions """
+        return self.scores if "FROM score" in self.sql else self.sessions
+
+
+def test_phenotype_differences_match_pairs(tmp_path):
+    """ Phenotype differences computed by broadcasting are the ones that
+        would be computed one pair at a time, using each bird's latest score
+    """
+    rng = np.random.default_rng(3)
+    birds = [f"bird{num:02d}" for num in range(11)]
+    scores = []
+    for pos, bird in enumerate(birds):
+        for term in ("median_tempo", "song_rate"):
+            if (pos + len(term)) % 4:
+                scores.append({"bird_id": pos + 1, "bird": bird, "term": term,
+                               "value": str(rng.random())})
+    scores.append({"bird_id": 3, "bird": birds[2], "term": "song_rate", "value": "n/a"})
+    scores.append({"bird_id": 5, "bird": birds[4], "term": "median_tempo", "value": "0.5"})
+    sessions = [{"bird": bird, "id": 500 + pos} for pos, bird in enumerate(birds[:-1])]
+    module = importlib.reload(compute_similarity)
+    module.ARG = Namespace(PHENOTYPES=["all"], BLOCK=3, BATCH=10, WRITE=True, CHECKPOINT=None)
+    module.LOGGER = logging.getLogger("compute_similarity")
+    module.CONN['bird'] = FakeConnection()
+    module.CURSOR['bird'] = ScoreCursor(scores, sessions)
+    module.compare_phenotypes()
+    latest = {}
+    for row in scores:
+        latest[(row["bird"], row["term"])] = row["value"]
+    expected = []
+    for pos1, bird1 in enumerate(birds[:-1]):
+        for pos2 in range(pos1 + 1, len(birds) - 1):
+            for term_id, term in enumerate(["median_tempo", "song_rate"], start=1):
+                try:
+                    diff = float(latest.get((bird1, term))) \
+                           - float(latest.get((birds[pos2], term)))
+                except (TypeError, ValueError):
+                    continue
+                expected.append((pos1 + 1, 500 + pos1, term_id, pos2 + 1, 500 + pos2,
+                                 str(diff)))
+    assert sorted(module.CURSOR['bird'].inserted) == sorted(expected)
+    assert {sql for sql, _ in module.CURSOR['bird'].batches} == {module.WRITE["REFRESH"]}
+    assert module.COUNT["skipped"] == 1
+
+
+@pytest.mark.parametrize("prior", [[], [(1001, 1002)]])
+def test_topk_needs_empty_table(tmp_path, monkeypatch, prior):
+    """ --topk is rejected when comparisons are already loaded """
+    (tmp_path / "birdsong_config.json").write_text('{"database": {"birdsong": {"dev": {}}}}')
+    (tmp_path / "run").mkdir()
+    monkeypatch.chdir(tmp_path / "run")
+    module = importlib.reload(compute_similarity)
+    module.ARG = Namespace(MANIFOLD="dev", MERGE=None, PHENOTYPES=None, SHARD=None,
+                           INCREMENTAL=False, PHENOTYPE="median_tempo", TOPK=5,
+                           COMPARISONS=["allele_match_all"])
+    module.LOGGER = logging.getLogger("compute_similarity")
+    monkeypatch.setattr(module, "db_connect",
+                        lambda dbd: (FakeConnection(prior), FakeCursor()))
+    if prior:
+        with pytest.raises(SystemExit):
+            module.initialize_program()
+    else:
+        module.initialize_program()
+        assert list(module.NEIGHBOR) == ["allele_match_all"]
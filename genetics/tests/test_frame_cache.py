@@ -0,0 +1,51 @@
+''' test_frame_cache.py
+    Tests for frame_cache.py
+'''
+
+import multiprocessing
+import os
+import pandas as pd
+import pytest
+import frame_cache
+
+pytest.importorskip("pyarrow")
+
+
+def cache_files(args):
+    """ Cache a list of sources (run in a worker process)
+        Keyword arguments:
+          args: cache directory, list of source TSVs
+        Returns:
+          list of Feather files
+    """
+    cache, paths = args
+    return [frame_cache.cached_file(path, cache) for path in paths]
+
+
+def test_workers_share_index(tmp_path):
+    """ Workers caching different files at once all end up in the index, and
+        a source that changes only drops a Feather file nothing else uses
+    """
+    paths = []
+    for num in range(12):
+        path = tmp_path / f"genotype{num}.tsv"
+        # Sources 0 and 1 have the same content
+        pd.DataFrame({"IND_ID": [max(num, 1)], "2": ["A/C"]}).to_csv(path, sep="\t",
+                                                                     index=False)
+        paths.append(str(path))
+    cache = str(tmp_path / "cache")
+    with multiprocessing.get_context("fork").Pool(4) as pool:
+        feathers = pool.map(cache_files, [(cache, paths[num::4] * 3) for num in range(4)])
+    index = frame_cache.read_index(cache)
+    assert sorted(index) == sorted(paths)
+    assert all(os.path.exists(cname) for cnames in feathers for cname in cnames)
+    assert index[paths[0]]["hash"] == index[paths[1]]["hash"]
+    shared = os.path.join(cache, f"{index[paths[0]]['hash']}.feather")
+    pd.DataFrame({"IND_ID": [0], "2": ["G/G"]}).to_csv(paths[0], sep="\t", index=False)
+    frame_cache.cached_file(paths[0], cache)
+    assert os.path.exists(shared)
+    stale = os.path.join(cache, f"{index[paths[2]]['hash']}.feather")
+    pd.DataFrame({"IND_ID": [2], "2": ["T/T"]}).to_csv(paths[2], sep="\t", index=False)
+    frame_cache.cached_file(paths[2], cache)
+    assert not os.path.exists(stale)
+    assert len(frame_cache.read_index(cache)) == 12
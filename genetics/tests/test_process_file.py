@@ -0,0 +1,380 @@
+''' test_process_file.py
+    Tests for process_file.py
+'''
+
+import importlib
+import logging
+import signal
+from argparse import Namespace
+import numpy as np
+import pandas as pd
+import pytest
+import process_file
+
+
+def test_genotype_summary_half_calls():
+    """ Half calls are neither missing nor heterozygous """
+    calls = np.array([["C/.", "./C", "./.", "C/G"],
+                      ["C/C", "./.", "G/G", "./G"]], dtype=object)
+    bird, counts = process_file.genotype_summary(calls)
+    assert bird["markers_sequenced"].tolist() == [3, 3]
+    assert bird["markers_missing"].tolist() == [1, 1]
+    assert bird["markers_heterozygous"].tolist() == [1, 0]
+    assert bird["call_rate"].tolist() == [0.75, 0.75]
+    # called, missing, heterozygous, A, C, G, T
+    assert counts.tolist() == [[2, 0, 0, 0, 3, 0, 0],
+                               [1, 1, 0, 0, 1, 0, 0],
+                               [1, 1, 0, 0, 0, 2, 0],
+                               [2, 0, 1, 0, 1, 2, 0]]
+
+
+def test_genotype_summary_multicharacter_alleles():
+    """ Alleles are split on "/", so longer alleles aren't misread """
+    calls = np.array([["AT/A", "A/AT", "AT/AT"],
+                      ["T/TA", "A/T", np.nan]], dtype=object)
+    bird, counts = process_file.genotype_summary(calls)
+    assert bird["markers_heterozygous"].tolist() == [2, 2]
+    assert bird["markers_missing"].tolist() == [0, 0]
+    assert counts[:, 2].tolist() == [2, 2, 0]
+    # Only single-base alleles are counted
+    assert counts[:, 3:].tolist() == [[1, 0, 0, 1],
+                                      [2, 0, 0, 1],
+                                      [0, 0, 0, 0]]
+
+
+class FakeConnection:
+    """ Connection with just enough transaction semantics to see what a load
+        leaves behind: DDL commits implicitly, as it does in MySQL
+    """
+    def __init__(self, fail_on=None):
+        self.pending = []
+        self.committed = []
+        self.fail_on = fail_on
+        self.lastrowid = 0
+        self.rows = []
+        self.executed = []
+        self.sessions = []
+
+    def commit(self):
+        """ Commit pending rows """
+        self.committed.extend(self.pending)
+        self.pending.clear()
+
+    def rollback(self):
+        """ Discard pending rows """
+        self.pending.clear()
+
+    def execute(self, sql, args=None):
+        """ Run one statement """
+        self.executed.append(sql)
+        self.rows = []
+        if self.fail_on and self.fail_on in sql:
+            raise RuntimeError(f"Failed: {sql}")
+        if sql.startswith("ALTER"):
+            self.commit()
+        elif sql.startswith("INSERT"):
+            self.lastrowid += 1
+            self.pending.append((sql, args))
+            if "INTO session" in sql:
+                self.sessions.append((self.lastrowid, args))
+        elif "MAX(id)" in sql:
+            self.rows = [{"id": self.sessions[-1][0] if self.sessions else 0}]
+        elif sql.startswith("SELECT id,bird_id,type_id FROM session"):
+            self.rows = [{"id": sid, "bird_id": row[2], "type_id": row[1]}
+                         for sid, row in self.sessions if sid > args[0]]
+        elif "cv_term_vw" in sql:
+            self.rows = [{"cv": "genotype", "cv_term": cvt, "id": pos}
+                         for pos, cvt in enumerate(("allelic_state",) + process_file.BIRD_QC)]
+            self.rows += [{"cv": "phenotype", "cv_term": cvt, "id": pos}
+                          for pos, cvt in enumerate(("median_tempo", "song_rate"), start=100)]
+        elif "FROM genotype_load" in sql:
+            self.rows = [{"bird_id": row[0]} for stmt, row in self.committed
+                         if "INTO genotype_load" in stmt and row[1] == args[0]]
+        elif "information_schema" in sql:
+            self.rows = [{"index_name": "state_marker_ind", "non_unique": 1,
+                          "columns": "marker"}]
+
+    def executemany(self, sql, rows):
+        """ Run a statement for each row """
+        for row in rows:
+            self.execute(sql, row)
+
+    def fetchone(self):
+        """ Return the first row of the last result """
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        """ Return the last result """
+        return self.rows
+
+
+def write_genotypes(path, bands=("gr1bu2", "gr3bu4", "gr5bu6"), calls=None):
+    """ Write a small genotype file
+        Keyword arguments:
+          path: genotype file
+          bands: color bands for the three birds
+          calls: calls for the three birds [three markers each]
+        Returns:
+          Dataframe written
+    """
+    calls = calls or [["A/A", "A/C", "./."], ["C/C", "A/A", "A/C"], ["A/C", "C/C", "C/C"]]
+    dfr = pd.DataFrame({"FAM_ID": 1, "IND_ID": list(bands),
+                        "FATHER_ID": 0, "MOTHER_ID": 0, "IND_BD": "01/01/2020",
+                        "BATCH": 1, "PLATE": 1, "WELL": "A1", "SEX": "M"})
+    dfr = pd.concat([dfr, pd.DataFrame(calls, columns=[str(col + 2)
+                                                      for col in range(len(calls[0]))])],
+                    axis=1)
+    dfr.to_csv(path, sep="\t", index=False)
+    return dfr
+
+
+def load_genotypes(tmp_path, monkeypatch, conn, **kwargs):
+    """ Load a small genotype file with --defer and --write
+        Keyword arguments:
+          tmp_path: directory for the genotype file
+          monkeypatch: pytest monkeypatch fixture
+          conn: fake connection
+          kwargs: argument overrides (and calls for write_genotypes)
+        Returns:
+          process_file module
+    """
+    dfr = write_genotypes(tmp_path / "genotype.tsv", calls=kwargs.pop("calls", None))
+    monkeypatch.chdir(tmp_path)
+    module = importlib.reload(process_file)
+    args = {"FILE": ["genotype.tsv"], "PHENFILE": None, "PHENOTYPE": ["median_tempo"],
+            "CHUNK": 0, "WORKERS": 1, "CACHE": str(tmp_path / "cache"), "SKIP": False,
+            "WRITE": True, "BATCH": 4, "PACKED": False, "INFILE": False, "DEFER": True}
+    args.update(kwargs)
+    module.ARG = Namespace(**args)
+    module.LOGGER = logging.getLogger("process_file")
+    module.CONN['bird'] = module.CURSOR['bird'] = conn
+    monkeypatch.setattr(module, "get_bird_names", lambda bands, birthdays: bands)
+    for bid, band in enumerate(dfr["IND_ID"], start=1):
+        module.BAND[band] = True
+        module.BIRD[band] = bid
+        module.BIRDID[bid] = {"name": band, "sex": "M", "band": band}
+    module.process_data_frame()
+    return module
+
+
+def test_deferred_load_commits(tmp_path, monkeypatch):
+    """ A deferred load commits its rows and restores the state indexes """
+    conn = FakeConnection()
+    load_genotypes(tmp_path, monkeypatch, conn)
+    assert not conn.pending
+    assert sum("INTO state" in sql for sql, _ in conn.committed) == 9
+    assert conn.executed[-2].startswith("ALTER TABLE state ADD INDEX `state_marker_ind`")
+
+
+def test_failed_deferred_load_rolls_back(tmp_path, monkeypatch):
+    """ A failed load leaves no rows behind, even though restoring the
+        indexes commits
+    """
+    conn = FakeConnection(fail_on="INTO state")
+    with pytest.raises(SystemExit):
+        load_genotypes(tmp_path, monkeypatch, conn)
+    assert not conn.committed
+    assert any(sql.startswith("ALTER TABLE state ADD") for sql in conn.executed)
+
+
+def test_pool_stops_on_bad_band(tmp_path, monkeypatch):
+    """ A worker that stops on a bad file stops the run instead of hanging it """
+    directory = tmp_path / "genotypes"
+    directory.mkdir()
+    write_genotypes(directory / "a.tsv")
+    write_genotypes(directory / "b.tsv", ("gr7bu8", "zz1bu2", "gr9bu1"))
+    monkeypatch.chdir(tmp_path)
+    module = importlib.reload(process_file)
+    module.ARG = Namespace(FILE=[str(directory)], PHENFILE=None, PHENOTYPE=["median_tempo"],
+                           CHUNK=0, WORKERS=2, CACHE=str(tmp_path / "cache"), SKIP=False,
+                           WRITE=True, BATCH=4, PACKED=False, INFILE=False, DEFER=False)
+    module.LOGGER = logging.getLogger("process_file")
+    module.CONN['bird'] = module.CURSOR['bird'] = FakeConnection()
+    module.COLOR.update({"gr": "green", "bu": "blue"})
+
+    def hung(sig, frame):
+        raise AssertionError("ingest_files hung")
+
+    previous = signal.signal(signal.SIGALRM, hung)
+    signal.alarm(60)
+    try:
+        with pytest.raises(SystemExit):
+            module.process_data_frame()
+    finally:
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def old_compare_calls(calls, markers, phencol, phenval, count):
+    """ Scan the phenotype birds one marker at a time (the original
+        compare_calls, without logging). The original counted a bird with no
+        match as close; here it's counted as a mismatch.
+        Keyword arguments:
+          calls: list of calls
+          markers: list of marker names
+          phencol: {bird: {marker: call}}
+          phenval: {bird: phenotype values}
+          count: counter dictionary
+        Returns:
+          Phenotype values (or None)
+    """
+    row = dict(zip(markers, calls))
+    for comp in phencol:
+        message = []
+        for marker in markers:
+            if row[marker] != phencol[comp][marker]:
+                message.append(marker)
+                if len(message) >= process_file.LIMIT:
+                    break
+        if len(message) >= process_file.LIMIT:
+            continue
+        count["seq_match" if not message else "seq_close"] += 1
+        return phenval[comp]
+    count["seq_mismatch"] += 1
+    return None
+
+
+def test_compare_calls_matches_scan(tmp_path):
+    """ The indexed match finds the same phenotype bird as the original scan,
+        including close matches that come before an exact one
+    """
+    rng = np.random.default_rng(5)
+    vocab = np.array(["A/A", "A/C", "C/C", "./."])
+    markers = [f"m{num}" for num in range(40)]
+    calls = vocab[rng.integers(0, len(vocab), (15, len(markers)))]
+    # Bird 9 is two calls away from bird 2
+    calls[9] = calls[2]
+    calls[9, [4, 17]] = np.where(calls[2, [4, 17]] == "A/A", "C/C", "A/A")
+    dfr = pd.DataFrame({"IND_ID": [f"bird{num}" for num in range(15)],
+                        "MEDIAN_TEMPO": rng.random(15)})
+    dfr = pd.concat([dfr, pd.DataFrame(calls, columns=markers)], axis=1)
+    dfr.to_csv(tmp_path / "phenotypes.tsv", sep="\t", index=False)
+    module = importlib.reload(process_file)
+    module.ARG = Namespace(PHENFILE=str(tmp_path / "phenotypes.tsv"), PHENOTYPE=["median_tempo"],
+                           CACHE=str(tmp_path / "cache"))
+    module.LOGGER = logging.getLogger("process_file")
+    module.process_phenotype_file({"phenotype": {"median_tempo": 1}})
+    phencol = {bird: dict(zip(markers, row)) for bird, row in zip(dfr["IND_ID"], calls)}
+    # The genotype file has a subset of the markers, in another order
+    gmarkers = list(rng.permutation(markers[:35]))
+    column = [markers.index(marker) for marker in gmarkers]
+    count = {"seq_match": 0, "seq_close": 0, "seq_mismatch": 0}
+    for bird in range(15):
+        for changes in range(module.LIMIT + 3):
+            gcalls = calls[bird, column].copy()
+            where = rng.choice(len(gmarkers), changes, replace=False)
+            gcalls[where] = np.where(gcalls[where] == "T/T", "G/G", "T/T")
+            expected = old_compare_calls(list(gcalls), gmarkers, phencol, module.PHENVAL, count)
+            assert module.compare_calls(list(gcalls), gmarkers) == expected
+    for key, val in count.items():
+        assert module.COUNT[key] == val
+    assert count["seq_close"] > count["seq_match"] > 0
+    assert count["seq_mismatch"] > 0
+
+
+def test_chunked_read_matches_full_read(tmp_path, monkeypatch):
+    """ Streaming a genotype file in chunks writes the same rows and analyzed
+        birds as reading it whole
+    """
+    rng = np.random.default_rng(9)
+    bands = [f"gr{num}bu{num}" for num in range(10)]
+    calls = np.array(["A/A", "A/C", "C/C", "./."])[rng.integers(0, 4, (10, 6))]
+    dfr = pd.DataFrame({"FAM_ID": 1, "IND_ID": bands, "FATHER_ID": 0, "MOTHER_ID": 0,
+                        "IND_BD": "01/01/2020", "BATCH": 1, "PLATE": 1, "WELL": "A1",
+                        "SEX": "M"})
+    dfr = pd.concat([dfr, pd.DataFrame(calls, columns=[str(num) for num in range(6)])], axis=1)
+    dfr.to_csv(tmp_path / "genotype.tsv", sep="\t", index=False)
+    monkeypatch.chdir(tmp_path)
+    results = []
+    for chunk in (0, 3):
+        conn = FakeConnection()
+        module = importlib.reload(process_file)
+        module.ARG = Namespace(FILE=["genotype.tsv"], PHENFILE=None,
+                               PHENOTYPE=["median_tempo"], CHUNK=chunk, WORKERS=1,
+                               CACHE=str(tmp_path / "cache"), SKIP=False, WRITE=True, BATCH=4,
+                               PACKED=False, INFILE=False, DEFER=False)
+        module.LOGGER = logging.getLogger("process_file")
+        module.CONN['bird'] = module.CURSOR['bird'] = conn
+        module.COLOR.update({"gr": "green", "bu": "blue"})
+        monkeypatch.setattr(module, "get_bird_names", lambda bands, birthdays: bands)
+        # The fifth bird isn't in the database
+        for bid, band in enumerate(bands, start=1):
+            if bid != 5:
+                module.BAND[band] = True
+                module.BIRD[band] = bid
+                module.BIRDID[bid] = {"name": band, "sex": "M", "band": band}
+        module.process_data_frame()
+        analyzed = pd.read_pickle("analyzed.pkl") if not chunk \
+                   else pd.read_csv("analyzed.tsv", sep="\t", dtype=str)
+        results.append((conn.committed, module.COUNT["processed"],
+                        analyzed.astype(str).reset_index(drop=True)))
+    full, chunked = results
+    assert chunked[0] == full[0]
+    assert chunked[1] == full[1] == 9
+    assert len(full[2]) == 9
+    pd.testing.assert_frame_equal(chunked[2], full[2])
+
+
+def test_ledger_rerun_skips_loaded_birds(tmp_path, monkeypatch):
+    """ A rerun only loads the birds that the ledger doesn't list for the file """
+    write_genotypes(tmp_path / "genotype.tsv")
+    fhash = process_file.source_hash(str(tmp_path / "genotype.tsv"))
+    conn = FakeConnection()
+    # An earlier run stopped after loading the first bird
+    conn.committed.append((process_file.WRITE["LEDGER"], (1, fhash, 99)))
+    module = load_genotypes(tmp_path, monkeypatch, conn)
+    assert module.COUNT["loaded"] == 1
+    assert module.COUNT["session"] == 2
+    sessions = [row for sql, row in conn.committed if "INTO session" in sql]
+    assert [row[2] for row in sessions] == [2, 3]
+    ledger = [row for sql, row in conn.committed if "INTO genotype_load" in sql]
+    assert sorted(row[0] for row in ledger) == [1, 2, 3]
+    committed = len(conn.committed)
+    module = load_genotypes(tmp_path, monkeypatch, conn)
+    assert module.COUNT["loaded"] == 3
+    assert module.COUNT["session"] == 0
+    assert not [sql for sql, _ in conn.committed[committed:] if "INTO session" in sql]
+
+
+def test_duplicate_bird_rows(tmp_path, monkeypatch):
+    """ A bird listed twice in a file is counted and loaded once """
+    write_genotypes(tmp_path / "genotype.tsv", ("gr1bu2", "gr3bu4", "gr1bu2"))
+    module = importlib.reload(process_file)
+    module.ARG = Namespace(PHENOTYPE=["median_tempo"])
+    module.LOGGER = logging.getLogger("process_file")
+    monkeypatch.setattr(module, "get_bird_names", lambda bands, birthdays: bands)
+    for bid, band in enumerate(("gr1bu2", "gr3bu4"), start=1):
+        module.BAND[band] = True
+        module.BIRD[band] = bid
+        module.BIRDID[bid] = {"name": band, "sex": "M", "band": band}
+    frame = module.validate_frame(pd.read_csv(tmp_path / "genotype.tsv", sep="\t"))
+    assert module.COUNT["duplicate"] == 1
+    assert module.COUNT["processed"] == 2
+    assert frame["bids"] == [1, 2]
+    assert frame["delete"] == [2]
+    assert frame["calls"].tolist() == [["A/A", "A/C", "./."], ["C/C", "A/A", "A/C"]]
+
+
+def test_phenotype_scores_on_their_sessions(tmp_path, monkeypatch):
+    """ Every phenotype column is loaded in one pass, and each score is
+        written to a session for its own bird and phenotype
+    """
+    rng = np.random.default_rng(2)
+    calls = np.array(["A/A", "A/C", "C/C", "./."])[rng.integers(0, 4, (3, 12))]
+    phen = pd.DataFrame({"IND_ID": [11, 12, 13], "MEDIAN_TEMPO": [1.5, 2.5, np.nan],
+                         "SONG_RATE": ["7", "x", "9"]})
+    phen = pd.concat([phen, pd.DataFrame(calls[[1, 2, 0]],
+                                         columns=[str(col + 2) for col in range(12)])], axis=1)
+    phen.to_csv(tmp_path / "phenotypes.tsv", sep="\t", index=False)
+    conn = FakeConnection()
+    module = load_genotypes(tmp_path, monkeypatch, conn, calls=calls.tolist(),
+                            PHENOTYPE=["all"], PHENFILE=str(tmp_path / "phenotypes.tsv"),
+                            BATCH=3)
+    assert module.PHENOTYPES == ["MEDIAN_TEMPO", "SONG_RATE"]
+    sessions = {sid: (row[2], row[1]) for sid, row in conn.sessions}
+    scores = {sessions[row[0]]: row[2] for sql, row in conn.committed if "INTO score" in sql
+              and row[1] >= 100}
+    # Genotype birds 1-3 match phenotype birds 13, 11, and 12
+    assert scores == {(1, 101): "9", (2, 100): 1.5, (2, 101): "7", (3, 100): 2.5}
+    assert module.COUNT["phenotype"] == 1
+    assert module.COUNT["seq_match"] == 3
@@ -0,0 +1,115 @@
+''' test_similarity_engine.py
+    Tests for similarity_engine.py. Scores are checked against a copy of the
+    per-pair comparison that the engine replaced.
+'''
+
+import numpy as np
+import pandas as pd
+import pytest
+from similarity_engine import METRICS, encode_genotypes, pair_metrics
+
+
+def compute_percent_match(row1, row2):
+    """ Compute match percentages for all and sequenced alleles, one marker at
+        a time (the original compute_similarity.py comparison)
+        Keyword arguments:
+          row1: list of bird1 calls
+          row2: list of bird2 calls
+        Returns:
+           % match for all alleles, % match for sequenced alleles
+    """
+    score = seqscore = 0.0
+    seqcount = 0
+    for val1, val2 in zip(row1, row2):
+        if (val1 == val2) and (val1 != "./."):
+            score += 1
+        else:
+            v1l = val1.split("/")
+            v2l = val2.split("/")
+            if (v1l[0] != "." and v1l[0] in v2l) or (v1l[1] != "." and v1l[1] in v2l):
+                score += 0.5
+        if val1 != "./." and val2 != "./.":
+            seqcount += 1
+            if val1 == val2:
+                seqscore += 1
+    return score / len(row1) * 100.0, seqscore / seqcount * 100.0
+
+
+def make_calls(kind, birds=24, markers=150):
+    """ Build a call matrix. Each marker has its own alleles.
+        Keyword arguments:
+          kind: biallelic, multiallelic, half (partial calls), or hets (both
+                heterozygous spellings)
+          birds: number of birds
+          markers: number of markers
+        Returns:
+          birds x markers array of calls
+    """
+    rng = np.random.default_rng(11)
+    bases = np.array(["A", "C", "G", "T"])
+    calls = np.empty((birds, markers), dtype=object)
+    for col in range(markers):
+        ref, alt, third = rng.permutation(bases)[:3]
+        choices = [f"{ref}/{ref}", f"{ref}/{alt}", f"{alt}/{alt}", "./."]
+        if kind == "multiallelic":
+            choices += [f"{alt}/{third}", f"{third}/{third}", f"{ref}/{third}"]
+        elif kind == "half":
+            choices += [f"{ref}/.", f"./{alt}"]
+        elif kind == "hets":
+            choices += [f"{alt}/{ref}"]
+        calls[:, col] = rng.choice(choices, size=birds)
+    # Every pair has sequenced markers in common
+    calls[:, 0] = "A/A"
+    return calls
+
+
+def encode(calls):
+    """ Encode a call matrix behind two name columns
+        Keyword arguments:
+          calls: birds x markers array of calls
+        Returns:
+          genotype dictionary
+    """
+    dfr = pd.concat([pd.DataFrame({"IND_ID": range(calls.shape[0]), "IND_NAME": "bird"}),
+                     pd.DataFrame(calls, columns=[str(i) for i in range(calls.shape[1])])],
+                    axis=1)
+    return encode_genotypes(dfr, 2)
+
+
+def baseline(calls):
+    """ Score every pair of birds with the original comparison
+        Keyword arguments:
+          calls: birds x markers array of calls
+        Returns:
+          all-marker and sequenced-marker match matrices
+    """
+    size = calls.shape[0]
+    match_all = np.zeros((size, size))
+    match_seq = np.zeros((size, size))
+    for idx1 in range(size):
+        for idx2 in range(size):
+            match_all[idx1, idx2], match_seq[idx1, idx2] \
+                = compute_percent_match(list(calls[idx1]), list(calls[idx2]))
+    return match_all, match_seq
+
+
+@pytest.mark.parametrize("kind,packed", [("biallelic", True), ("multiallelic", False),
+                                         ("half", False), ("hets", False)])
+def test_engine_matches_baseline(kind, packed):
+    """ Allele matches equal the per-pair comparison, and biallelic calls
+        score the same whether or not they are packed
+    """
+    calls = make_calls(kind)
+    geno = encode(calls)
+    assert (geno["packed"] is not None) == packed
+    match_all, match_seq = baseline(calls)
+    rows = list(range(calls.shape[0]))
+    # Bird1 rows are lists and bird2 rows are slices when scoring tiles
+    result = pair_metrics(geno, rows, slice(0, len(rows)), METRICS)
+    assert np.allclose(result["allele_match_all"], match_all, rtol=0, atol=1e-9)
+    assert np.allclose(result["allele_match_seq"], match_seq, rtol=0, atol=1e-9)
+    if packed:
+        geno["packed"] = None
+        unpacked = pair_metrics(geno, rows, slice(0, len(rows)), METRICS)
+        for cvt, values in result.items():
+            assert np.array_equal(unpacked[cvt], values, equal_nan=True)
@@ -0,0 +1,40 @@
+''' test_similarity_store.py
+    Tests for similarity_store.py
+'''
+
+import os
+import numpy as np
+from similarity_store import create_store, get_pair, open_store, put_block
+
+
+def test_float16_store_keeps_counts_exact(tmp_path):
+    """ Marker counts stay exact in a float16 store; similarities are rounded """
+    birds = ["bird1", "bird2", "bird3"]
+    store = create_store(str(tmp_path), birds, ["allele_match_all", "informative_markers"],
+                         "float16")
+    put_block(store, "informative_markers", 0, np.array([1, 2]), np.array([4097.0, 65537.0]))
+    put_block(store, "allele_match_all", 0, np.array([1, 2]), np.array([4097.0, 0.1]))
+    for mat in store["metrics"].values():
+        mat.flush()
+    store = open_store(str(tmp_path))
+    assert store["metrics"]["informative_markers"].dtype == np.float32
+    assert store["metrics"]["allele_match_all"].dtype == np.float16
+    assert get_pair(store, "informative_markers", "bird1", "bird2") == 4097
+    assert get_pair(store, "informative_markers", "bird3", "bird1") == 65537
+    # float16 rounds to the nearest representable value (a spacing of 4 above 4096)
+    assert get_pair(store, "allele_match_all", "bird1", "bird2") == 4096
+    assert np.isnan(get_pair(store, "informative_markers", "bird2", "bird3"))
+
+
+def test_rebuild_keeps_open_readers(tmp_path):
+    """ Rebuilding a store doesn't truncate the matrices a reader has open """
+    store = create_store(str(tmp_path), ["bird1", "bird2", "bird3"], ["allele_match_all"])
+    put_block(store, "allele_match_all", 0, np.array([1, 2]), np.array([50.0, 60.0]))
+    store["metrics"]["allele_match_all"].flush()
+    reader = open_store(str(tmp_path))
+    create_store(str(tmp_path), ["bird1", "bird2", "bird4", "bird5"], ["allele_match_all"])
+    assert get_pair(reader, "allele_match_all", "bird1", "bird3") == 60.0
+    rebuilt = open_store(str(tmp_path))
+    assert rebuilt["birds"] == ["bird1", "bird2", "bird4", "bird5"]
+    assert np.isnan(rebuilt["metrics"]["allele_match_all"]).all()
+    assert len([fname for fname in os.listdir(tmp_path) if fname.endswith(".npy")]) == 1
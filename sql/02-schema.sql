@@ -427,6 +427,102 @@ CREATE TABLE `state` (
 ) ENGINE=InnoDB AUTO_INCREMENT=1001 DEFAULT CHARSET=utf8mb4;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
+--
+-- Table structure for table `genotype_marker_set`
+--
+DROP TABLE IF EXISTS `genotype_marker_set`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `genotype_marker_set` (
+  `id` int(10) unsigned NOT NULL AUTO_INCREMENT,
+  `hash` varchar(32) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci NOT NULL,
+  `marker_count` int(10) unsigned NOT NULL,
+  `create_date` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `genotype_marker_set_hash_uk_ind` (`hash`) USING BTREE
+) ENGINE=InnoDB AUTO_INCREMENT=1001 DEFAULT CHARSET=utf8mb4;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `genotype_marker`
+--
+DROP TABLE IF EXISTS `genotype_marker`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `genotype_marker` (
+  `marker_set_id` int(10) unsigned NOT NULL,
+  `position` int(10) unsigned NOT NULL,
+  `marker` varchar(16) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci NOT NULL,
+  PRIMARY KEY (`marker_set_id`,`position`),
+  CONSTRAINT `genotype_marker_marker_set_id_fk` FOREIGN KEY (`marker_set_id`) REFERENCES `genotype_marker_set` (`id`) ON DELETE NO ACTION ON UPDATE NO ACTION
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `genotype_blob`
+--
+DROP TABLE IF EXISTS `genotype_blob`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `genotype_blob` (
+  `id` int(10) unsigned NOT NULL AUTO_INCREMENT,
+  `session_id` int(10) unsigned NOT NULL,
+  `marker_set_id` int(10) unsigned NOT NULL,
+  `vocab` text CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci NOT NULL,
+  `calls` mediumblob NOT NULL,
+  `create_date` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `genotype_blob_session_id_uk_ind` (`session_id`) USING BTREE,
+  CONSTRAINT `genotype_blob_session_id_fk` FOREIGN KEY (`session_id`) REFERENCES `session` (`id`) ON DELETE NO ACTION ON UPDATE NO ACTION,
+  CONSTRAINT `genotype_blob_marker_set_id_fk` FOREIGN KEY (`marker_set_id`) REFERENCES `genotype_marker_set` (`id`) ON DELETE NO ACTION ON UPDATE NO ACTION
+) ENGINE=InnoDB AUTO_INCREMENT=1001 DEFAULT CHARSET=utf8mb4;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `genotype_load`
+--
+DROP TABLE IF EXISTS `genotype_load`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `genotype_load` (
+  `id` int(10) unsigned NOT NULL AUTO_INCREMENT,
+  `bird_id` int(10) unsigned NOT NULL,
+  `file_hash` varchar(64) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci NOT NULL,
+  `session_id` int(10) unsigned NOT NULL,
+  `create_date` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `genotype_load_uk_ind` (`file_hash`,`bird_id`) USING BTREE,
+  CONSTRAINT `genotype_load_bird_id_fk` FOREIGN KEY (`bird_id`) REFERENCES `bird` (`id`) ON DELETE NO ACTION ON UPDATE NO ACTION,
+  CONSTRAINT `genotype_load_session_id_fk` FOREIGN KEY (`session_id`) REFERENCES `session` (`id`) ON DELETE NO ACTION ON UPDATE NO ACTION
+) ENGINE=InnoDB AUTO_INCREMENT=1001 DEFAULT CHARSET=utf8mb4;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `genotype_marker_summary`
+--
+DROP TABLE IF EXISTS `genotype_marker_summary`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `genotype_marker_summary` (
+  `id` int(10) unsigned NOT NULL AUTO_INCREMENT,
+  `file_hash` varchar(64) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci NOT NULL,
+  `marker` varchar(16) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci NOT NULL,
+  `birds` int(10) unsigned NOT NULL,
+  `called` int(10) unsigned NOT NULL,
+  `missing` int(10) unsigned NOT NULL,
+  `heterozygous` int(10) unsigned NOT NULL,
+  `allele_a` int(10) unsigned NOT NULL,
+  `allele_c` int(10) unsigned NOT NULL,
+  `allele_g` int(10) unsigned NOT NULL,
+  `allele_t` int(10) unsigned NOT NULL,
+  `call_rate` decimal(12,8) NOT NULL,
+  `create_date` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `genotype_marker_summary_uk_ind` (`file_hash`,`marker`) USING BTREE,
+  KEY `genotype_marker_summary_marker_ind` (`marker`) USING BTREE
+) ENGINE=InnoDB AUTO_INCREMENT=1001 DEFAULT CHARSET=utf8mb4;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for naterialized view `phenotype_state_mv`
 --
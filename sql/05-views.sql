@@ -300,6 +300,18 @@ JOIN bird b ON (ss.bird_id=b.id)
 JOIN user u ON (u.id=ss.user_id)
 ;
 
+-- Packed genotypes: byte n of calls is the 1-based position in the
+-- comma-separated vocab of the call for marker n of the marker set
+CREATE OR REPLACE VIEW packed_state_vw AS
+SELECT gb.id
+       ,gb.session_id
+       ,gm.marker
+       ,SUBSTRING_INDEX(SUBSTRING_INDEX(gb.vocab,',',ORD(SUBSTRING(gb.calls,gm.position,1))),',',-1) AS state
+       ,gb.create_date
+FROM genotype_blob gb
+JOIN genotype_marker gm ON (gm.marker_set_id=gb.marker_set_id)
+;
+
 CREATE OR REPLACE VIEW state_vw AS
 SELECT s.id
        ,ss.id AS session_id
@@ -311,6 +323,19 @@ SELECT s.id
 FROM state s
 JOIN session ss ON (s.session_id=ss.id)
 JOIN bird b ON (ss.bird_id=b.id)
+WHERE NOT EXISTS (SELECT 1 FROM genotype_blob pb WHERE pb.session_id=s.session_id)
+UNION ALL
+SELECT gb.id
+       ,ss.id AS session_id
+       ,ss.name AS session
+       ,b.name AS bird
+       ,gm.marker
+       ,SUBSTRING_INDEX(SUBSTRING_INDEX(gb.vocab,',',ORD(SUBSTRING(gb.calls,gm.position,1))),',',-1) AS state
+       ,gb.create_date
+FROM genotype_blob gb
+JOIN session ss ON (gb.session_id=ss.id)
+JOIN bird b ON (ss.bird_id=b.id)
+JOIN genotype_marker gm ON (gm.marker_set_id=gb.marker_set_id)
 ;
 
 CREATE OR REPLACE VIEW phenotype_state_build_vw AS
@@ -319,7 +344,10 @@ SELECT c.display_name AS type
        ,state
        ,GROUP_CONCAT(value) AS svalues
        ,COUNT(1) AS count
-FROM state st
+FROM (SELECT session_id,marker,state FROM state s
+      WHERE NOT EXISTS (SELECT 1 FROM genotype_blob pb WHERE pb.session_id=s.session_id)
+      UNION ALL
+      SELECT session_id,marker,state FROM packed_state_vw) st
 JOIN session ss1 ON (st.session_id=ss1.id)
 JOIN score sc
 JOIN cv_term c ON (sc.type_id=c.id)
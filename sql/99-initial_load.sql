@@ -110,6 +110,9 @@ INSERT INTO cv_term (cv_id,is_current,name,display_name,definition) VALUES (getC
 INSERT INTO cv (version,is_current,name,display_name,definition) VALUES (1,1,'genotype','Genotype','Genotype');
 INSERT INTO cv_term (cv_id,is_current,name,display_name,definition) VALUES (getCVId('genotype',''),1,'allelic_state','Allelic state','Allelic state');
 INSERT INTO cv_term (cv_id,is_current,name,display_name,definition) VALUES (getCVId('genotype',''),1,'markers_sequenced','Markers sequenced','Number of markers sequenced');
+INSERT INTO cv_term (cv_id,is_current,name,display_name,definition) VALUES (getCVId('genotype',''),1,'markers_missing','Markers missing','Number of markers with no call (./.)');
+INSERT INTO cv_term (cv_id,is_current,name,display_name,definition) VALUES (getCVId('genotype',''),1,'markers_heterozygous','Markers heterozygous','Number of heterozygous markers');
+INSERT INTO cv_term (cv_id,is_current,name,display_name,definition) VALUES (getCVId('genotype',''),1,'call_rate','Call rate','Fraction of markers sequenced');
 INSERT INTO cv (version,is_current,name,display_name,definition) VALUES (1,1,'phenotype','Phenotype','Phenotype');
 INSERT INTO cv_term (cv_id,is_current,name,display_name,definition) VALUES (getCVId('phenotype',''),1,'median_tempo','Median song tempo','Median song tempo');
 
@@ -127,6 +130,11 @@ INSERT INTO cv_term (cv_id,is_current,name,display_name,definition) VALUES (getC
 INSERT INTO cv (version,is_current,name,display_name,definition) VALUES (1,1,'bird_comparison','Bird comparison','Bird comparison');
 INSERT INTO cv_term (cv_id,is_current,name,display_name,definition) VALUES (getCVId('bird_comparison',''),1,'allele_match_all','Allele match % (all)','Allele match percentage (all markers)');
 INSERT INTO cv_term (cv_id,is_current,name,display_name,definition) VALUES (getCVId('bird_comparison',''),1,'allele_match_seq','Allele match % (sequenced)','Allele match percentage (sequenced markers)');
+INSERT INTO cv_term (cv_id,is_current,name,display_name,definition) VALUES (getCVId('bird_comparison',''),1,'ibs0','IBS0','Markers sequenced in both birds with no alleles in common');
+INSERT INTO cv_term (cv_id,is_current,name,display_name,definition) VALUES (getCVId('bird_comparison',''),1,'ibs1','IBS1','Markers sequenced in both birds with one allele in common');
+INSERT INTO cv_term (cv_id,is_current,name,display_name,definition) VALUES (getCVId('bird_comparison',''),1,'ibs2','IBS2','Markers sequenced in both birds with identical calls');
+INSERT INTO cv_term (cv_id,is_current,name,display_name,definition) VALUES (getCVId('bird_comparison',''),1,'informative_markers','Informative markers','Markers sequenced in both birds');
+INSERT INTO cv_term (cv_id,is_current,name,display_name,definition) VALUES (getCVId('bird_comparison',''),1,'genomic_relationship','Genomic relationship','Genomic relationship (twice the KING-robust kinship coefficient)');
 INSERT INTO cv_term (cv_id,is_current,name,display_name,definition) VALUES (getCVId('bird_comparison',''),1,'median_tempo','Median tempo','Median tempo');
 
 --